@@ -0,0 +1,365 @@
+# coding: utf-8
+"""
+Admission control for git transfers.
+
+Every upload-pack that is not answered from the cache runs its own git process, so a
+clone storm is turned into a queue instead: at most MAX_ACTIVE transfers run at a time
+across all workers sharing the cache (MAX_PER_REPO of them on one repo), the rest wait
+in per-user queues that are served round robin so one client cloning in a loop cannot
+starve everyone else. Once MAX_QUEUED transfers are waiting in a worker, or one waited
+QUEUE_TIMEOUT seconds, the client is told to come back later (429 with Retry-After).
+
+Running transfers are counted with one counter per scope (all transfers, each repo) in
+the shared cache, incremented and decremented atomically. Counters are kept per epoch
+of SLOT_TIMEOUT seconds and a scope's count is that of the current and the previous
+epoch: every worker moves its running transfers to the new epoch as it starts, so the
+transfers of a worker that died drop out of the count within two epochs however long
+the others run. The queues are per worker process; slots given back in this worker are
+handed out right away, those of other workers are looked for every POLL_INTERVAL
+seconds by a single thread per worker.
+
+Each worker publishes its counters to the cache every METRICS_INTERVAL seconds, see
+transfer_metrics().
+"""
+
+from collections import deque
+from hashlib import sha1
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .exception import TransferRejected
+
+
+MAX_ACTIVE = getattr(settings, 'GIT_TRANSFER_MAX_ACTIVE', (os.cpu_count() or 1) * 2)
+MAX_PER_REPO = getattr(settings, 'GIT_TRANSFER_MAX_PER_REPO', 4)
+MAX_QUEUED = getattr(settings, 'GIT_TRANSFER_MAX_QUEUED', 64)
+QUEUE_TIMEOUT = getattr(settings, 'GIT_TRANSFER_QUEUE_TIMEOUT', 30)
+RETRY_AFTER = getattr(settings, 'GIT_TRANSFER_RETRY_AFTER', 10)
+METRICS_INTERVAL = getattr(settings, 'GIT_TRANSFER_METRICS_INTERVAL', 10)
+SLOT_TIMEOUT = getattr(settings, 'GIT_TRANSFER_SLOT_TIMEOUT', 60)
+POLL_INTERVAL = getattr(settings, 'GIT_TRANSFER_POLL_INTERVAL', 0.5)
+WORKERS_KEY = 'git-transfer-workers'
+
+
+class Waiter(object):
+
+    def __init__(self, repo, user):
+        self.repo = repo
+        self.user = user
+        self.event = threading.Event()
+        self.queued_at = time.time()
+        self.slot = None  # The Slot it was given
+
+
+class Slot(object):
+    """
+    A running transfer's place in the counters of scopes, as of epoch
+    """
+
+    def __init__(self, scopes, epoch):
+        self.scopes = scopes
+        self.epoch = epoch
+
+
+class AdmissionController(object):
+    """
+    :param max_active: transfers running at the same time, in all workers
+    :param max_per_repo: of which on the same repo
+    :param max_queued: transfers allowed to wait for a slot in this worker, 0 to reject right away
+    :param timeout: seconds a transfer waits before it is rejected
+    :param name: prefix of the counters, controllers with the same name share their slots
+    """
+
+    def __init__(self, max_active=MAX_ACTIVE, max_per_repo=MAX_PER_REPO,
+                 max_queued=MAX_QUEUED, timeout=QUEUE_TIMEOUT, name='git-transfers'):
+        self.name = name
+        self.max_active = max_active
+        self.max_per_repo = max_per_repo
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = {}  # repo -> running transfers of this worker
+        self.slots = set()  # Slots of the running transfers of this worker
+        self.queues = {}  # user -> deque of Waiters
+        self.users = deque()  # Users with waiters, the next one to be served first
+        self.queued = 0
+        self.counters = dict.fromkeys(('admitted', 'queued', 'rejected', 'timed_out', 'completed'), 0)
+        self.wait_total = self.wait_max = 0.0
+        self.published_at = 0
+        self.poller = None
+
+    def __repr__(self):
+        return '<AdmissionController {0} active, {1} queued>'.format(self.running, self.queued)
+
+    @property
+    def running(self):
+        return sum(self.active.values())
+
+    def admit(self, repo, user):
+        """
+        Waits for a slot for a transfer of user (a username or client address) on repo.
+        :return: the callable that gives the slot back, call it once the transfer is over
+        :raise TransferRejected: if the queue is full or the wait timed out
+        """
+        waiter = Waiter(repo, user)
+
+        with self.lock:
+            self.__start_poller()
+
+            if user not in self.queues:
+                self.queues[user] = deque()
+                self.users.append(user)
+            self.queues[user].append(waiter)
+            self.queued += 1
+            self.__dispatch()
+
+            if waiter.event.is_set():
+                return self.__releaser(waiter)
+
+            # Whoever is left in the queue after a dispatch cannot start yet
+            if self.queued > self.max_queued:
+                self.__unqueue(waiter)
+                self.counters['rejected'] += 1
+                self.__publish()
+                raise TransferRejected(self.retry_after())
+            self.counters['queued'] += 1
+
+        if not waiter.event.wait(self.timeout):
+            with self.lock:
+                if not waiter.event.is_set():  # Not granted in the meantime
+                    self.__unqueue(waiter)
+                    self.counters['timed_out'] += 1
+                    self.__publish()
+                    raise TransferRejected(self.retry_after())
+        return self.__releaser(waiter)
+
+    def retry_after(self):
+        """
+        Seconds a rejected client should wait, longer the fuller the queue is
+        """
+        return RETRY_AFTER * (1 + self.queued // max(self.max_active, 1))
+
+    def metrics(self):
+        with self.lock:
+            waits = self.counters['admitted'] or 1
+            return dict(self.counters, active=self.running, waiting=self.queued,
+                        waiting_users=len(self.users), max_active=self.max_active,
+                        max_per_repo=self.max_per_repo, max_queued=self.max_queued,
+                        active_all_workers=sum(slot_counts(self.name, current_epoch())),
+                        wait_seconds_total=round(self.wait_total, 3), wait_seconds_max=round(self.wait_max, 3),
+                        wait_seconds_mean=round(self.wait_total / waits, 3),
+                        repos=dict((repo, count) for repo, count in self.active.items() if count))
+
+    def poll(self):
+        """
+        One round of the poller: hands slots freed by other workers to the waiters and
+        moves the running transfers to the current epoch
+        """
+        with self.lock:
+            epoch = current_epoch()
+
+            for slot in self.slots:
+                if slot.epoch != epoch:
+                    for scope in slot.scopes:
+                        move_slot(scope, slot.epoch, epoch)
+                    slot.epoch = epoch
+
+            if self.users:
+                self.__dispatch()
+
+    def __start_poller(self):
+        if self.poller is None or not self.poller.is_alive():
+            self.poller = threading.Thread(target=self.__poll_forever, daemon=True)
+            self.poller.start()
+
+    def __poll_forever(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            self.poll()
+
+    def __take(self, repo, epoch):
+        # A Slot among all transfers and among repo's, None when repo's are all
+        # taken and False when every slot is
+        repo_scope = '{0}:{1}'.format(self.name, sha1(repo.encode('utf-8')).hexdigest()[:16])
+
+        if not take_slot(self.name, self.max_active, epoch):
+            return False
+
+        if not take_slot(repo_scope, self.max_per_repo, epoch):
+            give_slot(self.name, epoch)
+            return None
+        return Slot((self.name, repo_scope), epoch)
+
+    def __start(self, waiter, slot):
+        waiter.slot = slot
+        self.slots.add(slot)
+        self.active[waiter.repo] = self.active.get(waiter.repo, 0) + 1
+        self.counters['admitted'] += 1
+        waited = time.time() - waiter.queued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.__publish()
+
+    def __releaser(self, waiter):
+        released = []
+
+        def release():
+            with self.lock:
+                if released:
+                    return
+                released.append(True)
+                slot = waiter.slot
+                self.slots.discard(slot)
+                for scope in slot.scopes:
+                    give_slot(scope, slot.epoch)
+
+                self.active[waiter.repo] -= 1
+                if not self.active[waiter.repo]:
+                    del self.active[waiter.repo]
+                self.counters['completed'] += 1
+                self.__dispatch()
+                self.__publish()
+        return release
+
+    def __dispatch(self):
+        # Hands free slots to the waiters, one user at a time in turn. A user's
+        # waiters start in order unless their repo is at its limit. Each repo is
+        # tried at most once and the first full answer for all transfers ends it,
+        # so a round costs a few cache calls however many are waiting.
+        skipped = 0
+        full = set()
+        epoch = current_epoch()
+
+        while self.users and skipped < len(self.users):
+            user = self.users[0]
+            waiter = slot = None
+
+            for candidate in self.queues[user]:
+                if candidate.repo in full:
+                    continue
+
+                slot = self.__take(candidate.repo, epoch)
+                if slot is False:
+                    return  # No slot left for anyone
+                if slot is None:
+                    full.add(candidate.repo)
+                    continue
+                waiter = candidate
+                break
+            self.users.rotate(-1)
+
+            if waiter is None:
+                skipped += 1
+                continue
+
+            skipped = 0
+            self.__unqueue(waiter)
+            self.__start(waiter, slot)
+            waiter.event.set()
+
+    def __unqueue(self, waiter):
+        queue = self.queues[waiter.user]
+        queue.remove(waiter)
+        self.queued -= 1
+
+        if not queue:
+            del self.queues[waiter.user]
+            self.users.remove(waiter.user)
+
+    def __publish(self):
+        # Called with the lock held
+        now = time.time()
+        if now - self.published_at < METRICS_INTERVAL:
+            return
+        self.published_at = now
+
+        threading.Thread(target=publish_metrics, args=(self,), daemon=True).start()
+
+
+def current_epoch():
+    return int(time.time() // SLOT_TIMEOUT)
+
+
+def slot_key(scope, epoch):
+    return 'git-transfer-slots:{0}:{1}'.format(scope, epoch)
+
+
+def slot_counts(scope, epoch):
+    """
+    :return: (transfers counted in epoch, in the one before) for scope
+    """
+    counts = cache.get_many([slot_key(scope, epoch), slot_key(scope, epoch - 1)])
+    return counts.get(slot_key(scope, epoch), 0), counts.get(slot_key(scope, epoch - 1), 0)
+
+
+def increment_slot(scope, epoch, delta=1):
+    key = slot_key(scope, epoch)
+    cache.add(key, 0, SLOT_TIMEOUT * 3)
+
+    try:
+        return cache.incr(key, delta)
+    except ValueError:  # Expired in between
+        return None
+
+
+def take_slot(scope, limit, epoch):
+    """
+    Counts one more transfer in scope unless that makes more than limit
+    :return: True if it was counted
+    """
+    current, previous = slot_counts(scope, epoch)
+    if current + previous >= limit:
+        return False
+
+    current = increment_slot(scope, epoch)
+    if current is None or current + previous > limit:  # Someone else was faster
+        if current is not None:
+            give_slot(scope, epoch)
+        return False
+    return True
+
+
+def give_slot(scope, epoch):
+    try:
+        cache.decr(slot_key(scope, epoch))
+    except ValueError:  # Expired, the transfer is not counted anymore anyway
+        pass
+
+
+def move_slot(scope, old_epoch, epoch):
+    # Counted in epoch before old_epoch goes away, so it never drops out of the count
+    increment_slot(scope, epoch)
+    give_slot(scope, old_epoch)
+
+
+def worker_key():
+    return 'git-transfers:{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+def publish_metrics(controller):
+    """
+    Stores the counters of this worker's controller in the cache for transfer_metrics()
+    """
+    key = worker_key()
+    cache.set(key, controller.metrics(), METRICS_INTERVAL * 6)
+
+    workers = cache.get(WORKERS_KEY) or []
+    if key not in workers:
+        cache.set(WORKERS_KEY, [worker for worker in workers if cache.get(worker) is not None] + [key], None)
+
+
+def transfer_metrics():
+    """
+    :return: {worker: metrics} of the workers that published in the last minutes, this one included
+    """
+    publish_metrics(GIT_TRANSFERS)
+    workers = cache.get_many(cache.get(WORKERS_KEY) or [])
+    return dict((key.split(':', 1)[-1], metrics) for key, metrics in workers.items())
+
+
+GIT_TRANSFERS = AdmissionController()
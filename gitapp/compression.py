@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+Compression backends for archive downloads.
+
+``tar.gz`` is compressed pigz style: the tar stream is cut in blocks that are deflated in
+parallel on a shared thread pool (zlib lets go of the GIL while it works) and stitched
+back together in order into one gzip member. Each block is primed with the last 32 KiB
+of the one before it, so the ratio stays close to plain gzip. ``tar.zst`` needs the
+optional zstandard package and uses its own worker threads.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import struct
+import threading
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+THREADS = getattr(settings, 'ARCHIVE_COMPRESSION_THREADS', None) or os.cpu_count() or 1
+BLOCK_SIZE = getattr(settings, 'ARCHIVE_COMPRESSION_BLOCK_SIZE', 128 * 1024)
+WINDOW_SIZE = 32 * 1024  # Deflate's window, how much of the previous block primes the next
+GZIP_HEADER = b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff'  # No mtime, unknown OS
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=THREADS)
+        return _executor
+
+
+def rechunk(chunks, size):
+    """
+    Regroups a stream of chunks into blocks of exactly size bytes, the last one may be shorter
+    """
+    buffer = bytearray()
+
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+
+    if buffer:
+        yield bytes(buffer)
+
+
+def deflate_block(block, dictionary, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY,
+                                  *([dictionary] if dictionary else []))
+    data = compressor.compress(block)
+    return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_blocks(chunks, level):
+    """
+    Parallel gzip of a stream of chunks, see the module docstring
+    """
+    executor = get_executor()
+    pending = deque()
+    crc = size = 0
+    previous = b''
+    blocks = rechunk(chunks, BLOCK_SIZE)
+    block = next(blocks, b'')
+
+    yield GZIP_HEADER
+
+    while True:
+        following = next(blocks, None)
+        last = following is None
+
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        pending.append(executor.submit(deflate_block, block, previous[-WINDOW_SIZE:], level, last))
+        previous = block
+
+        while len(pending) > THREADS * 2 or (last and pending):
+            yield pending.popleft().result()
+
+        if last:
+            break
+        block = following
+
+    yield struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+
+def zstd(chunks, level):
+    compressor = zstandard.ZstdCompressor(level=level, threads=THREADS).compressobj()
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Archive format -> (compressor, highest level), all of them compress a plain tar stream
+COMPRESSORS = {'tar.gz': (gzip_blocks, 9), 'tgz': (gzip_blocks, 9)}
+
+if zstandard is not None:
+    COMPRESSORS['tar.zst'] = (zstd, 19)
+
+
+def clamp_level(archive_format, level):
+    highest = COMPRESSORS[archive_format][1] if archive_format in COMPRESSORS else 9
+    return max(1, min(level, highest))
+
+
+def compress(chunks, archive_format, level):
+    """
+    :param chunks: a plain tar stream, e.g. Repository.archive(sha, 'tar')
+    :param archive_format: a key of COMPRESSORS
+    """
+    compressor = COMPRESSORS[archive_format][0]
+    return compressor(chunks, clamp_level(archive_format, level))
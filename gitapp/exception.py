@@ -3,3 +3,12 @@
 
 class ProjectUserPermissionError(Exception):
     pass
+
+
+class TransferRejected(Exception):
+    """
+    A git transfer was turned away because the server is saturated, retry_after is in seconds
+    """
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
@@ -0,0 +1,221 @@
+# coding: utf-8
+"""
+Content-addressed file cache on local disk.
+
+Entries are written while they are streamed to the first client, published with an
+atomic rename once complete and evicted least recently used first when the cache grows
+past its size limit, which is tracked in the shared cache so the tree is only walked
+then. Only one request fills a given key at a time, everyone else waits up to FILL_WAIT
+seconds for the entry and only goes to the source if it does not show up by then.
+"""
+
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, HttpResponse
+
+from .repository import READ_SIZE
+from .utils import make_path
+
+
+# None serves hits with FileResponse, 'X-Sendfile' or 'X-Accel-Redirect' leave it to the web server
+SENDFILE_HEADER = getattr(settings, 'FILE_CACHE_SENDFILE_HEADER', None)
+# For X-Accel-Redirect: {cache root: internal location} e.g. {COMPRESSION_POINT: '/protected/compress/'}
+SENDFILE_LOCATIONS = getattr(settings, 'FILE_CACHE_SENDFILE_LOCATIONS', {})
+FILL_LOCK_TIMEOUT = getattr(settings, 'FILE_CACHE_FILL_LOCK_TIMEOUT', 60 * 30)
+FILL_WAIT = getattr(settings, 'FILE_CACHE_FILL_WAIT', 60 * 2)
+FILL_POLL_INTERVAL = getattr(settings, 'FILE_CACHE_FILL_POLL_INTERVAL', 0.5)
+TEMP_SUFFIX = '.tmp'
+
+
+class FileCache(object):
+    """
+    :param root: directory the entries live in
+    :param max_size: bytes kept before the least recently used entries are evicted
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+
+    def __repr__(self):
+        return '<FileCache {0}>'.format(self.root)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        :return: the path of the entry or None, a hit counts as a use for eviction
+        """
+        path = self.path(key)
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def wait(self, key, timeout=FILL_WAIT):
+        """
+        Waits up to timeout seconds for the entry of key while someone is filling it
+        :return: the path of the entry, None if it is not being filled or did not show up in time
+        """
+        deadline = time.time() + timeout
+
+        while cache.get(self.__lock_key(key)) is not None and time.time() < deadline:
+            time.sleep(FILL_POLL_INTERVAL)
+        return self.get(key)
+
+    def fill(self, key, chunks, complete=None):
+        """
+        Passes chunks through while writing them to the entry for key. The entry is only
+        published if chunks is read to the end (and complete(), if given, returns True
+        then), and only if no one else is filling it. If someone is, the entry they
+        publish is streamed instead and chunks is closed unread. chunks is closed as well
+        when the caller stops reading early.
+        """
+        filling = self.__fill(key, chunks, complete)
+
+        try:
+            for chunk in filling:
+                yield chunk
+        finally:
+            filling.close()
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def __fill(self, key, chunks, complete):
+        lock = self.__lock_key(key)
+
+        if not cache.add(lock, True, FILL_LOCK_TIMEOUT):
+            entry = self.__open(self.wait(key))
+
+            if entry is None:  # Not there in time, go to the source after all
+                for chunk in chunks:
+                    yield chunk
+                return
+
+            with entry:
+                for chunk in iter(lambda: entry.read(READ_SIZE), b''):
+                    yield chunk
+            return
+
+        path = self.path(key)
+        temp_path = '{0}.{1}{2}'.format(path, uuid.uuid4().hex, TEMP_SUFFIX)
+        published = False
+
+        try:
+            make_path(os.path.dirname(path))
+
+            with open(temp_path, 'wb') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield chunk
+
+            if complete is None or complete():
+                size = os.path.getsize(temp_path)
+                os.rename(temp_path, path)
+                published = True
+        finally:
+            if not published and os.path.exists(temp_path):
+                os.remove(temp_path)
+            cache.delete(lock)
+
+        if published:
+            self.__grow(size)
+
+    def __lock_key(self, key):
+        return 'file-cache-fill:{0}:{1}'.format(self.root, key)
+
+    def __size_key(self):
+        return 'file-cache-size:{0}'.format(self.root)
+
+    def __grow(self, size):
+        # Counts a new entry towards max_size, the tree is only walked once it is exceeded
+        # or when the size is not known (yet)
+        try:
+            total = cache.incr(self.__size_key(), size)
+        except ValueError:
+            total = None
+
+        if total is None or total > self.max_size:
+            self.evict()
+
+    @staticmethod
+    def __open(path):
+        # An entry can be evicted between get and open
+        try:
+            return open(path, 'rb') if path is not None else None
+        except OSError:
+            return None
+
+    def delete_prefix(self, prefix):
+        """
+        Removes every entry whose key starts with prefix (at least 2 characters long)
+        """
+        directory = os.path.dirname(self.path(prefix))
+
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+
+        for name in names:
+            if name.startswith(prefix) and not name.endswith(TEMP_SUFFIX):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    continue
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_size, walks the
+        whole cache and records its size for the fills to come
+        """
+        entries = []
+        size = 0
+
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(TEMP_SUFFIX):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                size += stat.st_size
+
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+        cache.set(self.__size_key(), size, None)
+
+    def serve(self, path, content_type):
+        """
+        Response for a cache hit, offloaded to the web server when FILE_CACHE_SENDFILE_HEADER is set
+        """
+        if SENDFILE_HEADER is None:
+            return FileResponse(open(path, 'rb'), content_type=content_type)
+
+        response = HttpResponse(content_type=content_type)
+
+        if SENDFILE_HEADER == 'X-Accel-Redirect':
+            location = SENDFILE_LOCATIONS.get(self.root, '/')
+            response[SENDFILE_HEADER] = '{0}/{1}'.format(location.rstrip('/'), os.path.relpath(path, self.root))
+        else:
+            response[SENDFILE_HEADER] = path
+        return response
@@ -1,38 +1,70 @@
 """Utility functions to invoke git-http-backend
+
+The smart HTTP protocol can also be served without it: advertise_refs answers
+info/refs from the repo's refs and run_git_service hands pack negotiation
+straight to git upload-pack / receive-pack --stateless-rpc.
 """
 
+import asyncio
+from collections import OrderedDict
+import hashlib
+import os
 import subprocess
 import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .filecache import FileCache
+from .repository import get_repository
 
 
-DEFAULT_CHUNK_SIZE = 0x8000
-DEFAULT_MAX_HEADER_SIZE = 0X20000  # No header should ever be this large.
-# TODO: expose these sizes to API
+# Memory held per request is bounded by these: at most one chunk of the pack in flight each
+# way, plus the CGI header while it is being looked for.
+DEFAULT_CHUNK_SIZE = getattr(settings, 'GIT_HTTP_CHUNK_SIZE', 0x10000)
+DEFAULT_MAX_HEADER_SIZE = getattr(settings, 'GIT_HTTP_MAX_HEADER_SIZE', 0X20000)  # No header should ever be this large.
+GIT_BINARY = getattr(settings, 'GIT_BINARY', 'git')
+GIT_HTTP_BACKEND = [GIT_BINARY, 'http-backend']
 CRLF = b'\r\n'
 HEADER_END = CRLF * 2
+SERVICES = ('git-upload-pack', 'git-receive-pack')
+REF_ADVERTISEMENT_CACHE_SIZE = getattr(settings, 'REF_ADVERTISEMENT_CACHE_SIZE', 256)  # Repos per process
+REF_ADVERTISEMENT_TIMEOUT = getattr(settings, 'REF_ADVERTISEMENT_TIMEOUT', 60 * 60)
+GIT_ADVERTISEMENT_TIMEOUT = getattr(settings, 'GIT_ADVERTISEMENT_TIMEOUT', 5 * 60)
+UPLOAD_PACK_CACHE = FileCache(settings.UPLOAD_PACK_CACHE_POINT, getattr(settings, 'UPLOAD_PACK_CACHE_SIZE', 4 << 30))
+UPLOAD_PACK_CACHE_MAX_REQUEST = 0x40000  # Bigger upload-pack requests are never clones worth caching
+FLUSH_PKT = b'0000'
+ZERO_SHA = '0' * 40
 
 
 def wsgi_to_git_http_backend(wsgi_environ,
                              git_project_root,
-                             user=None):
+                             user=None,
+                             chunk_size=DEFAULT_CHUNK_SIZE,
+                             max_header_size=DEFAULT_MAX_HEADER_SIZE):
     """Convenience wrapper for how a WSGI application can use this
     module to handle a request.
 
     See build_cgi_environ regarding git_project_root and user.
 
     See run_git_http_backend for requirements for wsgi.input
-    and wsgi.errors."""
+    and wsgi.errors, chunk_size and max_header_size."""
     cgi_environ = build_cgi_environ(wsgi_environ, git_project_root, user)
     input_stream = wsgi_environ['wsgi.input']
     error_stream = wsgi_environ['wsgi.errors']
     cgi_header, response_body_generator = run_git_http_backend(
-        cgi_environ, input_stream, error_stream
+        cgi_environ, input_stream, error_stream,
+        chunk_size=chunk_size, max_header_size=max_header_size
     )
     status_line, list_of_headers = parse_cgi_header(cgi_header)
     return status_line, list_of_headers, response_body_generator
 
 
-def run_git_http_backend(cgi_environ, input_stream, error_stream):
+def run_git_http_backend(cgi_environ, input_stream, error_stream,
+                         chunk_size=DEFAULT_CHUNK_SIZE,
+                         max_header_size=DEFAULT_MAX_HEADER_SIZE):
     """Execute "git http-backend" as a CGI script, using the supplied
     environment and the file-like object input_stream.
 
@@ -45,24 +77,28 @@ def run_git_http_backend(cgi_environ, input_stream, error_stream):
     Any stderr generated by the git process will be piped to error_stream,
     which must have a file descriptor.
 
+    Request and response bodies are moved chunk_size bytes at a time and
+    the response body is handed out as soon as git writes it, so memory use
+    does not grow with the size of the pack.
+
     Return (cgi_header, response_body_generator). The cgi_header is the
-    string of raw headers returned by git ending with just one CRLF. The
+    bytes of raw headers returned by git ending with just one CRLF. The
     response sent back to the client will need an additional blank line
     separating this from the response body.
 
     Raise EnvironmentError (errno 1) if a CGI/HTTP header is not returned
-    from git http-backend."""
+    from git http-backend within max_header_size bytes."""
     input_length = int(cgi_environ.get('CONTENT_LENGTH', '') or 0)
     proc = subprocess.Popen(
-        ['/usr/bin/git', 'http-backend'],
-        bufsize=DEFAULT_CHUNK_SIZE,
+        GIT_HTTP_BACKEND,
+        bufsize=chunk_size,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=error_stream,
         env=cgi_environ
     )
     cgi_header, response_body_generator = _communicate_with_git(
-        proc, input_stream, input_length
+        proc, input_stream, input_length, chunk_size, max_header_size
     )
     return cgi_header, response_body_generator
 
@@ -113,12 +149,10 @@ def parse_cgi_header(cgi_header):
     header_dict = {}
     names = []  # to preserve order
 
-    try:
-        cgi_header = cgi_header.decode("utf-8")
-    except AttributeError:
-        pass
+    if isinstance(cgi_header, (bytes, bytearray, memoryview)):
+        cgi_header = bytes(cgi_header).decode('latin-1')  # HTTP headers are latin-1
 
-    raw_lines = cgi_header.split(CRLF.decode("utf-8"))
+    raw_lines = cgi_header.split(CRLF.decode('latin-1'))
     assert raw_lines[-1] == ''
     for raw_line in raw_lines[:-1]:
         name, padded_value = raw_line.strip().split(':', 1)
@@ -131,114 +165,580 @@ def parse_cgi_header(cgi_header):
     return status_line, list_of_headers
 
 
-def _communicate_with_git(proc, input_stream, input_length):
+def _communicate_with_git(proc, input_stream, input_length,
+                          chunk_size=DEFAULT_CHUNK_SIZE,
+                          max_header_size=DEFAULT_MAX_HEADER_SIZE):
     # Given a subprocess.Popen object:
     # * Start writing request data
-    # * Start reading stdout and possibly stderr
-    # * Extract the cgi_header
+    # * Read stdout into one buffer until the end of the cgi_header shows up
     # * Construct a generator for everything that comes after the header
     # * Return (cgi_header, response_body_generator)
     # (The generator is responsible for extracting all data and cleaning up.)
     # Raise EnvironmentError (errno 1) if header is not returned from proc.
     threading.Thread(target=_input_data_pump,
-                     args=(proc, input_stream, input_length)).start()
-    chunks = ['']  # Dummy str at start helps here.
-    header_end = None
-    while not header_end:
-        total_bytes_read = sum(map(len, chunks))
-        if total_bytes_read > DEFAULT_MAX_HEADER_SIZE:
-            raise EnvironmentError(
-                1,
-                'Read %d bytes from "git http-backend" without '
-                'finding header boundary.' % total_bytes_read,
-            )  # TODO: Test this.
-        chuck_data = proc.stdout.read(DEFAULT_CHUNK_SIZE)
-        if not chuck_data:
-            raise EnvironmentError(
-                1,
-                'Did not find header boundary in response '
-                'from "git http-backend".',
-            )  # TODO: Test this.
-        chunks.append(chuck_data)
-        # Search the two most recent chunks for the end of the header.
-        # header_end -> (header_end_on_boundary, index_within_chunk) or None
-        header_end = _find_header_end_in_2_chunks(*chunks[-2:])
-    header_end_on_boundary, index_within_chunk = header_end
-    cgi_header, remainder = _separate_header(
-        chunks, header_end_on_boundary, index_within_chunk
-    )
-    response_body_generator = _response_body_generator(remainder, proc)
+                     args=(proc, input_stream, input_length, chunk_size),
+                     daemon=True).start()
+    try:
+        cgi_header, remainder = _read_header(proc.stdout, chunk_size, max_header_size)
+    except EnvironmentError:
+        _close(proc)
+        raise
+    response_body_generator = _response_body_generator(remainder, proc, chunk_size)
     return cgi_header, response_body_generator
 
 
-def _input_data_pump(proc, input_stream, input_length):
+def _read_header(stream, chunk_size, max_header_size):
+    # Return (header ending with one CRLF, the start of the body).
+    buffer = bytearray()
+    while True:
+        _check_header_size(buffer, max_header_size)
+        chunk_data = stream.read1(chunk_size)
+        header = _add_to_header(buffer, chunk_data)
+        if header is not None:
+            return header
+
+
+def _check_header_size(buffer, max_header_size):
+    if len(buffer) > max_header_size:
+        raise EnvironmentError(
+            1,
+            'Read %d bytes from "git http-backend" without '
+            'finding header boundary.' % len(buffer),
+        )
+
+
+def _add_to_header(buffer, chunk_data):
+    # Appends chunk_data to buffer and returns (header, start of the body)
+    # once HEADER_END is in it. Only the new bytes plus the 3 before them are
+    # searched in case HEADER_END straddles two reads.
+    if not chunk_data:
+        raise EnvironmentError(
+            1,
+            'Did not find header boundary in response '
+            'from "git http-backend".',
+        )
+    start = max(0, len(buffer) - len(HEADER_END) + 1)
+    buffer += chunk_data
+    header_end = buffer.find(HEADER_END, start)
+    if header_end == -1:
+        return None
+    view = memoryview(buffer)
+    return bytes(view[:header_end + len(CRLF)]), bytes(view[header_end + len(HEADER_END):])
+
+
+def pkt_line(data):
+    """Frames data as a pkt-line, data is bytes or str"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return '{0:04x}'.format(len(data) + 4).encode('ascii') + data
+
+
+_advertisements = OrderedDict()  # (git_dir, service, protocol) -> (config stamp, time, advertisement)
+_advertisements_lock = threading.Lock()
+
+
+def _config_stamp(git_dir):
+    # Changes whenever the repo's config is written (git config, uploadpack.*, receive.*)
+    try:
+        stat = os.stat(os.path.join(git_dir, 'config'))
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _git_advertisement(git_dir, service, protocol=None):
+    # What git itself advertises for service, kept per (repo, service,
+    # protocol) until the repo's config changes. Entries older than
+    # GIT_ADVERTISEMENT_TIMEOUT are asked for again, which picks up changes to
+    # the global config and to git itself. Only the capabilities are used for
+    # protocol v0; a v2 advertisement has no refs and is used as is.
+    key = (git_dir, service, protocol)
+    stamp = _config_stamp(git_dir)
+    now = time.time()
+    with _advertisements_lock:
+        entry = _advertisements.get(key)
+        if entry is not None and entry[0] == stamp and now - entry[1] < GIT_ADVERTISEMENT_TIMEOUT:
+            _advertisements.move_to_end(key)
+            return entry[2]
+
+    env = dict(os.environ, GIT_PROTOCOL=protocol) if protocol else None
+    proc = subprocess.Popen(
+        [GIT_BINARY, service[len('git-'):], '--stateless-rpc', '--advertise-refs', git_dir],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env
+    )
+    advertisement = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise EnvironmentError(1, '"git %s --advertise-refs" failed.' % service)
+
+    with _advertisements_lock:
+        _advertisements[key] = (stamp, now, advertisement)
+        _advertisements.move_to_end(key)
+        while len(_advertisements) > REF_ADVERTISEMENT_CACHE_SIZE:
+            _advertisements.popitem(last=False)
+    return advertisement
+
+
+def _capabilities(git_dir, service, symref=None):
+    # The capability list of git's own v0 advertisement with symref=
+    # (the only one that depends on the refs) set to symref or left out
+    advertisement = _git_advertisement(git_dir, service)
+    first_line = advertisement[4:int(advertisement[:4] or b'0', 16)]
+    capabilities = first_line.partition(b'\0')[2].strip().decode('ascii').split()
+    symref = 'symref={0}'.format(symref) if symref else None
+    if symref and not any(capability.startswith('symref=') for capability in capabilities):
+        capabilities.append(symref)
+    return [symref if capability.startswith('symref=') else capability
+            for capability in capabilities if symref or not capability.startswith('symref=')]
+
+
+def advertise_refs(repository, service, protocol=None):
+    """Body of a smart HTTP info/refs response for service, one of SERVICES.
+
+    Refs are read from the repository's ref snapshot (see Repository.refs), so
+    apart from the first advertisement of a repo in this process no git
+    process is started. protocol is the Git-Protocol request header, protocol
+    v2 advertises capabilities only which are served from memory as well."""
+    body = [pkt_line('# service={0}\n'.format(service)), FLUSH_PKT]
+
+    if protocol and 'version=2' in protocol:
+        return b''.join(body) + _git_advertisement(repository.git_dir, service, protocol)
+
+    refs = []
+    symref = None
+
+    if service == 'git-upload-pack':
+        head = repository.head()
+        symbolic_head = repository.symbolic_head()
+        if head is not None:
+            refs.append((head, 'HEAD'))
+            if symbolic_head is not None:
+                symref = 'HEAD:{0}'.format(symbolic_head)
+
+    capabilities = _capabilities(repository.git_dir, service, symref)
+
+    for name, sha in repository.refs().items():
+        refs.append((sha, name))
+        if service == 'git-upload-pack' and name.startswith('refs/tags/') \
+                and repository.object_info(sha)[1] == 'tag':
+            refs.append((repository.rev_parse('{0}^{{}}'.format(sha)), '{0}^{{}}'.format(name)))
+
+    if not refs:
+        refs.append((ZERO_SHA, 'capabilities^{}'))
+
+    for index, (sha, name) in enumerate(refs):
+        if index == 0:
+            body.append(pkt_line('{0} {1}\0{2}\n'.format(sha, name, ' '.join(capabilities))))
+        else:
+            body.append(pkt_line('{0} {1}\n'.format(sha, name)))
+
+    body.append(FLUSH_PKT)
+    return b''.join(body)
+
+
+_ref_advertisements = OrderedDict()  # (git_dir, service, protocol) -> (refs stamp, etag, body)
+_ref_advertisements_lock = threading.Lock()
+
+
+def _ref_advertisement_key(git_dir, service, protocol, stamp):
+    return 'info-refs:{0}:{1}:{2}:{3}'.format(hashlib.sha1(git_dir.encode('utf-8')).hexdigest(),
+                                              service, protocol or '', stamp)
+
+
+def cached_advertise_refs(repository, service, protocol=None):
+    """advertise_refs through a per process cache backed by the django cache.
+    Entries are keyed by Repository.refs_stamp so they go stale as soon as a
+    ref file changes, and invalidate_ref_advertisements drops them outright.
+
+    Return (etag, body)."""
+    key = (repository.git_dir, service, protocol)
+    stamp = repository.refs_stamp()
+
+    with _ref_advertisements_lock:
+        entry = _ref_advertisements.get(key)
+        if entry is not None and entry[0] == stamp:
+            _ref_advertisements.move_to_end(key)
+            return entry[1:]
+
+    cache_key = _ref_advertisement_key(repository.git_dir, service, protocol, stamp)
+    body = cache.get(cache_key)
+
+    if body is None:
+        body = advertise_refs(repository, service, protocol)
+        cache.set(cache_key, body, REF_ADVERTISEMENT_TIMEOUT)
+
+    etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+
+    with _ref_advertisements_lock:
+        _ref_advertisements[key] = (stamp, etag, body)
+        _ref_advertisements.move_to_end(key)
+        while len(_ref_advertisements) > REF_ADVERTISEMENT_CACHE_SIZE:
+            _ref_advertisements.popitem(last=False)
+    return etag, body
+
+
+def invalidate_ref_advertisements(repository):
+    """Drops the cached info/refs responses of repository, e.g. once a push completed."""
+    with _ref_advertisements_lock:
+        entries = [(key, _ref_advertisements.pop(key)) for key in list(_ref_advertisements)
+                   if key[0] == repository.git_dir]
+
+    cache.delete_many([_ref_advertisement_key(*(key + (entry[0],))) for key, entry in entries] +
+                      [_ref_advertisement_key(repository.git_dir, service, None, repository.refs_stamp())
+                       for service in SERVICES])
+
+
+def run_git_service(git_dir, service, wsgi_environ, user=None, chunk_size=DEFAULT_CHUNK_SIZE, status=None):
+    """Runs "git upload-pack|receive-pack --stateless-rpc" for the request in
+    wsgi_environ and returns a generator of the response body, with the same
+    streaming and cleanup as run_git_http_backend. The exit code of git is
+    stored in status['returncode'] once the body has been read to the end."""
+    env = dict(os.environ)
+    if wsgi_environ.get('HTTP_GIT_PROTOCOL'):
+        env['GIT_PROTOCOL'] = wsgi_environ['HTTP_GIT_PROTOCOL']
+    if user:
+        # What git http-backend sets for the reflog of a push
+        env['REMOTE_USER'] = env['GIT_COMMITTER_NAME'] = user
+        env['GIT_COMMITTER_EMAIL'] = '{0}@http.{1}'.format(user, wsgi_environ.get('REMOTE_ADDR', ''))
+
+    content_length = wsgi_environ.get('CONTENT_LENGTH')
+    input_length = int(content_length) if content_length else None
+    decoder = None
+    if wsgi_environ.get('HTTP_CONTENT_ENCODING') in ('gzip', 'x-gzip'):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    proc = subprocess.Popen(
+        [GIT_BINARY, service[len('git-'):], '--stateless-rpc', git_dir],
+        bufsize=chunk_size,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=wsgi_environ['wsgi.errors'],
+        env=env
+    )
+    threading.Thread(target=_input_data_pump,
+                     args=(proc, wsgi_environ['wsgi.input'], input_length, chunk_size, decoder),
+                     daemon=True).start()
+    return _response_body_generator(b'', proc, chunk_size, status)
+
+
+class _PrefixedStream(object):
+    # A file-like object that returns prefix before the rest of stream
+    def __init__(self, prefix, stream=None):
+        self.prefix = memoryview(prefix)
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.prefix:
+            size = len(self.prefix) if size is None or size < 0 else size
+            data, self.prefix = bytes(self.prefix[:size]), self.prefix[size:]
+            return data
+        if self.stream is None:
+            return b''
+        return self.stream.read(size)
+
+
+def _read_request(input_stream, input_length, limit):
+    # Return (up to limit bytes of the request body, True if that is all of it)
+    if input_length is not None and input_length > limit:
+        return b'', False
+    wanted = limit + 1 if input_length is None else input_length
+    data = bytearray()
+    while len(data) < wanted:
+        current_data = input_stream.read(min(DEFAULT_CHUNK_SIZE, wanted - len(data)))
+        if not current_data:
+            break
+        data += current_data
+    return bytes(data), len(data) <= limit
+
+
+def _pkt_lines(data):
+    # The payloads of the pkt-lines in data, flush/delim packets left out
+    index = 0
+    while index < len(data):
+        length = int(data[index:index + 4], 16)
+        if length < 4:
+            index += 4
+            continue
+        yield data[index + 4:index + length]
+        index += length
+
+
+def _upload_pack_prefix(git_dir):
+    return hashlib.sha1(git_dir.encode('utf-8')).hexdigest()[:16]
+
+
+def upload_pack_cache_key(git_dir, body, protocol=None, refs_stamp=''):
+    """Cache key of an upload-pack request, None unless it is a fetch without
+    haves, i.e. a full or shallow clone whose response depends on nothing but
+    the request (wants, shallow/deepen lines, capabilities), the protocol
+    (the Git-Protocol header) and the repo. refs_stamp (Repository.refs_stamp)
+    ties the entry to the refs, so it is not served anymore once they change
+    however that happens, e.g. a push over ssh or a deleted branch."""
+    wants = False
+    try:
+        for line in _pkt_lines(body):
+            if line.startswith(b'have '):
+                return None
+            if line.startswith(b'command=') and line.rstrip(b'\n') != b'command=fetch':
+                return None  # e.g. protocol v2 ls-refs, which depends on the refs
+            wants = wants or line.startswith(b'want ')
+    except ValueError:
+        return None
+    if not wants:
+        return None
+    digest = hashlib.sha1((protocol or '').encode('latin-1') + b'\0' + refs_stamp.encode('utf-8') + b'\0' +
+                          body).hexdigest()
+    return '{0}-{1}'.format(_upload_pack_prefix(git_dir), digest)
+
+
+def run_cached_upload_pack(git_dir, wsgi_environ, user=None, chunk_size=DEFAULT_CHUNK_SIZE, admit=None):
+    """run_git_service for git-upload-pack, with clone responses kept in
+    UPLOAD_PACK_CACHE. Identical clones of a repo are served from disk as long
+    as its refs stay the same, pushes over HTTP also drop the entries of the
+    repo (see invalidate_upload_pack_cache).
+
+    admit, if given, is called before git is started on a miss and returns
+    the callable to call once git is done, e.g. AdmissionController.admit.
+
+    Return (path of the cached response, None) on a hit and (None, response
+    body generator) otherwise."""
+    content_length = wsgi_environ.get('CONTENT_LENGTH')
+    input_length = int(content_length) if content_length else None
+    input_stream = wsgi_environ['wsgi.input']
+    raw, complete = _read_request(input_stream, input_length, UPLOAD_PACK_CACHE_MAX_REQUEST)
+    key = None
+
+    if complete:
+        body = raw
+        try:
+            if wsgi_environ.get('HTTP_CONTENT_ENCODING') in ('gzip', 'x-gzip'):
+                body = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+            key = upload_pack_cache_key(git_dir, body, wsgi_environ.get('HTTP_GIT_PROTOCOL'),
+                                        get_repository(git_dir).refs_stamp())
+        except zlib.error:
+            key = None
+
+    if key is not None:
+        # While the same response is being cached, wait for it rather than run git again
+        path = UPLOAD_PACK_CACHE.get(key) or UPLOAD_PACK_CACHE.wait(key)
+        if path is not None:
+            return path, None
+
+    environ = dict(wsgi_environ)
+    environ['wsgi.input'] = _PrefixedStream(raw, None if complete else input_stream)
+    status = {}
+    release = admit() if admit is not None else None
+    try:
+        response_body_generator = run_git_service(git_dir, 'git-upload-pack', environ, user=user,
+                                                  chunk_size=chunk_size, status=status)
+    except Exception:
+        if release is not None:
+            release()
+        raise
+    if release is not None:
+        response_body_generator = _release_after(response_body_generator, release)
+    if key is not None:
+        response_body_generator = UPLOAD_PACK_CACHE.fill(key, response_body_generator,
+                                                         complete=lambda: status.get('returncode') == 0)
+    return None, response_body_generator
+
+
+def _release_after(response_body_generator, release):
+    # Gives the admission slot back once git has exited or the client went away
+    try:
+        for current_data in response_body_generator:
+            yield current_data
+    finally:
+        response_body_generator.close()
+        release()
+
+
+def invalidate_upload_pack_cache(repository):
+    """Drops the cached upload-pack responses of repository"""
+    UPLOAD_PACK_CACHE.delete_prefix(_upload_pack_prefix(repository.git_dir))
+
+
+def _input_data_pump(proc, input_stream, input_length, chunk_size=DEFAULT_CHUNK_SIZE, decoder=None):
     # Thread for feeding input to git
     # TODO: Currently using threads due to lack of universal standard for
     # async event loops in web applications.
+    # input_length None reads up to EOF (chunked requests), decoder is a
+    # zlib decompressobj for gzip encoded request bodies.
     bytes_read = 0
-    while bytes_read < input_length:
-        bytes_to_read = min(DEFAULT_CHUNK_SIZE, input_length - bytes_read)
-        current_data = input_stream.read(bytes_to_read)
-        bytes_read += len(current_data)
-        proc.stdin.write(current_data)
-    proc.stdin.close()
-
-
-def _find_header_end_in_2_chunks(chunk0, chunk1):
-    # Search for the 4-byte HEADER_END in either the end of the first chunk
-    # (with the 4-byte boundary stretching into the second chunk) or within
-    # the second chunk starting at 0.
-    # Return as (header_end_on_boundary, index_within_chunk).
-    # Return None if header end not found.
-    boundary_string = chunk0[-3:] + chunk1[:3].decode("utf-8")
-    header_end = _search_str_for_header_end(boundary_string)
-    if header_end != -1:
-        return True, len(chunk0) - 3 + header_end
-    header_end = _search_str_for_header_end(chunk1)
-    if header_end != -1:
-        return False, header_end
-    return None
-
-
-def _search_str_for_header_end(data_str):
-    """Return index of header end or -1."""
     try:
-        data_str = data_str.find(HEADER_END)
-        return data_str
-    except TypeError:
-        return -1
-
-
-def _separate_header(chunks, header_end_on_boundary, index_within_chunk):
-    # Return header, remainder
-    if header_end_on_boundary:
-        # Header ends within chunks[-2]
-        header_chunks = chunks[:-2]
-        last_header_chunk = chunks[-2]
-        body_start_index = (4 - (len(last_header_chunk) - index_within_chunk))
-    else:
-        # Header ends within chunks[-1]
-        header_chunks = chunks[:-1]
-        last_header_chunk = chunks[-1]
-        body_start_index = index_within_chunk + 4
-    header_chunks.append(last_header_chunk[:index_within_chunk])
-    header_chunks.append(CRLF)  # Line end might have been split.
-    for index, header in enumerate(header_chunks):
-        if type(header) != str:
-            header_chunks[index] = header.decode("utf-8")
-    header = ''.join(header_chunks)
-    remainder = chunks[-1][body_start_index:]
-    return header, remainder
-
-
-def _response_body_generator(remainder, proc):
+        while input_length is None or bytes_read < input_length:
+            bytes_to_read = chunk_size if input_length is None else min(chunk_size, input_length - bytes_read)
+            current_data = input_stream.read(bytes_to_read)
+            if not current_data:
+                break  # Client went away or the chunked body ended
+            bytes_read += len(current_data)
+            if decoder is not None:
+                current_data = decoder.decompress(current_data)
+            proc.stdin.write(current_data)
+        if decoder is not None:
+            proc.stdin.write(decoder.flush())
+    except (BrokenPipeError, ValueError, zlib.error):
+        pass  # git exited (or was killed) before taking all of the request
+    finally:
+        try:
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+
+def _response_body_generator(remainder, proc, chunk_size=DEFAULT_CHUNK_SIZE, status=None):
     # The generator returned up the stack to the WSGI application.
-    # Yields chunks of data from the subprocess output.
-    yield remainder
-    current_data = proc.stdout.read(DEFAULT_CHUNK_SIZE)
-    while current_data:
-        yield current_data
-        current_data = proc.stdout.read(DEFAULT_CHUNK_SIZE)
-    # TODO: Do we need this?
-    while proc.poll() is None:
-        yield ''
+    # Yields chunks of data from the subprocess output as soon as git
+    # writes them, git is killed if the client stops reading early.
+    finished = False
+    try:
+        if remainder:
+            yield remainder
+        for current_data in iter(lambda: proc.stdout.read1(chunk_size), b''):
+            yield current_data
+        finished = True
+    finally:
+        _close(proc, kill=not finished)
+        if status is not None:
+            status['returncode'] = proc.returncode
+
+
+def _close(proc, kill=True):
+    if kill and proc.poll() is None:
+        proc.kill()
+    proc.stdout.close()
+    proc.wait()
+
+
+# ASGI
+# The same bridge on an asyncio event loop: no thread per request, the request
+# body is only read from the client as fast as git takes it and git is killed
+# as soon as the client disconnects.
+
+async def asgi_to_git_http_backend(scope, receive,
+                                   git_project_root,
+                                   user=None,
+                                   chunk_size=DEFAULT_CHUNK_SIZE,
+                                   max_header_size=DEFAULT_MAX_HEADER_SIZE):
+    """ASGI counterpart of wsgi_to_git_http_backend.
+
+    scope and receive are those of an ASGI http connection, the request
+    body is read from receive.
+
+    Return (status_line, list_of_headers, response_body_generator) where
+    the generator is an async one. Raise EnvironmentError (errno 1) if a
+    CGI/HTTP header is not returned from git http-backend."""
+    cgi_environ = build_cgi_environ(scope_to_environ(scope), git_project_root, user)
+    proc = await asyncio.create_subprocess_exec(
+        *GIT_HTTP_BACKEND,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        env=cgi_environ,
+        limit=chunk_size
+    )
+    pump = asyncio.ensure_future(_async_input_data_pump(proc, receive))
+
+    try:
+        buffer = bytearray()
+        header = None
+        while header is None:
+            _check_header_size(buffer, max_header_size)
+            header = _add_to_header(buffer, await proc.stdout.read(chunk_size))
+    except BaseException:
+        await _async_close(proc, pump)
+        raise
+
+    cgi_header, remainder = header
+    status_line, list_of_headers = parse_cgi_header(cgi_header)
+    response_body_generator = _async_response_body_generator(remainder, proc, pump, chunk_size)
+    return status_line, list_of_headers, response_body_generator
+
+
+async def serve_asgi(scope, receive, send, git_project_root, user=None):
+    """Answers an ASGI http request with git http-backend, authentication
+    and routing are left to the caller."""
+    status_line, list_of_headers, response_body_generator = \
+        await asgi_to_git_http_backend(scope, receive, git_project_root, user=user)
+
+    await send({
+        'type': 'http.response.start',
+        'status': int(status_line[:3]),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in list_of_headers],
+    })
+    async for chunk in response_body_generator:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def scope_to_environ(scope):
+    """The parts of a WSGI environ build_cgi_environ needs, from an ASGI scope"""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'][len(scope.get('root_path', '')):],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version', '1.1')),
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = value.decode('latin-1')
+    return environ
+
+
+async def _async_input_data_pump(proc, receive):
+    # Feeds the request body to git, waiting for git to take each message
+    # before asking the client for the next one. Afterwards keeps listening
+    # for the client to disconnect so git can be stopped.
+    try:
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            proc.stdin.write(message.get('body', b''))
+            await proc.stdin.drain()
+            more_body = message.get('more_body', False)
+        proc.stdin.close()
+
+        if not more_body:
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+    except (BrokenPipeError, ConnectionResetError):
+        proc.stdin.close()
+        return
+    _async_kill(proc)
+
+
+async def _async_response_body_generator(remainder, proc, pump, chunk_size=DEFAULT_CHUNK_SIZE):
+    finished = False
+    try:
+        if remainder:
+            yield remainder
+        while True:
+            current_data = await proc.stdout.read(chunk_size)
+            if not current_data:
+                break
+            yield current_data
+        finished = True
+    finally:
+        await _async_close(proc, pump, kill=not finished)
+
+
+async def _async_close(proc, pump, kill=True):
+    pump.cancel()
+    if kill:
+        _async_kill(proc)
+    await proc.wait()
+
+
+def _async_kill(proc):
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass  # Exited since returncode was last updated
@@ -0,0 +1,126 @@
+# coding: utf-8
+"""
+Syntax highlighting with the rendered HTML cached.
+
+Highlighted code only depends on the source, the lexer and the formatter options, so
+fragments are kept under the blob sha (or a hash of the source when there is none):
+in a small per-process LRU first, then in the shared cache. Lexers and formatters are
+built once per process.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django_pygments import utils as django_pygments
+from pygments import highlight
+from pygments.formatters.html import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+
+
+MEMORY_CACHE_SIZE = getattr(settings, 'HIGHLIGHT_MEMORY_CACHE_SIZE', 32 << 20)  # Bytes of HTML per process
+CACHE_TIMEOUT = getattr(settings, 'HIGHLIGHT_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+DEFAULT_LANGUAGE = 'text'
+
+
+class ListHtmlFormatter(django_pygments.ListHtmlFormatter):
+    """
+    What {% pygment %} renders, an ordered list of lines, numbered from linenostart
+    """
+    def _wrap_list(self, source):
+        for i, t in super()._wrap_list(source):
+            if t == '<ol>' and self.linenostart != 1:
+                t = '<ol start="{0}">'.format(self.linenostart)
+            yield i, t
+
+
+FORMATTERS = {'html': HtmlFormatter, 'list': ListHtmlFormatter}
+
+_fragments = OrderedDict()  # key -> html
+_fragments_size = 0
+_fragments_lock = threading.Lock()
+_lexers = {}
+_formatters = {}
+
+
+def get_lexer(language, strip=True):
+    """
+    Shared lexer for language, plain text if pygments does not know it.
+    strip=False keeps leading and trailing blank lines, e.g. for a window of a file.
+    """
+    lexer = _lexers.get((language, strip))
+
+    if lexer is None:
+        options = {'stripall': True} if strip else {'stripnl': False}
+        try:
+            lexer = get_lexer_by_name(language, **options)
+        except ClassNotFound:
+            lexer = get_lexer_by_name(DEFAULT_LANGUAGE, **options)
+        _lexers[(language, strip)] = lexer
+    return lexer
+
+
+def get_formatter(formatter='list', **options):
+    key = (formatter, tuple(sorted(options.items())))
+    instance = _formatters.get(key)
+
+    if instance is None:
+        instance = _formatters[key] = FORMATTERS[formatter](**options)
+    return instance
+
+
+def fragment_key(sha, language, strip, formatter, options):
+    options = hashlib.sha1(repr((strip, formatter, sorted(options.items()))).encode('utf-8')).hexdigest()[:12]
+    return 'highlight:{0}:{1}:{2}'.format(sha, get_lexer(language).aliases[0], options)
+
+
+def highlight_code(code, language, sha=None, strip=True, formatter='list', **options):
+    """
+    :param code: source text
+    :param language: pygments lexer name, e.g. from get_language_via_ext
+    :param sha: blob sha of code, pass it when code is the blob as is
+    :param strip: see get_lexer
+    :param formatter: a key of FORMATTERS, options are passed to it
+    :return: the highlighted HTML
+    """
+    if sha is None:
+        sha = hashlib.sha1(code.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    key = fragment_key(sha, language, strip, formatter, options)
+    html = get_fragment(key)
+
+    if html is None:
+        html = cache.get(key)
+
+        if html is None:
+            html = highlight(code, get_lexer(language, strip), get_formatter(formatter, **options))
+            cache.set(key, html, CACHE_TIMEOUT)
+        set_fragment(key, html)
+    return html
+
+
+def get_fragment(key):
+    with _fragments_lock:
+        html = _fragments.get(key)
+        if html is not None:
+            _fragments.move_to_end(key)
+        return html
+
+
+def set_fragment(key, html):
+    global _fragments_size
+
+    if len(html) > MEMORY_CACHE_SIZE:
+        return
+
+    with _fragments_lock:
+        previous = _fragments.pop(key, None)
+        _fragments_size -= len(previous) if previous is not None else 0
+        _fragments[key] = html
+        _fragments_size += len(html)
+
+        while _fragments_size > MEMORY_CACHE_SIZE:
+            _fragments_size -= len(_fragments.popitem(last=False)[1])
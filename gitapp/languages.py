@@ -0,0 +1,156 @@
+# coding: utf-8
+"""
+Per-project language statistics.
+
+The index is a JSON file in the project's media dir. Blobs are classified once and kept
+under their sha (plus extension, since the extension decides the type as much as the
+content), so moving the index to a new tip only reads the blobs that changed between
+the indexed tip and the new one.
+"""
+
+from collections import OrderedDict
+import json
+import os
+
+from .utils import detect_blob_type, filename_normalizer
+
+
+MEASURES = ('files', 'lines', 'bytes')
+EXCLUDE_FILES = ('.gitignore',)
+REBUILD_RATIO = 2  # Rebuild once the index holds this many blobs per file of the tip
+
+
+def blob_key(path, sha):
+    return sha + os.path.splitext(path)[-1].lower()
+
+
+class LanguageIndex(object):
+    """
+    File, line and byte counts per file type for the tree of one tip.
+    """
+
+    def __init__(self, repository, path):
+        self.repository = repository
+        self.path = path
+        self.tip = None
+        self.blobs = {}  # blob key -> [file type, lines, bytes]
+        self.totals = {}  # file type -> [files, lines, bytes]
+        self.chart = None  # Percentages the chart image was last drawn from
+        self.load()
+
+    def __repr__(self):
+        return '<LanguageIndex {0} at {1}>'.format(self.path, self.tip)
+
+    def load(self):
+        try:
+            with open(self.path) as index_file:
+                data = json.load(index_file)
+        except (IOError, OSError, ValueError):
+            return
+
+        self.tip = data.get('tip')
+        self.blobs = data.get('blobs', {})
+        self.totals = data.get('totals', {})
+        self.chart = data.get('chart')
+
+    def save(self):
+        temp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+
+        with open(temp_path, 'w') as index_file:
+            json.dump({'tip': self.tip, 'blobs': self.blobs,
+                       'totals': self.totals, 'chart': self.chart}, index_file)
+        os.rename(temp_path, self.path)
+
+    def update(self, rev='HEAD'):
+        """
+        Moves the index to rev.
+        :return: True if the counts were recomputed
+        """
+        tip = self.repository.rev_parse(rev)
+
+        if tip == self.tip:
+            return False
+
+        if tip is None:
+            self.blobs, self.totals = {}, {}
+        elif (self.tip is None or self.repository.rev_parse(self.tip) is None or
+              len(self.blobs) > REBUILD_RATIO * max(self.files, 1)):
+            self.__rebuild(tip)
+        else:
+            try:
+                self.__apply(self.repository.diff_blobs(self.tip, tip))
+            except KeyError:  # A blob of the old tip is missing, the file was not written by us
+                self.__rebuild(tip)
+
+        self.tip = tip
+        self.save()
+        return True
+
+    @property
+    def files(self):
+        return sum(counts[0] for counts in self.totals.values())
+
+    def percentages(self, measure='files'):
+        """
+        :param measure: one of MEASURES
+        :return: OrderedDict of file type -> percentage, sorted by file type
+        """
+        column = MEASURES.index(measure)
+        amounts = {}
+
+        for file_type, counts in self.totals.items():
+            file_type = filename_normalizer(file_type)
+            amounts[file_type] = amounts.get(file_type, 0) + counts[column]
+
+        total = sum(amounts.values())
+        if not total:
+            return OrderedDict()
+
+        return OrderedDict((file_type, float('{0:.0f}'.format(float(amount) / total * 100)))
+                           for file_type, amount in sorted(amounts.items()))
+
+    def __rebuild(self, tip):
+        blobs = {}
+        self.totals = {}
+
+        for path, sha in self.repository.list_blobs(tip):
+            if os.path.basename(path) in EXCLUDE_FILES:
+                continue
+
+            key = blob_key(path, sha)
+            blobs[key] = self.blobs.get(key) or blobs.get(key) or self.__classify(path, sha)
+            self.__count(blobs[key], 1)
+        self.blobs = blobs
+
+    def __apply(self, changes):
+        for path, old, new in changes:
+            if os.path.basename(path) in EXCLUDE_FILES:
+                continue
+
+            if old is not None:
+                self.__count(self.blobs[blob_key(path, old)], -1)
+
+            if new is not None:
+                key = blob_key(path, new)
+                if key not in self.blobs:
+                    self.blobs[key] = self.__classify(path, new)
+                self.__count(self.blobs[key], 1)
+
+        self.totals = dict((file_type, counts) for file_type, counts in self.totals.items() if counts[0] > 0)
+
+    def __classify(self, path, sha):
+        data = self.repository.read_object(sha)[2]
+        lines = 0
+
+        if b'\0' not in data[:8000]:
+            lines = data.count(b'\n')
+            if data and not data.endswith(b'\n'):
+                lines += 1
+        return [detect_blob_type(path, data), lines, len(data)]
+
+    def __count(self, blob, sign):
+        file_type, lines, size = blob
+        counts = self.totals.setdefault(file_type, [0, 0, 0])
+        counts[0] += sign
+        counts[1] += sign * lines
+        counts[2] += sign * size
@@ -0,0 +1,134 @@
+# coding: utf-8
+"""
+Housekeeping for the hosted bare repos.
+
+A repo gets a light pass (pack loose objects, refresh the multi-pack-index and its
+bitmap, extend the commit-graph) when loose objects, packs or pushes pile up, and a full
+one (everything in one pack with a bitmap, a fresh commit-graph, prune) when the packs
+themselves get out of hand. Runs are queued by Celery, see gitapp.tasks.
+"""
+
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .repository import GitError
+
+
+LOOSE_OBJECTS_LIMIT = getattr(settings, 'MAINTENANCE_LOOSE_OBJECTS', 500)
+PACKS_LIMIT = getattr(settings, 'MAINTENANCE_PACKS', 8)  # Light pass above this many packs
+FULL_REPACK_PACKS = getattr(settings, 'MAINTENANCE_FULL_REPACK_PACKS', 32)  # Full pass above this many
+PUSHES_LIMIT = getattr(settings, 'MAINTENANCE_PUSHES', 50)
+LOCK_TIMEOUT = getattr(settings, 'MAINTENANCE_LOCK_TIMEOUT', 60 * 60)
+PRUNE_EXPIRE = getattr(settings, 'MAINTENANCE_PRUNE_EXPIRE', '2.weeks.ago')
+
+LIGHT, FULL = 'light', 'full'
+
+logger = logging.getLogger(__name__)
+
+
+def object_counts(repository):
+    """
+    ``git count-objects -v`` as a dict of ints e.g. {'count': 34, 'packs': 1, ...}
+    """
+    counts = {}
+
+    for line in repository.run('count-objects', '-v').decode('utf-8').splitlines():
+        name, _, value = line.partition(':')
+        try:
+            counts[name.strip()] = int(value)
+        except ValueError:
+            continue
+    return counts
+
+
+def has_file(repository, *path):
+    return os.path.exists(os.path.join(repository.git_dir, 'objects', *path))
+
+
+def pushes_key(repository):
+    return 'maintenance-pushes:{0}'.format(repository.git_dir)
+
+
+def record_push(repository):
+    """
+    Counts a push towards PUSHES_LIMIT
+    """
+    key = pushes_key(repository)
+
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def needed_maintenance(repository):
+    """
+    :return: FULL, LIGHT or None
+    """
+    counts = object_counts(repository)
+    packs = counts.get('packs', 0)
+
+    # Not counts['garbage']: repack leaves those files alone, so every run would be a full one
+    if packs > FULL_REPACK_PACKS:
+        return FULL
+
+    if (counts.get('count', 0) > LOOSE_OBJECTS_LIMIT or packs > PACKS_LIMIT or
+            (cache.get(pushes_key(repository)) or 0) >= PUSHES_LIMIT):
+        return LIGHT
+
+    if packs and not has_file(repository, 'info', 'commit-graph') and \
+            not has_file(repository, 'info', 'commit-graphs', 'commit-graph-chain'):
+        return LIGHT
+    return None
+
+
+def run_step(repository, *args):
+    """
+    Runs one git command of a maintenance pass
+    :raise GitError: if it fails, the later steps are not run then
+    """
+    process = repository.popen(*args)
+    error = process.communicate()[1]
+
+    if process.returncode:
+        message = 'git {0} failed in {1} ({2}): {3}'.format(
+            ' '.join(args), repository.git_dir, process.returncode, error.decode('utf-8', 'replace').strip())
+        logger.error(message)
+        raise GitError(message)
+
+
+def maintain(repository, level=None):
+    """
+    Runs the maintenance repository needs, or level (LIGHT or FULL) regardless of the heuristics.
+    At most one run per repo at a time. The push count is only reset once every step succeeded.
+    :return: the level that ran or None
+    :raise GitError: if a step failed
+    """
+    level = level or needed_maintenance(repository)
+    lock = 'maintenance-lock:{0}'.format(repository.git_dir)
+
+    if level is None or not cache.add(lock, True, LOCK_TIMEOUT):
+        return None
+
+    try:
+        if level == FULL:
+            # Like git gc --cruft: unreachable objects, e.g. those of a push still in flight, go to
+            # a cruft pack rather than away, until they are older than PRUNE_EXPIRE
+            run_step(repository, 'repack', '--cruft', '--cruft-expiration={0}'.format(PRUNE_EXPIRE),
+                     '-d', '-l', '--write-bitmap-index')  # Also drops the multi-pack-index
+            run_step(repository, 'commit-graph', 'write', '--reachable', '--changed-paths')
+            run_step(repository, 'prune', '--expire={0}'.format(PRUNE_EXPIRE))
+        else:
+            run_step(repository, 'repack', '-d', '-l')
+            run_step(repository, 'multi-pack-index', 'write', '--bitmap')
+            run_step(repository, 'commit-graph', 'write', '--reachable', '--split', '--changed-paths')
+
+        run_step(repository, 'pack-refs', '--all')
+        cache.delete(pushes_key(repository))
+    finally:
+        cache.delete(lock)
+    return level
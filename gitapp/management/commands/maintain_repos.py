@@ -0,0 +1,27 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+
+from ...maintenance import maintain, needed_maintenance, FULL, LIGHT
+from ...models import Project
+
+
+class Command(BaseCommand):
+    help = " Repacks (with bitmaps), writes commit-graphs and prunes the hosted bare repos. "
+
+    def add_arguments(self, parser):
+        parser.add_argument('--level', choices=(LIGHT, FULL), default=FULL,
+                            help='Maintenance to run on every repo, default full.')
+        parser.add_argument('--needed', action='store_true',
+                            help='Only touch repos the heuristics say need it, at the level they pick.')
+
+    def handle(self, *args, **options):
+        for project in Project.objects.select_related('repo__owner').iterator():
+            repository = project.repository
+
+            if not repository.exists():
+                continue
+
+            level = needed_maintenance(repository) if options['needed'] else options['level']
+            result = maintain(repository, level=level) if level else None
+            self.stdout.write('{0}: {1}'.format(project, result or 'skipped'))
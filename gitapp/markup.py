@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Markdown rendering with the HTML cached under a revision of the source, the blob sha of
+a README or the last update of a wiki. A new revision gets a new key, so entries are
+never invalidated, they expire after MARKDOWN_CACHE_TIMEOUT.
+"""
+
+import hashlib
+from html import unescape
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+import markdown
+from markdown.treeprocessors import Treeprocessor
+
+from .utils import markdown_2_html
+
+
+CACHE_TIMEOUT = getattr(settings, 'MARKDOWN_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+SAFE_SCHEMES = ('', 'http', 'https', 'mailto', 'ftp')
+
+
+def link_scheme(value):
+    """
+    The scheme a browser would see in a link, after decoding entities and dropping the
+    whitespace and control characters it ignores, e.g. 'javascript' for 'Java&#x09;Script:'
+    """
+    value = unescape(unescape(value))  # The attribute may come out of markdown entity encoded twice
+    value = ''.join(char for char in value if char > ' ' and char != '\x7f')
+    return urlsplit(value).scheme.lower()
+
+
+class SafeLinks(Treeprocessor):
+    """
+    Drops href and src attributes with a scheme other than SAFE_SCHEMES, e.g. javascript:
+    """
+    def run(self, root):
+        for element in root.iter():
+            for attribute in ('href', 'src'):
+                value = element.get(attribute)
+                if value is not None and link_scheme(value) not in SAFE_SCHEMES:
+                    del element.attrib[attribute]
+
+
+def safe_markdown_2_html(markdown_text):
+    """
+    markdown_2_html for text written on the site: raw HTML is escaped and unsafe links dropped
+    """
+    converter = markdown.Markdown()
+    converter.preprocessors.deregister('html_block')
+    converter.inlinePatterns.deregister('html')
+    converter.treeprocessors.register(SafeLinks(converter), 'safe_links', 0)
+    return mark_safe(converter.convert(markdown_text))
+
+
+def render_markdown(text, key=None, safe=False):
+    """
+    :param text: the markdown, or a callable returning it that is only called on a miss
+    :param key: revision of text e.g. a blob sha, a hash of text by default
+    :param safe: render with safe_markdown_2_html instead of markdown_2_html
+    :return: the HTML
+    """
+    if key is None:
+        text = text() if callable(text) else text
+        key = hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+    cache_key = 'markdown:{0}:{1}'.format('safe' if safe else 'raw', key)
+    html = cache.get(cache_key)
+
+    if html is None:
+        text = text() if callable(text) else text
+        html = str((safe_markdown_2_html if safe else markdown_2_html)(text))
+        cache.set(cache_key, html, CACHE_TIMEOUT)
+    return mark_safe(html)
@@ -1,6 +1,7 @@
 # coding: utf-8
 
-from collections import OrderedDict
+import itertools
+import logging
 import os
 import hashlib
 from subprocess import Popen, PIPE
@@ -8,6 +9,7 @@ from subprocess import Popen, PIPE
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.humanize.templatetags.humanize import naturaltime
+from django.core.cache import cache
 from django.db import models
 from django.template.defaultfilters import slugify
 from django.urls import reverse
@@ -16,6 +18,7 @@ from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.functional import cached_property
 from django.utils.html import mark_safe, format_html
+from django.utils.http import urlencode
 
 from autoslug import AutoSlugField
 from polymorphic.models import PolymorphicModel
@@ -23,10 +26,18 @@ from polymorphic.showfields import ShowFieldTypeAndContent
 
 from gitapp.utils import detect_file_type
 from .exception import ProjectUserPermissionError
-from .utils import (make_path, cd, return_files_in_dir, filename_normalizer, normalize_link,
-                    get_date_from_git, CommitParser)
+from .languages import LanguageIndex
+from .markup import render_markdown
+from .repository import get_repository, GitError, ObjectNotFound, READ_SIZE
+from .utils import make_path, cd, return_files_in_dir, normalize_link
 
 
+BROWSE_BARE_REPO = getattr(settings, 'BROWSE_BARE_REPO', True)
+TRANSIT_LOCK_TIMEOUT = getattr(settings, 'TRANSIT_LOCK_TIMEOUT', 60 * 10)
+LANGUAGE_STATS_MEASURE = getattr(settings, 'LANGUAGE_STATS_MEASURE', 'files')
+
+logger = logging.getLogger(__name__)
+
 can_clone, can_create_branch, can_delete_branch, can_pull, can_push = range(5)
 
 PERMISSIONS = (
@@ -38,61 +49,120 @@ PERMISSIONS = (
                )
 
 
-class Commit(object):
+def run_git(*args, check=True):
     """
-    An object that represents a commit.
+    Runs git in the current directory and returns its stdout
+    :param check: raise GitError, after logging git's stderr, if it fails
     """
-    def __init__(self, commit=None, author=None, date=None, message=None, merge=None):
-        self.commit = commit.split()[1]
-        authors = list(filter(None, author.split()))
-        self.author = ' '.join(authors[1:-1])  # Solve multiple names
-        self.email = authors[-1]
-        self.date = get_date_from_git(' '.join(date.split()[2:]))
-        self.message = message.strip()
-        self.email = self.email.replace('<', '').replace('>', '')
-
-        if merge:
-            self.merge = ' '.join(merge.split()[1:])
-        else:
-            self.merge = merge
+    process = Popen(['git'] + list(args), stdout=PIPE, stderr=PIPE)
+    output, error = process.communicate()
 
-    def __str__(self):
-        return self.title
+    if check and process.returncode:
+        message = 'git {0} failed in {1} ({2}): {3}'.format(
+            ' '.join(args), os.getcwd(), process.returncode, error.decode('utf-8', 'replace').strip())
+        logger.error(message)
+        raise GitError(message)
+    return output
+
+
+class CommitSequence(object):
+    """
+    A lazy view of the history reachable from one commit. Slicing asks git for just that
+    window (--skip/--max-count), so it can be handed to Django's Paginator.
+    """
+    def __init__(self, repository, tip):
+        self.repository = repository
+        self.tip = tip
 
     def __repr__(self):
-        return '<<Commit:{0}>>'.format(self.title)
+        return '<<CommitSequence:{0}>>'.format(self.tip)
 
-    class Meta:
-        static = {'commit': {}, 'author': {},
-                  'email': {}, 'date': {}, 'message': {}}
+    def count(self):
+        return self.repository.count_commits(self.tip)
 
-    @cached_property
-    def title(self):
-        title = self.message.split('\n')[0]
-        return title.title()
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            commits = self[index:index + 1]
+            if not commits:
+                raise IndexError(index)
+            return commits[0]
+
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        return self.window(skip=start, max_count=stop - start)
+
+    def window(self, skip=0, max_count=None, tip=None):
+        tip = tip or self.tip
+
+        if not tip or (max_count is not None and max_count <= 0):
+            return []
+
+        command = ['--skip={0}'.format(skip)]
+
+        if max_count is not None:
+            command.append('--max-count={0}'.format(max_count))
+        command.append(tip)
+        return list(self.repository.iter_commits(*command))
+
+
+class KeysetPage(object):
+    """
+    A page of commits that starts right after a given commit of the history of tip. The
+    cursor pins tip, so pages stay consistent while the branch moves, and the position
+    of that commit, so git skips straight to it.
+    """
+    number = None
+    paginator = None
+
+    def __init__(self, commits, per_page, tip=None, offset=0):
+        """
+        :param commits: up to per_page + 1 commits, the extra one only tells there is a next page
+        :param tip: sha the history is walked from
+        :param offset: position of commits[0] in the history of tip
+        """
+        self.object_list = commits[:per_page]
+        self.tip = tip
+        self.offset = offset
+        self.__has_next = len(commits) > per_page
 
-    def get_author(self):
-        return self.Meta.static.get('author')
+    def __iter__(self):
+        return iter(self.object_list)
 
-    def get_commit(self):
-        return self.Meta.static.get('commit')
+    def __len__(self):
+        return len(self.object_list)
 
-    def get_date(self):
-        return self.Meta.static.get('date')
+    def has_next(self):
+        return self.__has_next
 
-    def get_email(self):
-        return self.Meta.static.get('email')
+    def has_previous(self):
+        return False
 
-    def get_message(self):
-        return self.Meta.static.get('message')
+    @property
+    def next_before(self):
+        if self.__has_next:
+            return self.object_list[-1].commit
+        return None
+
+    @property
+    def next_query(self):
+        """
+        Query string of the next page, without the leading ?
+        """
+        if not self.__has_next:
+            return None
+        return urlencode({'before': self.next_before, 'tip': self.tip,
+                          'skip': self.offset + len(self.object_list) - 1})
 
 
 class CommitFactory(object):
     """
-    Consumes stdout and returns commit objects
+    Pages through a CommitSequence or sorts any other stream of commit objects
     """
     def __init__(self, commits):
-        self.__commit_parser = CommitParser(commits)
+        self.__commits = commits
 
     def __str__(self):
         return None
@@ -105,16 +175,23 @@ class CommitFactory(object):
         """
         :return:
         """
-        sorted_commit = sorted(self.__commit_parser(), key=lambda x: x.date, reverse=True)
+        sorted_commit = sorted(self.__commits, key=lambda x: x.date, reverse=True)
         return sorted_commit
 
-    def get_commits_page(self, page):
+    def get_commits_page(self, page, before=None, tip=None, skip=None):
         """
-        Always use this method for performance reasons
+        Always use this method for performance reasons, only the requested page is read
+        from git. Passing before (a commit sha) switches to keyset pagination: the page
+        holds the commits after before in the history of tip (the sequence's by default),
+        skip is the position of before there if known, see KeysetPage.next_query.
         """
         from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-        sorted_commit = sorted(self.__commit_parser(), key=lambda x: x.date, reverse=True)
-        paginator = Paginator(sorted_commit, settings.NUMPERPAGE or 50)
+        per_page = settings.NUMPERPAGE or 50
+
+        if before is not None:
+            return self.__keyset_page(before, tip or self.__commits.tip, skip, per_page)
+
+        paginator = Paginator(self.__commits, per_page)
 
         try:
             commits = paginator.page(page)
@@ -125,6 +202,23 @@ class CommitFactory(object):
             # If page is out of range (e.g. 9999), deliver last page of results.
         return commits
 
+    def __keyset_page(self, before, tip, skip, per_page):
+        # Walking from before itself would miss the side branches of merges later in
+        # the history of tip, so the history of tip is walked up to before instead
+        if skip is not None:
+            commits = self.__commits.window(skip=skip, max_count=per_page + 2, tip=tip)
+            if commits and commits[0].commit == before:
+                return KeysetPage(commits[1:], per_page, tip=tip, offset=skip + 1)
+
+        # No or a stale position, look for before from the tip
+        commits = self.__commits.repository.iter_commits(tip)
+        for position, commit in enumerate(commits):
+            if commit.commit == before:
+                page = list(itertools.islice(commits, per_page + 1))
+                commits.close()
+                return KeysetPage(page, per_page, tip=tip, offset=position + 1)
+        return KeysetPage([], per_page, tip=tip)
+
 
 class Key(PolymorphicModel, ShowFieldTypeAndContent):
     title = models.CharField(_('Name'), max_length=150, blank=False, null=False)
@@ -219,6 +313,7 @@ class Star(models.Model):
         if not self.pk:
             self.total = 1
         super().save(*args, **kwargs)
+        self.project.touch_pages()
 
 
 class RepoFile(object):
@@ -229,22 +324,23 @@ class RepoFile(object):
         self.cwd = kwargs.get('cwd')
         self.wrap_folder, self.file = kwargs.get('file_n_folder')
         self.project = kwargs.get('project')
+        self.commit = kwargs.get('commit')
 
     def file_last_modified(self):
-        with cd(self.cwd):
-            try:
+        if self.commit is not None:
+            return naturaltime(self.commit.date)
+
+        try:
+            with cd(self.cwd):
                 modified_time = os.path.getmtime(self.file)
                 return naturaltime(timezone.datetime.fromtimestamp(modified_time))
-            except OSError:
-                return
+        except OSError:
+            return
 
     def last_commit(self):
-        with cd(self.cwd):
-            command = 'git log -n 1 -- {0}'.format(self.file).split(' ')
-            process = Popen(command, stdout=PIPE, stderr=PIPE)
-            results = process.communicate()[0].decode("utf-8")
-            results = list(filter(None, results.split('\n')))
-            return results[-1].strip()[:60]
+        if self.commit is None:
+            return ''
+        return self.commit.message.strip().split('\n')[0][:60]
 
     def detect_file_type(self):
         return detect_file_type(self.file)
@@ -303,6 +399,19 @@ class Wiki(models.Model):
             self.date_created = now
         self.date_updated = now
         super().save(*args, **kwargs)
+        self.project.touch_pages()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.project.touch_pages()
+        return result
+
+    def rendered_text(self):
+        """
+        The text rendered from markdown, once per update
+        """
+        return render_markdown(self.text, key='wiki-{0}-{1}'.format(self.pk, self.date_updated.timestamp()),
+                               safe=True)
 
 
 class Project(models.Model):
@@ -381,21 +490,26 @@ class Project(models.Model):
         except AttributeError:
             return False
 
+    @cached_property
+    def repository(self):
+        """
+        The pooled access layer for this project's bare repo, see gitapp.repository
+        """
+        return get_repository(self.full_path())
+
     def log(self, n=None, **kwargs):
+        """
+        Streams Commit objects, kwargs are passed to git log as option/value pairs
+        """
+        command = []
+
         if n is not None:
-            result = 'git,log,-n {0}'.format(n)
-        else:
-            result = 'git,log'
+            command.append('-n{0}'.format(n))
 
         for key, value in kwargs.items():
             if key and value:
-                result = '{0},{1},{2}'.format(result, key, value)
-        command = result.split(',')
-
-        with cd(self.working_dir):
-            process = Popen(command, stdout=PIPE, stderr=PIPE)
-            results = process.communicate()
-            return results[0]
+                command.extend([key, value])
+        return self.repository.iter_commits(*command)
 
     def last_commit_object_on_file(self, filename):
         """
@@ -403,41 +517,68 @@ class Project(models.Model):
         :param filename:
         :return:
         """
-        from gitapp.utils import solve_commit
-        command = ['git', 'log', '-n 1', '--', filename]
-
-        with cd(self.working_dir):
-            try:
-                process = Popen(command, stdout=PIPE, stderr=PIPE)
-                results = process.communicate()
-                results = results[0].decode("utf-8")
-                results = [result for result in filter(None, results.split('\n'))]
-                return solve_commit(results)
-            except IndexError:
-                pass
+        return next(self.repository.iter_commits('-n1', '--', filename), None)
 
     def commits(self):
         return self.log()
 
+    def commit_history(self, branch=None):
+        """
+        Returns a lazy CommitSequence for branch (HEAD by default)
+        """
+        rev = 'HEAD' if branch is None else 'refs/heads/{0}'.format(branch)
+        return CommitSequence(self.repository, self.repository.rev_parse(rev))
+
+    def get_stats(self, refresh=False):
+        """
+        Commit count and branches, cached against the current ref tips so they are only
+        recomputed once a push moves a ref.
+        """
+        key = 'project-stats:{0}:{1}'.format(self.pk, self.repository.ref_fingerprint())
+        stats = None if refresh else cache.get(key)
+
+        if stats is None:
+            stats = {'commits': self.repository.count_commits(self.repository.head()),
+                     'branches': self.repository.branches() or ['master']}
+            cache.set(key, stats)
+        return stats
+
     def get_branches(self):
-        command = ['git', 'branch', '--all']
+        return list(self.get_stats()['branches'])
 
-        with cd(self.working_dir):
-            process = Popen(command, stdout=PIPE, stderr=PIPE)
-            results = process.communicate()
-            results = results[0].decode("utf-8")
-
-            try:
-                results = list(filter(None, [result.strip() for result in results.split('\n')]))
-                results = [name.split('/')[-1] for name in results]
-                results = [name for name in results if not name.startswith('*')]
-                results = list(set(results))
-            except (AttributeError, IndexError):
-                pass
-
-            if not results:
-                results = ['master']
-        return results
+    def last_commits(self, path='', ref=None):
+        """
+        Last commit touching each entry of the directory path on ref (HEAD by default)
+        :return: {entry name: Commit}
+        """
+        try:
+            return self.repository.last_commits(ref or 'HEAD', path)
+        except ObjectNotFound:
+            return {}
+
+    def refs_updated(self, old_refs=None):
+        """
+        Called by GitView once a push has completed, refreshes everything keyed on refs.
+        :param old_refs: Repository.refs() from before the push
+        """
+        from .gitHttpBackend import invalidate_ref_advertisements, invalidate_upload_pack_cache
+        from .maintenance import record_push
+        from .tasks import update_language_stats
+
+        invalidate_ref_advertisements(self.repository)
+        invalidate_upload_pack_cache(self.repository)
+        record_push(self.repository)
+        self.get_stats(refresh=True)
+
+        new_refs = self.repository.refs()
+        old_refs = old_refs or {}
+        changed = sorted(name for name in set(old_refs) | set(new_refs)
+                         if old_refs.get(name) != new_refs.get(name))
+
+        if changed:
+            if not BROWSE_BARE_REPO or os.path.exists(self.working_dir):
+                self.refresh_transit(refs=changed)  # Pages are read from the bare repo, only sync a clone in use
+            update_language_stats.delay(self.id)
 
     def get_current_branch_url(self):
         url = reverse('commits', args=(self.repo.name, self.name, self.current_branch()))
@@ -452,12 +593,8 @@ class Project(models.Model):
         return branches
 
     def current_branch(self):
-        branch = [i.replace('* ', '') for i in self.get_branches() if i.startswith('*')]
-        if type(branch) == list:
-            if branch:
-                return branch[0]
-            branch = 'master'
-        return branch
+        branch = (self.repository.symbolic_head() or '').split('refs/heads/')[-1]
+        return branch or 'master'
 
     @cached_property
     def owner(self):
@@ -501,16 +638,7 @@ class Project(models.Model):
         Counts number of commits
         :return:
         """
-        command = ['git', 'rev-list', '--count', 'HEAD']
-        with cd(self.working_dir):
-            process = Popen(command, stdout=PIPE, stderr=PIPE)
-            result = process.communicate()[0]
-
-            try:
-                result = int(result)
-            except ValueError:
-                result = 0
-            return result
+        return self.get_stats()['commits']
 
     @cached_property
     def number_of_contributors(self):
@@ -528,16 +656,18 @@ class Project(models.Model):
         return result
 
     def status(self):
-        with cd(self.working_dir):
-            command = ['git', 'log', '-1']
-            process = Popen(command, stdout=PIPE, stderr=PIPE)
-            result = process.communicate()
-            result = result[0].decode("utf-8")
+        """
+        Returns the title of the last commit on HEAD
+        """
+        try:
+            message = self.repository.read_commit('HEAD')[2]
+        except ObjectNotFound:
+            return ''
 
-            try:
-                return result.splitlines()[-1].strip()
-            except IndexError:
-                return result
+        try:
+            return message.strip().splitlines()[0].strip()
+        except IndexError:
+            return message
 
     @cached_property
     def get_transit_path(self):
@@ -587,40 +717,133 @@ class Project(models.Model):
             result = result.communicate()
             del result
 
-    def update_transit(self):
-        transit_point = os.path.join(self.get_transit_path, str(self.name))
+    @cached_property
+    def transit_lock_key(self):
+        return 'transit-lock:{0}'.format(self.pk)
 
-        if os.path.exists(transit_point):
-            command = ['git', 'pull', '--all']
+    def transit_is_warming(self):
+        return cache.get(self.transit_lock_key) is not None
 
-        else:
-            command = ['git', 'clone', self.full_path()]
+    @cached_property
+    def pages_key(self):
+        return 'project-pages:{0}'.format(self.pk)
 
-        with cd(self.get_transit_path):
-            result = Popen(command, stdout=PIPE, stderr=PIPE)
-            return result.communicate()[0]
+    def touch_pages(self):
+        """
+        Changes pages_fingerprint for what shows on the project's pages but is neither in its
+        refs nor in its row, e.g. stars and the wiki
+        """
+        try:
+            cache.incr(self.pages_key)
+        except ValueError:
+            cache.set(self.pages_key, 1, None)
 
-    def compress_project(self, compression='tar.gz', return_path=False, return_compressed_dir=False):
-        project_name = self.file_name.replace('.git', '')
-        compressed_dir = '{0}.{1}'.format(project_name, compression)
+    def pages_fingerprint(self, working_dir=False):
+        """
+        A digest of what the project's pages are made from besides the request: its refs (and
+        the transit clone when pages are read from it), its row, contributors and touch_pages
+        :param working_dir: the page is read from the transit clone even with BROWSE_BARE_REPO
+        """
+        parts = [self.pk, self.date_updated.isoformat(), self.is_private, self.downloads, self.clones,
+                 cache.get(self.pages_key, 0), self.repository.refs_stamp(),
+                 list(self.contributors.order_by('pk').values_list('pk', flat=True))]
 
-        if return_compressed_dir:
-            return '{0}.{1}'.format(project_name, compression)
+        if working_dir or not BROWSE_BARE_REPO:
+            parts.append(cache.get(self.transit_synced_key))
+        return hashlib.sha1('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
 
-        repo_2_compress = os.path.join(self.get_transit_path, project_name)
+    @cached_property
+    def transit_synced_key(self):
+        return 'transit-synced:{0}'.format(self.pk)
 
-        if compression.startswith('tar'):
-            command = ['tar', 'cvzf', compressed_dir, repo_2_compress]
-        else:
-            command = ['zip', '-r', compressed_dir, repo_2_compress]
+    def transit_is_stale(self):
+        """
+        True if refs moved in the bare repo since the transit clone was last synced
+        """
+        return cache.get(self.transit_synced_key) != self.repository.ref_fingerprint()
 
-        with cd(self.get_compression_path):
-            result = Popen(command, stdout=PIPE, stderr=PIPE)
-            result = result.communicate()[0]
-            del result
+    def refresh_transit(self, refs=None):
+        """
+        Queues a background refresh of the transit clone unless a clone or sync of this
+        project is already queued or running.
+        :param refs: only fetch these ref names, everything when None
+        :return: True if this call queued it
+        """
+        from .tasks import update_transit
 
-            if return_path:
-                return os.path.join(os.getcwd(), compressed_dir)
+        if not cache.add(self.transit_lock_key, True, TRANSIT_LOCK_TIMEOUT):
+            return False
+
+        try:
+            update_transit.delay(self.id, locked=True, refs=refs)
+        except Exception:
+            cache.delete(self.transit_lock_key)
+            raise
+        return True
+
+    def update_transit(self, locked=False, refs=None):
+        """
+        Clones the transit copy or brings it up to date with the bare repo, at most one at a
+        time per project. Refs moved while this ran trigger another refresh.
+        :param locked: the caller already holds transit_lock_key (see refresh_transit)
+        :param refs: only fetch these ref names, everything when None
+        """
+        if not locked and not cache.add(self.transit_lock_key, True, TRANSIT_LOCK_TIMEOUT):
+            return None  # Someone else is cloning or syncing right now
+
+        fingerprint = self.repository.ref_fingerprint()
+
+        try:
+            if os.path.exists(self.working_dir):
+                result = self.__sync_working_dir(refs)
+            else:
+                with cd(self.get_transit_path):
+                    result = run_git('clone', self.full_path())
+            # Only once every step succeeded, the ETags of the pages read from the clone carry it
+            cache.set(self.transit_synced_key, fingerprint, None)
+        except GitError:
+            return None  # Logged by run_git, the next push or reconcile_transits tries again
+        finally:
+            cache.delete(self.transit_lock_key)
+
+        if self.repository.ref_fingerprint() != fingerprint:
+            self.refresh_transit()
+        return result
+
+    def __sync_working_dir(self, refs=None):
+        """
+        Fetches refs (all when None) from the bare repo and moves the checked out branch.
+        """
+        git = run_git
+
+        with cd(self.working_dir):
+            if refs is None:
+                result = git('fetch', '--prune', '--tags', 'origin')
+            else:
+                current = self.repository.refs()
+                refspecs = []
+
+                for ref in refs:
+                    if ref.startswith('refs/heads/'):
+                        local_ref = 'refs/remotes/origin/{0}'.format(ref[len('refs/heads/'):])
+                    elif ref.startswith('refs/tags/'):
+                        local_ref = ref
+                    else:
+                        continue
+
+                    if ref in current:
+                        refspecs.append('+{0}:{1}'.format(ref, local_ref))
+                    else:
+                        git('update-ref', '-d', local_ref)
+
+                result = git('fetch', 'origin', *refspecs) if refspecs else b''
+
+            # Exits with 1 on a detached HEAD
+            branch = git('symbolic-ref', '--short', '-q', 'HEAD', check=False).decode('utf-8').strip()
+
+            if branch and (refs is None or 'refs/heads/{0}'.format(branch) in refs):
+                git('reset', '-q', '--hard', 'origin/{0}'.format(branch))
+        return result
 
     @cached_property
     def file_name(self):
@@ -668,7 +891,138 @@ class Project(models.Model):
             modified_time = os.path.getmtime(filename)
             return timezone.datetime.fromtimestamp(modified_time)
 
-    def wrapped_list_folder(self):
+    def source_url(self, path='', ref=None):
+        """
+        Url of path in the source browser, the project page for the root
+        """
+        url = '/{0}/{1}'.format(self.repo.name, self.working_dir_name)
+        path = path.strip('/')
+
+        if path:
+            url = '{0}/{1}/{2}'.format(url, settings.SOURCE, path)
+
+        if ref:
+            url = '{0}?{1}'.format(url, urlencode({'ref': ref}))
+        return url
+
+    def wrap_entry(self, name, path, is_dir, ref=None, icon='black'):
+        icon_type = 'folder-close' if is_dir else 'file'
+        return format_html('<i class="icon-{0} icon-{1}"></i> <a href=\'{2}\'>{3} </a>',
+                           icon_type, icon, self.source_url(path, ref=ref), name), name
+
+    def path_type(self, path, ref=None):
+        """
+        Returns 'tree', 'blob' or None if path does not exist at ref
+        """
+        path = path.strip('/')
+
+        if not BROWSE_BARE_REPO:
+            full_path = os.path.join(self.working_dir, path)
+
+            if os.path.isdir(full_path):
+                return 'tree'
+            return 'blob' if os.path.isfile(full_path) else None
+
+        try:
+            return self.repository.object_info('{0}:{1}'.format(ref or 'HEAD', path))[1]
+        except ObjectNotFound:
+            return None
+
+    def read_blob(self, path, ref=None):
+        """
+        Returns the content of the file at path as bytes
+        """
+        path = path.strip('/')
+
+        if not BROWSE_BARE_REPO:
+            with open(os.path.join(self.working_dir, path), 'rb') as blob:
+                return blob.read()
+        return self.repository.read_object('{0}:{1}'.format(ref or 'HEAD', path))[2]
+
+    def blob_sha(self, path, ref=None):
+        """
+        Returns the sha of the file at path, None when files are read from the working dir
+        """
+        if not BROWSE_BARE_REPO:
+            return None
+        return self.repository.rev_parse('{0}:{1}'.format(ref or 'HEAD', path.strip('/')))
+
+    def blob_size(self, path, ref=None):
+        """
+        Returns the size in bytes of the file at path
+        """
+        path = path.strip('/')
+
+        if not BROWSE_BARE_REPO:
+            return os.path.getsize(os.path.join(self.working_dir, path))
+        return self.repository.object_info('{0}:{1}'.format(ref or 'HEAD', path))[2]
+
+    def blob_info(self, path, ref=None):
+        """
+        Returns (sha, size) of the file at path in one lookup, sha is None when files are read
+        from the working dir
+        :raise ObjectNotFound: if path is not a file at ref
+        """
+        path = path.strip('/')
+
+        if not BROWSE_BARE_REPO:
+            if not os.path.isfile(os.path.join(self.working_dir, path)):
+                raise ObjectNotFound(path)
+            return None, self.blob_size(path)
+
+        sha, object_type, size = self.repository.object_info('{0}:{1}'.format(ref or 'HEAD', path))
+        if object_type != 'blob':
+            raise ObjectNotFound(path)
+        return sha, size
+
+    def stream_blob(self, path, ref=None, start=0, stop=None, sha=None):
+        """
+        Yields the content of the file at path, from byte start to stop (exclusive), in chunks
+        :param sha: the blob sha of path at ref when already known, e.g. from blob_info
+        """
+        path = path.strip('/')
+
+        if BROWSE_BARE_REPO:
+            sha = sha or self.blob_sha(path, ref=ref)
+            if sha is None:
+                raise ObjectNotFound(path)
+            return self.repository.stream_blob(sha, start, stop)
+        return self.__stream_working_file(os.path.join(self.working_dir, path), start, stop)
+
+    @staticmethod
+    def __stream_working_file(full_path, start, stop):
+        with open(full_path, 'rb') as blob:
+            blob.seek(start)
+            remaining = (stop if stop is not None else os.path.getsize(full_path)) - start
+
+            for chunk in iter(lambda: blob.read(min(READ_SIZE, remaining)), b''):
+                remaining -= len(chunk)
+                yield chunk
+
+    def wrapped_list_folder(self, path='', ref=None):
+        """
+        Wrapped entries of the directory path, the directory itself comes first
+        """
+        path = path.strip('/')
+
+        if not BROWSE_BARE_REPO:
+            if path:
+                return self.wrapped_given_folder_list(os.path.join(self.working_dir, path))
+            return self.__wrapped_working_dir()
+
+        try:
+            entries = self.repository.ls_tree(ref or 'HEAD', path)[1]
+        except ObjectNotFound:
+            entries = []
+
+        name = path.split('/')[-1] if path else self.working_dir_name
+        current_files = [self.wrap_entry(name, path, True, ref=ref)]
+        current_files.extend(self.wrap_entry(entry.name, '/'.join(filter(None, (path, entry.name))),
+                                             entry.is_dir(), ref=ref)
+                             for entry in entries)
+        return current_files
+
+    def __wrapped_working_dir(self):
         working_dir = self.working_dir
         root_folder = working_dir.split('/')[-1]
         root_dir = '/'.join(working_dir.split('/')[:-1])
@@ -692,12 +1046,16 @@ class Project(models.Model):
             [current_files.append(self.wrap_folder(i)) for i in os.listdir('.') if i != '.git']
             return current_files
 
+    @cached_property
+    def working_dir_name(self):
+        return self.file_name.split('.git')[0]
+
     @cached_property
     def working_dir(self):
         """
         Returns the current working dir of project
         """
-        filename = self.file_name.split('.git')[0]
+        filename = self.working_dir_name
         transit_path = self.get_transit_path
         full_path = os.path.join(transit_path, filename)
         return full_path
@@ -719,9 +1077,13 @@ class Project(models.Model):
         """
         return detect_file_type(filename)
 
-    def list_all_in_repo(self):
-        with cd(self.working_dir):
-            return return_files_in_dir('.', exclude_dir=('.git',), exclude_file=['.gitignore'])
+    def list_all_in_repo(self, ref=None):
+        if not BROWSE_BARE_REPO:
+            with cd(self.working_dir):
+                return return_files_in_dir('.', exclude_dir=('.git',), exclude_file=['.gitignore'])
+
+        return [path for path in self.repository.list_files(ref or 'HEAD')
+                if os.path.basename(path) != '.gitignore']
 
     def __all_files(self):
         with cd(self.working_dir):
@@ -732,74 +1094,76 @@ class Project(models.Model):
         return files
 
     def get_readme_file(self):
-        from .utils import get_code_n_count, markdown_2_html
+        """
+        Returns the README of HEAD rendered to HTML or False, rendered once per blob sha
+        """
+        from .utils import get_blob_code_n_count, get_code_n_count
 
-        with cd(self.working_dir):
-            try:
-                readme_file = [i for i in os.listdir(os.getcwd()) if i.lower().startswith('readme')][0]
-                markdown_text = get_code_n_count(readme_file)[0]
-                html = markdown_2_html(markdown_text)
-            except IndexError:
-                return False
-        return html
-
-    def file_percentage(self):
-        def percentage(number_of_files, file_count):
-            result = (float(number_of_files) / float(file_count)) * 100
-            return float("{0:.0f}".format(result))
-
-        file_type_n_count_dict = {}
-        percentage_of_files = {}  # List all file type and percentages
-
-        def set_file_type_n_count(percentage_dict, file_name):
-            """
-            Count the number of files and its types and return it as a dict.
-            :param percentage_dict:
-            :param file_name:
-            :return:
-            """
-            file_type = self.detect_file_type(file_name)
-            count_list = percentage_dict.get(file_type, [])
-            count_list.append(file_name)
-            percentage_dict[file_type] = count_list
-
-        [set_file_type_n_count(file_type_n_count_dict, filename) for filename in self.list_all_in_repo()]
-
-        all_files = []
-        [all_files.extend(a_file) for a_file in file_type_n_count_dict.values()]
-        total_files = len(all_files)
-
-        for key, value in file_type_n_count_dict.items():
-            percentage_of_files[filename_normalizer(key)] = percentage(len(value), total_files)
-
-        percentage_of_files = OrderedDict(sorted(percentage_of_files.items(), key=lambda t: t[0]))
-        return percentage_of_files
-
-    def __create_repo_chart(self, show=False):
-        from .statistics import create_chart, display_graph
-        labels = []
-        size = []
+        if not BROWSE_BARE_REPO:
+            with cd(self.working_dir):
+                try:
+                    readme_file = [i for i in os.listdir(os.getcwd()) if i.lower().startswith('readme')][0]
+                except IndexError:
+                    return False
+                return render_markdown(get_code_n_count(readme_file)[0])
+
+        try:
+            entries = self.repository.ls_tree('HEAD')[1]
+        except ObjectNotFound:
+            return False
+
+        readme = next((entry for entry in entries
+                       if entry.name.lower().startswith('readme') and not entry.is_dir()), None)
+        if readme is None:
+            return False
+        return render_markdown(lambda: get_blob_code_n_count(self.repository.read_object(readme.sha)[2])[0],
+                               key=readme.sha)
+
+    @cached_property
+    def media_name(self):
+        return self.file_name.split('.')[0]
+
+    def language_index(self, update=True):
+        """
+        The language stats index of HEAD, see LanguageIndex
+        :param update: bring it up to HEAD first, only reclassifies blobs that changed
+        """
+        index = LanguageIndex(self.repository,
+                              os.path.join(self.get_repo_media, '{0}.languages.json'.format(self.media_name)))
+        if update:
+            index.update('HEAD')
+        return index
+
+    def file_percentage(self, measure=LANGUAGE_STATS_MEASURE):
+        """
+        Share of each file type in HEAD
+        :param measure: 'files', 'lines' or 'bytes'
+        """
+        return self.language_index().percentages(measure)
 
-        for lang, percent in self.file_percentage().items():
-            labels.append(lang)
-            size.append(percent)
+    def __create_repo_chart(self, percentages, show=False):
+        from .statistics import create_chart, display_graph
 
-        chart = create_chart(labels=labels, sizes=size, colors=None, explode=None)
+        create_chart(labels=list(percentages.keys()), sizes=list(percentages.values()), colors=None, explode=None)
         path = self.get_repo_media
 
         with cd(path):
-            image_path = '{0}.jpeg'.format(self.file_name.split('.')[0])
+            image_path = '{0}.jpeg'.format(self.media_name)
         return display_graph(show=show, path=image_path)
 
     def get_percentage_media_file(self, show=False):
+        """
+        URL of the language chart, redrawn only when the percentages it shows changed
+        """
         path = self.get_repo_media
-
-        with cd(path):
-            image_path = '{0}.jpeg'.format(self.file_name.split('.')[0])
-            image_full_path = os.path.join(path, image_path)
-
-            if not os.path.exists(image_full_path):
-                self.__create_repo_chart(show=show)
+        image_full_path = os.path.join(path, '{0}.jpeg'.format(self.media_name))
+        index = self.language_index()
+        percentages = index.percentages(LANGUAGE_STATS_MEASURE)
+
+        if not os.path.exists(image_full_path) or index.chart != percentages:
+            self.__create_repo_chart(percentages, show=show)
+            index.chart = percentages
+            index.save()
         return '/media/{0}'.format('/'.join((image_full_path.split('/')[-2:])))
 
     def save(self, *args, **kwargs):
@@ -0,0 +1,660 @@
+# coding: utf-8
+"""
+Repository access layer.
+
+Every read against a bare repo goes through a :class:`Repository`. Object lookups are
+answered by one long-lived ``git cat-file --batch`` (and ``--batch-check``) process per
+repo and refs are read straight from ``packed-refs`` and ``refs/``, so most queries never
+fork. Repositories are pooled per process, see :func:`get_repository`.
+"""
+
+from collections import OrderedDict
+import atexit
+import datetime
+import hashlib
+import os
+from subprocess import Popen, PIPE, DEVNULL
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+GIT_BINARY = getattr(settings, 'GIT_BINARY', 'git')
+POOL_SIZE = getattr(settings, 'GIT_REPOSITORY_POOL_SIZE', 64)
+READ_SIZE = 0x10000
+STREAM_BLOB_SIZE = 0x100000  # Bigger blobs are streamed by a git process of their own
+
+# One record per commit, fields split by US (0x1f) and records terminated by NUL (-z).
+# The body goes last so a stray separator inside a message can not shift the fields.
+LOG_FIELDS = ('%H', '%P', '%an', '%ae', '%at', '%B')
+LOG_FORMAT = '--format={0}'.format('%x1f'.join(LOG_FIELDS))
+FIELD_SEPARATOR = b'\x1f'
+RECORD_SEPARATOR = b'\x00'
+RECORD_MARKER = b'\x1e'  # Tells commit records from file names in --name-only output
+
+
+class GitError(Exception):
+    pass
+
+
+class ObjectNotFound(GitError):
+    pass
+
+
+class Commit(object):
+    """
+    A commit as read from ``git log -z``. Kept small, a page view can hold thousands.
+    """
+    __slots__ = ('commit', 'parents', 'author', 'email', 'date', 'message')
+
+    def __init__(self, commit, parents, author, email, date, message):
+        self.commit = commit
+        self.parents = parents
+        self.author = author
+        self.email = email
+        self.date = date
+        self.message = message
+
+    def __str__(self):
+        return self.title
+
+    def __repr__(self):
+        return '<<Commit:{0}>>'.format(self.title)
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Builds a commit from one raw ``LOG_FORMAT`` record.
+        """
+        commit, parents, author, email, timestamp, message = \
+            record.decode('utf-8', 'replace').split(FIELD_SEPARATOR.decode(), len(LOG_FIELDS) - 1)
+        date = datetime.datetime.fromtimestamp(int(timestamp), tz=datetime.timezone.utc)
+        return cls(commit, tuple(parents.split()), author, email, date, message.strip())
+
+    @property
+    def title(self):
+        title = self.message.split('\n')[0]
+        return title.title()
+
+    @property
+    def merge(self):
+        """
+        Abbreviated parents of a merge commit or None.
+        """
+        if len(self.parents) > 1:
+            return ' '.join(parent[:7] for parent in self.parents)
+        return None
+
+
+def parse_commits(stream):
+    """
+    Yields Commit objects from a file like object producing ``LOG_FORMAT`` records,
+    reading it in chunks so that history is never held in memory all at once.
+    """
+    remainder = b''
+
+    while True:
+        chunk = stream.read(READ_SIZE)
+
+        if not chunk:
+            break
+
+        records = (remainder + chunk).split(RECORD_SEPARATOR)
+        remainder = records.pop()
+
+        for record in records:
+            record = record.lstrip(b'\n')
+            if record:
+                yield Commit.from_record(record)
+
+    if remainder.strip():
+        yield Commit.from_record(remainder.lstrip(b'\n'))
+
+
+class TreeEntry(object):
+    """
+    One entry of a tree object.
+    """
+    __slots__ = ('mode', 'type', 'sha', 'name')
+
+    def __init__(self, mode, object_type, sha, name):
+        self.mode = mode
+        self.type = object_type
+        self.sha = sha
+        self.name = name
+
+    def __repr__(self):
+        return '<<TreeEntry:{0}>>'.format(self.name)
+
+    def is_dir(self):
+        return self.type == 'tree'
+
+
+def parse_tree(data):
+    """
+    Parses a raw tree object (``<mode> <name>\\0<20 byte sha>`` repeated) into TreeEntry
+    objects.
+    """
+    entries = []
+    position = 0
+
+    while position < len(data):
+        space = data.index(b' ', position)
+        nul = data.index(b'\x00', space)
+        mode = data[position:space].decode('ascii')
+        name = data[space + 1:nul].decode('utf-8', 'replace')
+        sha = data[nul + 1:nul + 21].hex()
+        position = nul + 21
+
+        if mode == '40000':
+            object_type = 'tree'
+        elif mode == '160000':
+            object_type = 'commit'
+        else:
+            object_type = 'blob'
+        entries.append(TreeEntry(mode, object_type, sha, name))
+    return entries
+
+
+class CatFile(object):
+    """
+    A persistent ``git cat-file --batch`` or ``--batch-check`` process.
+    The process is started lazily and restarted if it dies.
+    """
+    def __init__(self, git_dir, check=False):
+        self.git_dir = git_dir
+        self.check = check
+        self.process = None
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return '<<CatFile:{0}>>'.format(self.git_dir)
+
+    def start(self):
+        option = '--batch-check' if self.check else '--batch'
+        command = [GIT_BINARY, '--git-dir', self.git_dir, 'cat-file', option]
+        # stderr is never read, warnings like ambiguous refnames would fill a pipe and block git
+        self.process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+
+    def query(self, rev):
+        """
+        Looks up a single object.
+        :param rev: anything ``git rev-parse`` understands e.g ``HEAD:README.md``
+        :return: (sha, type, size, data) data is None for batch-check
+        """
+        if isinstance(rev, bytes):
+            rev = rev.decode('utf-8')
+
+        if not rev or '\n' in rev:
+            raise ObjectNotFound(rev)
+
+        with self.lock:
+            try:
+                return self.__query(rev)
+            except (BrokenPipeError, ValueError, OSError):
+                # The process died under us (repo removed, git killed), start over once.
+                self.close()
+                return self.__query(rev)
+
+    def __query(self, rev):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+
+        self.process.stdin.write('{0}\n'.format(rev).encode('utf-8'))
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+
+        if not header:
+            raise ValueError('cat-file exited')
+
+        header = header.decode('utf-8').rstrip('\n').split()
+
+        if header[-1] in ('missing', 'ambiguous'):
+            raise ObjectNotFound(rev)
+
+        sha, object_type, size = header[0], header[1], int(header[2])
+        data = None
+
+        if not self.check:
+            data = self.process.stdout.read(size)
+            self.process.stdout.read(1)  # Trailing LF
+        return sha, object_type, size, data
+
+    def close(self):
+        with self.lock:
+            if self.process is None:
+                return
+
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+            self.process = None
+
+
+class Repository(object):
+    """
+    A bare git repository. Cheap queries are served from the cat-file processes or the
+    ref files, everything else falls back to :meth:`run`.
+    """
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.__batch = CatFile(git_dir)
+        self.__batch_check = CatFile(git_dir, check=True)
+
+    def __str__(self):
+        return self.git_dir
+
+    def __repr__(self):
+        return '<<Repository:{0}>>'.format(self.git_dir)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.git_dir, 'HEAD'))
+
+    def popen(self, *args, **kwargs):
+        command = [GIT_BINARY, '--git-dir', self.git_dir] + list(args)
+        kwargs.setdefault('stdout', PIPE)
+        kwargs.setdefault('stderr', PIPE)
+        return Popen(command, **kwargs)
+
+    def run(self, *args):
+        """
+        Runs a git command against this repo and returns stdout as bytes.
+        """
+        process = self.popen(*args)
+        return process.communicate()[0]
+
+    def iter_commits(self, *args):
+        """
+        Streams Commit objects from ``git log -z``, args are passed on to git log.
+        The git process is killed if the caller stops iterating early.
+        """
+        process = self.popen('log', '-z', LOG_FORMAT, *args)
+
+        try:
+            for commit in parse_commits(process.stdout):
+                yield commit
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.communicate()
+
+    def archive(self, sha, archive_format='tar.gz', prefix='', level=None, status=None):
+        """
+        Streams ``git archive`` of a tree-ish in READ_SIZE chunks, the git process is
+        killed if the caller stops reading early.
+        :param sha: object name of a commit, tag or tree, never a user supplied ref
+        :param archive_format: any format git archive knows, e.g. tar, tar.gz or zip
+        :param prefix: directory the files are placed under, e.g. 'project/'
+        :param level: compression level 0-9, ignored for plain tar
+        :param status: a dict that gets git's exit code as 'returncode' once it is over
+        """
+        args = ['archive', '--format={0}'.format(archive_format), '--prefix={0}'.format(prefix)]
+
+        if level is not None and archive_format != 'tar':
+            args.append('-{0:d}'.format(level))
+
+        process = self.popen(*(args + [sha]), stderr=DEVNULL)
+
+        try:
+            for chunk in iter(lambda: process.stdout.read(READ_SIZE), b''):
+                yield chunk
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.communicate()
+
+            if status is not None:
+                status['returncode'] = process.returncode
+
+    def stream_blob(self, sha, start=0, stop=None):
+        """
+        Streams bytes start to stop (exclusive) of a blob in READ_SIZE chunks. Blobs up to
+        STREAM_BLOB_SIZE come from the cat-file process, bigger ones from their own
+        ``git cat-file blob`` which is killed if the caller stops reading early.
+        :param sha: object name of the blob, never a user supplied ref
+        """
+        size = self.object_info(sha)[2]
+        stop = size if stop is None else min(stop, size)
+
+        if size <= STREAM_BLOB_SIZE:
+            data = self.read_object(sha)[2]
+            for offset in range(start, stop, READ_SIZE):
+                yield data[offset:min(offset + READ_SIZE, stop)]
+            return
+
+        process = self.popen('cat-file', 'blob', sha, stderr=DEVNULL)
+        position = 0
+
+        try:
+            while position < stop:
+                chunk = process.stdout.read(READ_SIZE)
+                if not chunk:
+                    break
+
+                chunk_start, position = position, position + len(chunk)
+                if position > start:
+                    yield chunk[max(start - chunk_start, 0):stop - chunk_start]
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.communicate()
+
+    def count_commits(self, sha):
+        """
+        Number of commits reachable from sha. A commit's history never changes so the
+        count is cached without expiry.
+        """
+        if not sha:
+            return 0
+
+        key = 'commit-count:{0}'.format(sha)
+        result = cache.get(key)
+
+        if result is None:
+            try:
+                result = int(self.run('rev-list', '--count', sha))
+            except ValueError:
+                return 0
+            cache.set(key, result, None)
+        return result
+
+    def ls_tree(self, rev, path=''):
+        """
+        Lists the tree at rev:path.
+        :return: (tree sha, [TreeEntry]) raises ObjectNotFound if it is not a directory
+        """
+        path = path.strip('/')
+        sha, object_type, data = self.read_object('{0}:{1}'.format(rev, path))
+
+        if object_type != 'tree':
+            raise ObjectNotFound('{0}:{1}'.format(rev, path))
+        return sha, parse_tree(data)
+
+    def list_files(self, rev):
+        """
+        Paths of every file in the tree of rev
+        """
+        sha = self.rev_parse(rev)
+
+        if sha is None:
+            return []
+
+        output = self.run('ls-tree', '-r', '-z', '--name-only', sha)
+        return [path.decode('utf-8', 'replace') for path in output.split(RECORD_SEPARATOR) if path]
+
+    def list_blobs(self, rev):
+        """
+        Every file in the tree of rev (submodules left out)
+        :return: [(path, blob sha)]
+        """
+        sha = self.rev_parse(rev)
+
+        if sha is None:
+            return []
+
+        blobs = []
+        for record in self.run('ls-tree', '-r', '-z', sha).split(RECORD_SEPARATOR):
+            if not record:
+                continue
+            info, path = record.split(b'\t', 1)
+            _, object_type, blob = info.decode('ascii').split()
+            if object_type == 'blob':
+                blobs.append((path.decode('utf-8', 'replace'), blob))
+        return blobs
+
+    def diff_blobs(self, old, new):
+        """
+        Files that differ between the trees of two commits, renames reported as delete + add
+        :param old: commit sha
+        :param new: commit sha
+        :return: [(path, old blob sha or None, new blob sha or None)]
+        """
+        output = self.run('diff-tree', '-r', '-z', '--no-renames', '--no-commit-id', old, new)
+        fields = output.split(RECORD_SEPARATOR)
+        changes = []
+
+        for info, path in zip(fields[0::2], fields[1::2]):
+            old_mode, new_mode, old_blob, new_blob, _ = info.lstrip(b':').decode('ascii').split()
+            changes.append((path.decode('utf-8', 'replace'),
+                            old_blob if old_mode not in ('000000', '160000') else None,
+                            new_blob if new_mode not in ('000000', '160000') else None))
+        return changes
+
+    def last_commits(self, rev, path=''):
+        """
+        Finds the last commit that touched each entry of the directory rev:path with a
+        single history walk that stops as soon as every entry is resolved. Results are
+        cached per (tree sha, path).
+        :return: {entry name: Commit}
+        """
+        path = path.strip('/')
+        tree, entries = self.ls_tree(rev, path)
+        key = 'last-commits:{0}:{1}'.format(tree, hashlib.sha1(path.encode('utf-8')).hexdigest())
+        result = cache.get(key)
+
+        if result is not None:
+            return result
+
+        result = {}
+        rev = self.rev_parse(rev)  # Never hand a user supplied ref to git log as an argument
+        pending = set(entry.name for entry in entries)
+        prefix = '{0}/'.format(path) if path else ''
+        command = ['log', '-z', '--name-only', '--format=%x1e{0}'.format('%x1f'.join(LOG_FIELDS)), rev]
+
+        if path:
+            command.extend(['--', prefix])
+
+        process = self.popen(*command)
+        commit = None
+        remainder = b''
+
+        try:
+            while pending:
+                chunk = process.stdout.read(READ_SIZE)
+
+                if not chunk:
+                    break
+
+                tokens = (remainder + chunk).split(RECORD_SEPARATOR)
+                remainder = tokens.pop()
+
+                for token in tokens:
+                    token = token.lstrip(b'\n')
+
+                    if token.startswith(RECORD_MARKER):
+                        commit = Commit.from_record(token[1:])
+                        continue
+
+                    name = token.decode('utf-8', 'replace')[len(prefix):].split('/')[0]
+
+                    if name in pending and commit is not None:
+                        result[name] = commit
+                        pending.discard(name)
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.communicate()
+
+        cache.set(key, result)
+        return result
+
+    def object_info(self, rev):
+        """
+        :return: (sha, type, size)
+        """
+        return self.__batch_check.query(rev)[:3]
+
+    def read_object(self, rev):
+        """
+        :return: (sha, type, data)
+        """
+        sha, object_type, _, data = self.__batch.query(rev)
+        return sha, object_type, data
+
+    def rev_parse(self, rev):
+        try:
+            return self.object_info(rev)[0]
+        except ObjectNotFound:
+            return None
+
+    def read_commit(self, rev):
+        """
+        Parses a commit object.
+        :return: (sha, headers, message) headers is a list of (name, value)
+        """
+        sha, object_type, data = self.read_object(rev)
+
+        if object_type != 'commit':
+            raise ObjectNotFound(rev)
+
+        head, _, message = data.decode('utf-8', 'replace').partition('\n\n')
+        headers = []
+
+        for line in head.split('\n'):
+            if line.startswith(' ') and headers:  # Continuation e.g gpgsig
+                name, value = headers[-1]
+                headers[-1] = (name, '{0}\n{1}'.format(value, line[1:]))
+            else:
+                name, _, value = line.partition(' ')
+                headers.append((name, value))
+        return sha, headers, message
+
+    def symbolic_head(self):
+        """
+        Returns the ref HEAD points at e.g refs/heads/master
+        """
+        try:
+            with open(os.path.join(self.git_dir, 'HEAD')) as head:
+                content = head.read().strip()
+        except (IOError, OSError):
+            return None
+
+        if content.startswith('ref:'):
+            return content[4:].strip()
+        return None
+
+    def refs(self, prefix='refs/'):
+        """
+        Reads all refs from packed-refs and the loose refs under refs/.
+        Loose refs win over packed ones, like git does.
+        :return: OrderedDict sorted by ref name {name: sha}
+        """
+        refs = {}
+
+        try:
+            with open(os.path.join(self.git_dir, 'packed-refs')) as packed:
+                for line in packed:
+                    if line.startswith(('#', '^')):
+                        continue
+                    sha, _, name = line.strip().partition(' ')
+                    if name:
+                        refs[name] = sha
+        except (IOError, OSError):
+            pass
+
+        root = os.path.join(self.git_dir, 'refs')
+
+        for current_dir, _, files in os.walk(root):
+            for file_name in files:
+                full_path = os.path.join(current_dir, file_name)
+                name = os.path.relpath(full_path, self.git_dir).replace(os.sep, '/')
+
+                try:
+                    with open(full_path) as ref_file:
+                        sha = ref_file.read().strip()
+                except (IOError, OSError):
+                    continue
+
+                if sha.startswith('ref:'):
+                    sha = self.rev_parse(sha[4:].strip())
+
+                if sha:
+                    refs[name] = sha
+
+        return OrderedDict(sorted((name, sha) for name, sha in refs.items() if name.startswith(prefix)))
+
+    def branches(self):
+        prefix = 'refs/heads/'
+        return [name[len(prefix):] for name in self.refs(prefix)]
+
+    def head(self):
+        """
+        Returns the commit sha HEAD resolves to or None for an empty repo.
+        """
+        symbolic = self.symbolic_head()
+
+        if symbolic is None:
+            return self.rev_parse('HEAD')
+        return self.refs(symbolic).get(symbolic)
+
+    def refs_stamp(self):
+        """
+        A digest of the mtime and size of HEAD, packed-refs and every directory under refs/.
+        Git moves a loose ref into place with a rename, which touches its directory, so the
+        stamp changes whenever a ref does, without reading a single ref.
+        """
+        digest = hashlib.sha1()
+
+        for path in (os.path.join(self.git_dir, 'HEAD'), os.path.join(self.git_dir, 'packed-refs')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digest.update('{0} {1} {2}\n'.format(path, stat.st_mtime_ns, stat.st_size).encode('utf-8'))
+
+        for current_dir, _, _ in os.walk(os.path.join(self.git_dir, 'refs')):
+            try:
+                stat = os.stat(current_dir)
+            except OSError:
+                continue
+            digest.update('{0} {1}\n'.format(current_dir, stat.st_mtime_ns).encode('utf-8'))
+        return digest.hexdigest()
+
+    def ref_fingerprint(self):
+        """
+        A digest of HEAD and every ref tip, it changes whenever a push moves a ref.
+        """
+        digest = hashlib.sha1('HEAD {0}\n'.format(self.symbolic_head()).encode('utf-8'))
+
+        for name, sha in self.refs().items():
+            digest.update('{0} {1}\n'.format(name, sha).encode('utf-8'))
+        return digest.hexdigest()
+
+    def close(self):
+        self.__batch.close()
+        self.__batch_check.close()
+
+
+_pool = OrderedDict()
+_pool_lock = threading.Lock()
+
+
+def get_repository(git_dir):
+    """
+    Returns the pooled Repository for git_dir, least recently used ones are closed once
+    the pool grows over GIT_REPOSITORY_POOL_SIZE.
+    """
+    git_dir = os.path.abspath(git_dir)
+
+    with _pool_lock:
+        repository = _pool.pop(git_dir, None)
+
+        if repository is None:
+            repository = Repository(git_dir)
+
+        _pool[git_dir] = repository
+
+        while len(_pool) > POOL_SIZE:
+            _, stale = _pool.popitem(last=False)
+            stale.close()
+        return repository
+
+
+@atexit.register
+def close_repositories():
+    with _pool_lock:
+        while _pool:
+            _pool.popitem()[1].close()
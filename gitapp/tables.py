@@ -48,16 +48,18 @@ class KeyTable(tables.Table):
         attrs = {"class": "table table-bordered table-condensed content-box gs-profile"}
 
 
-def format_repo_2_table(project):
-    wrapped_list_folder = project.wrapped_list_folder()
-    repos = [RepoFile(cwd=project.working_dir, file_n_folder=file_n_folder)
-             for file_n_folder in wrapped_list_folder]
-    return ProjectTable(repos)
+def format_repo_2_table(project, ref=None):
+    return dynamic_format_repo_2_table(project, '', ref=ref)
 
 
-def dynamic_format_repo_2_table(project, current_path):
+def dynamic_format_repo_2_table(project, current_path, ref=None):
+    """
+    :param current_path: directory relative to the root of the repo
+    """
     cwd = project.working_dir
+    last_commits = project.last_commits(current_path, ref=ref)
 
-    repos = [RepoFile(cwd=cwd, file_n_folder=file_n_folder, project=project)
-             for file_n_folder in project.wrapped_given_folder_list(current_path)]
+    repos = [RepoFile(cwd=cwd, file_n_folder=file_n_folder, project=project,
+                      commit=last_commits.get(file_n_folder[1]))
+             for file_n_folder in project.wrapped_list_folder(current_path, ref=ref)]
     return ProjectTable(repos)
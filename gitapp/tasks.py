@@ -4,12 +4,67 @@ from gitstation import celery_app
 
 
 @celery_app.task(ignore_result=True)
-def update_transit(project_id):
+def update_transit(project_id, locked=False, refs=None):
     """
     This task updates a project's transit path in the background.
     :param str project_id: Project id
+    :param bool locked: the transit lock was taken when queueing, see Project.refresh_transit
+    :param list refs: only fetch these ref names, everything when None
     :return:
     """
     from .models import Project
     project = Project.objects.get(id=project_id)
-    project.update_transit()
+    project.update_transit(locked=locked, refs=refs)
+
+
+@celery_app.task(ignore_result=True)
+def update_language_stats(project_id):
+    """
+    Moves a project's language stats index to its new HEAD, see LanguageIndex.
+    :param str project_id: Project id
+    """
+    from .models import Project
+    project = Project.objects.get(id=project_id)
+    project.language_index(update=True)
+
+
+@celery_app.task(ignore_result=True)
+def reconcile_transits():
+    """
+    Periodic catch up for pushes whose sync was missed: queues a full sync of every transit
+    clone that is behind its bare repo.
+    """
+    import os
+    from .models import Project
+
+    for project in Project.objects.select_related('repo__owner').iterator():
+        if os.path.exists(project.working_dir) and project.transit_is_stale():
+            project.refresh_transit()
+
+
+@celery_app.task(ignore_result=True)
+def maintain_repository(project_id, level=None):
+    """
+    Repacks, writes bitmaps and commit-graphs and prunes a project's bare repo as needed.
+    :param str project_id: Project id
+    :param str level: maintenance.LIGHT or maintenance.FULL, None to go by the heuristics
+    """
+    from .maintenance import maintain
+    from .models import Project
+    project = Project.objects.get(id=project_id)
+    maintain(project.repository, level=level)
+
+
+@celery_app.task(ignore_result=True)
+def schedule_maintenance():
+    """
+    Periodic check of every bare repo, queues maintenance for the ones that need it.
+    """
+    from .maintenance import needed_maintenance
+    from .models import Project
+
+    for project in Project.objects.select_related('repo__owner').iterator():
+        if project.repository.exists():
+            level = needed_maintenance(project.repository)
+            if level is not None:
+                maintain_repository.delay(project.id, level=level)
@@ -1,11 +1,10 @@
 # coding: utf-8
 
 from django.template import Library, Node
-from pygments.formatters.html import HtmlFormatter
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
 from django.template import Variable
 
+from gitapp.highlight import highlight_code
+
 register = Library()
 
 
@@ -21,10 +20,8 @@ class StylizeNode(Node):
         if len(self.vlist) > 0:
             style = Variable(self.vlist[0]).resolve(context)  # style = resolve_variable(self.vlist[0], context)
 
-        return highlight(self.nodelist.render(context),
-                         get_lexer_by_name(style, encoding='UTF-8'),
-                         HtmlFormatter(cssclass="pygment_highlight")
-                         )
+        return highlight_code(self.nodelist.render(context), style,
+                              formatter='html', cssclass="pygment_highlight")
 
 
 def stylize(parser, token):
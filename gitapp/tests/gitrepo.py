@@ -0,0 +1,52 @@
+# coding: utf-8
+"""
+Throwaway git repositories for the tests
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+class GitRepo(object):
+    """
+    A repository in a temporary directory, git_dir is what Repository expects.
+    Commits get increasing dates so that ``git log`` order is predictable.
+    """
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix='gitapp-test-')
+        self.git_dir = os.path.join(self.path, '.git')
+        self.time = 1500000000
+        self.git('init', '-q', '-b', 'master')
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def git(self, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='Alice', GIT_AUTHOR_EMAIL='alice@example.com',
+                   GIT_COMMITTER_NAME='Alice', GIT_COMMITTER_EMAIL='alice@example.com',
+                   GIT_AUTHOR_DATE='{0} +0000'.format(self.time), GIT_COMMITTER_DATE='{0} +0000'.format(self.time),
+                   GIT_CONFIG_NOSYSTEM='1', HOME=self.path)
+        return subprocess.check_output(['git'] + list(args), cwd=self.path, env=env).decode('utf-8').strip()
+
+    def commit(self, message, files=None):
+        """
+        Commits files ({path: content}) and returns the sha
+        """
+        self.time += 60
+
+        for name, content in (files or {}).items():
+            path = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb' if isinstance(content, bytes) else 'w') as handle:
+                handle.write(content)
+            self.git('add', name)
+        self.git('commit', '-q', '--allow-empty', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def merge(self, branch, message):
+        self.time += 60
+        self.git('merge', '-q', '--no-ff', '-m', message, branch)
+        return self.git('rev-parse', 'HEAD')
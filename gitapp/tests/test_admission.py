@@ -0,0 +1,143 @@
+# coding: utf-8
+
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from gitapp import admission
+from gitapp.admission import AdmissionController, increment_slot, slot_counts, take_slot
+from gitapp.exception import TransferRejected
+
+
+class AdmissionTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def controller(self, **kwargs):
+        kwargs.setdefault('timeout', 5)
+        return AdmissionController(name='test-transfers', **kwargs)
+
+    def running(self, epoch=None):
+        return sum(slot_counts('test-transfers', admission.current_epoch() if epoch is None else epoch))
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline, 'timed out')
+            time.sleep(0.005)
+
+    def test_slots_are_counted_and_given_back(self):
+        controller = self.controller(max_active=2)
+        first = controller.admit('a.git', 'alice')
+        second = controller.admit('b.git', 'bob')
+        self.assertEqual(self.running(), 2)
+        self.assertEqual(controller.running, 2)
+
+        first()
+        first()  # Giving back twice counts once
+        self.assertEqual(self.running(), 1)
+        second()
+        self.assertEqual(self.running(), 0)
+        self.assertEqual(controller.metrics()['completed'], 2)
+
+    def test_slots_are_shared_between_workers(self):
+        one, other = self.controller(max_active=1, max_queued=0), self.controller(max_active=1, max_queued=0)
+        release = one.admit('a.git', 'alice')
+
+        with self.assertRaises(TransferRejected):
+            other.admit('b.git', 'bob')
+        release()
+        other.admit('b.git', 'bob')()
+
+    def test_per_repo_limit(self):
+        controller = self.controller(max_active=3, max_per_repo=1, max_queued=0)
+        release = controller.admit('a.git', 'alice')
+
+        with self.assertRaises(TransferRejected):
+            controller.admit('a.git', 'bob')
+        controller.admit('b.git', 'bob')()
+        self.assertEqual(self.running(), 1)  # The rejected one gave its global slot back
+        release()
+
+    def test_wait_times_out(self):
+        controller = self.controller(max_active=1, timeout=0.05)
+        release = controller.admit('a.git', 'alice')
+
+        with self.assertRaises(TransferRejected):
+            controller.admit('a.git', 'bob')
+        self.assertEqual(controller.metrics()['timed_out'], 1)
+        self.assertEqual(controller.queued, 0)
+        release()
+
+    def test_users_are_served_round_robin(self):
+        controller = self.controller(max_active=1)
+        release = controller.admit('a.git', 'holder')
+        order = []
+
+        def transfer(user):
+            done = controller.admit('a.git', user)
+            order.append(user)
+            done()
+
+        threads = []
+        for user in ('alice', 'alice', 'alice', 'bob', 'carol'):
+            thread = threading.Thread(target=transfer, args=(user,))
+            thread.start()
+            threads.append(thread)
+            self.wait_for(lambda: controller.queued == len(threads))
+
+        release()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(order, ['alice', 'bob', 'carol', 'alice', 'alice'])
+
+    def test_full_repo_does_not_block_other_repos(self):
+        controller = self.controller(max_active=2, max_per_repo=1)
+        release = controller.admit('a.git', 'holder')
+
+        first = threading.Thread(target=lambda: controller.admit('a.git', 'alice')())
+        first.start()
+        self.wait_for(lambda: controller.queued == 1)
+
+        # alice's first transfer waits for a.git, her second on b.git goes ahead
+        other = controller.admit('b.git', 'alice')
+        self.assertEqual(controller.queued, 1)
+        release()
+        first.join(5)
+        self.assertEqual(controller.queued, 0)
+        other()
+        self.assertEqual(self.running(), 0)
+
+    def test_running_transfers_move_to_the_current_epoch(self):
+        controller = self.controller()
+
+        with mock.patch('gitapp.admission.current_epoch', return_value=10):
+            release = controller.admit('a.git', 'alice')
+            self.assertEqual(slot_counts('test-transfers', 10), (1, 0))
+
+        with mock.patch('gitapp.admission.current_epoch', return_value=11):
+            controller.poll()
+            self.assertEqual(slot_counts('test-transfers', 11), (1, 0))
+
+        with mock.patch('gitapp.admission.current_epoch', return_value=12):
+            controller.poll()
+            self.assertEqual(self.running(12), 1)
+            release()
+            self.assertEqual(self.running(12), 0)
+
+    def test_slots_of_a_dead_worker_expire(self):
+        # Counted at epoch 10 by a worker that never moved or gave them back
+        increment_slot('test-transfers', 10, 3)
+        self.assertFalse(take_slot('test-transfers', 3, 10))
+        self.assertFalse(take_slot('test-transfers', 3, 11))
+        self.assertTrue(take_slot('test-transfers', 3, 12))
+
+    def test_take_slot_stays_within_the_limit(self):
+        self.assertTrue(take_slot('test-transfers', 2, 10))
+        self.assertTrue(take_slot('test-transfers', 2, 10))
+        self.assertFalse(take_slot('test-transfers', 2, 10))
+        self.assertEqual(slot_counts('test-transfers', 10), (2, 0))
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+from django.test import SimpleTestCase, override_settings
+
+from gitapp.models import CommitFactory, CommitSequence
+from gitapp.repository import Repository
+
+from .gitrepo import GitRepo
+
+
+@override_settings(NUMPERPAGE=2)
+class KeysetPaginationTest(SimpleTestCase):
+
+    def setUp(self):
+        # master: root - a ----- merge
+        # side:        \ b1 - b2 /
+        self.repo = GitRepo()
+        self.root = self.repo.commit('root')
+        self.repo.git('checkout', '-q', '-b', 'side')
+        self.b1 = self.repo.commit('b1')
+        self.repo.git('checkout', '-q', 'master')
+        self.a = self.repo.commit('a')
+        self.repo.git('checkout', '-q', 'side')
+        self.b2 = self.repo.commit('b2')
+        self.repo.git('checkout', '-q', 'master')
+        self.merge = self.repo.merge('side', 'merge')
+        self.repository = Repository(self.repo.git_dir)
+        self.factory = CommitFactory(CommitSequence(self.repository, self.merge))
+
+    def tearDown(self):
+        self.repository.close()
+        self.repo.cleanup()
+
+    def history(self):
+        return [commit.commit for commit in self.repository.iter_commits(self.merge)]
+
+    def follow(self, page):
+        shas = [commit.commit for commit in page]
+
+        while page.has_next():
+            page = self.factory.get_commits_page(None, before=page.next_before, tip=page.tip,
+                                                 skip=page.offset + len(page) - 1)
+            shas += [commit.commit for commit in page]
+        return shas
+
+    def test_pages_across_a_merge(self):
+        # a is the first parent of the merge, b1 only comes after it in the history
+        self.assertEqual(self.history(), [self.merge, self.b2, self.a, self.b1, self.root])
+
+        page = self.factory.get_commits_page(None, before=self.merge)
+        self.assertEqual([commit.commit for commit in page], [self.b2, self.a])
+        self.assertEqual(self.follow(page), self.history()[1:])
+
+    def test_stale_position_falls_back_to_a_walk(self):
+        page = self.factory.get_commits_page(None, before=self.a, skip=0)
+        self.assertEqual([commit.commit for commit in page], [self.b1, self.root])
+        self.assertFalse(page.has_next())
+
+    def test_next_query_pins_tip_and_position(self):
+        page = self.factory.get_commits_page(None, before=self.merge)
+        self.assertIn('before={0}'.format(self.a), page.next_query)
+        self.assertIn('tip={0}'.format(self.merge), page.next_query)
+        self.assertIn('skip=2', page.next_query)
+
+    def test_before_outside_the_history(self):
+        self.repo.git('checkout', '-q', '--orphan', 'other')
+        other = self.repo.commit('other')
+        self.assertEqual(len(self.factory.get_commits_page(None, before=other)), 0)
@@ -0,0 +1,52 @@
+# coding: utf-8
+
+import gzip
+import os
+
+from django.test import SimpleTestCase
+
+from gitapp import compression
+
+
+class GzipBlocksTest(SimpleTestCase):
+
+    def compress(self, data, chunk_size=10000, level=6):
+        chunks = (data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size))
+        return b''.join(compression.gzip_blocks(chunks, level))
+
+    def assertRoundTrip(self, data, **kwargs):
+        # gzip.decompress also checks the crc32 and ISIZE trailer
+        self.assertEqual(gzip.decompress(self.compress(data, **kwargs)), data)
+
+    def test_empty(self):
+        self.assertRoundTrip(b'')
+
+    def test_smaller_than_a_block(self):
+        self.assertRoundTrip(os.urandom(1000))
+
+    def test_exactly_one_block(self):
+        self.assertRoundTrip(os.urandom(compression.BLOCK_SIZE))
+
+    def test_block_boundaries(self):
+        for size in (compression.BLOCK_SIZE - 1, compression.BLOCK_SIZE + 1, compression.BLOCK_SIZE * 2):
+            self.assertRoundTrip(os.urandom(size))
+
+    def test_several_blocks(self):
+        data = os.urandom(compression.BLOCK_SIZE * 5 + 12345)
+        self.assertRoundTrip(data, chunk_size=7)
+        self.assertRoundTrip(data, chunk_size=compression.BLOCK_SIZE * 3)
+
+    def test_levels(self):
+        data = b'tree\n' * 100000
+        for level in (1, 9):
+            self.assertRoundTrip(data, level=level)
+
+    def test_blocks_are_primed_with_the_previous_one(self):
+        # The pattern repeats within deflate's window, so every block after the first
+        # only refers back to the one before it
+        pattern = os.urandom(compression.WINDOW_SIZE // 2)
+        data = pattern * (compression.BLOCK_SIZE * 4 // len(pattern))
+        compressed = self.compress(data)
+
+        self.assertEqual(gzip.decompress(compressed), data)
+        self.assertLess(len(compressed), len(pattern) * 2)
@@ -0,0 +1,155 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from gitapp import filecache
+from gitapp.filecache import FileCache
+
+
+class Source(object):
+    """
+    Chunks that remember how far they were read and whether they were closed
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.read += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+@mock.patch.object(filecache, 'FILL_POLL_INTERVAL', 0.01)
+class FileCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.root = tempfile.mkdtemp(prefix='gitapp-test-')
+        self.cache = FileCache(self.root, 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def lock_key(self, key):
+        return 'file-cache-fill:{0}:{1}'.format(self.root, key)
+
+    def read(self, path):
+        with open(path, 'rb') as entry:
+            return entry.read()
+
+    def leftovers(self):
+        return [name for _, _, files in os.walk(self.root) for name in files if name.endswith(filecache.TEMP_SUFFIX)]
+
+    def test_fill_publishes_what_was_read(self):
+        source = Source([b'ab', b'cd'])
+        self.assertIsNone(self.cache.get('abcdef'))
+        self.assertEqual(b''.join(self.cache.fill('abcdef', source)), b'abcd')
+
+        self.assertEqual(self.read(self.cache.get('abcdef')), b'abcd')
+        self.assertTrue(source.closed)
+        self.assertIsNone(cache.get(self.lock_key('abcdef')))
+
+    def test_stopping_early_publishes_nothing(self):
+        source = Source([b'ab', b'cd', b'ef'])
+        chunks = self.cache.fill('abcdef', source)
+        self.assertEqual(next(chunks), b'ab')
+        chunks.close()
+
+        self.assertIsNone(self.cache.get('abcdef'))
+        self.assertTrue(source.closed)
+        self.assertEqual(self.leftovers(), [])
+        self.assertIsNone(cache.get(self.lock_key('abcdef')))
+
+    def test_incomplete_source_is_not_published(self):
+        self.assertEqual(b''.join(self.cache.fill('abcdef', Source([b'ab']), complete=lambda: False)), b'ab')
+        self.assertIsNone(self.cache.get('abcdef'))
+        self.assertEqual(self.leftovers(), [])
+
+        self.assertEqual(b''.join(self.cache.fill('abcdef', Source([b'ab']), complete=lambda: True)), b'ab')
+        self.assertIsNotNone(self.cache.get('abcdef'))
+
+    def test_concurrent_fill_streams_the_published_entry(self):
+        # Someone else holds the lock, publishes and lets go
+        cache.add(self.lock_key('abcdef'), True)
+
+        def other_fill():
+            path = self.cache.path('abcdef')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as entry:
+                entry.write(b'from first')
+            cache.delete(self.lock_key('abcdef'))
+
+        timer = threading.Timer(0.05, other_fill)
+        timer.start()
+        source = Source([b'from', b' second'])
+        self.assertEqual(b''.join(self.cache.fill('abcdef', source)), b'from first')
+        timer.join()
+
+        self.assertEqual(source.read, 0)
+        self.assertTrue(source.closed)
+
+    def test_concurrent_fill_that_fails_falls_back_to_the_source(self):
+        cache.add(self.lock_key('abcdef'), True)
+        timer = threading.Timer(0.05, cache.delete, [self.lock_key('abcdef')])
+        timer.start()
+        self.assertEqual(b''.join(self.cache.fill('abcdef', Source([b'ab', b'cd']))), b'abcd')
+        timer.join()
+
+        self.assertIsNone(self.cache.get('abcdef'))
+
+    def test_wait(self):
+        self.assertIsNone(self.cache.wait('abcdef'))  # Nobody filling it
+        cache.add(self.lock_key('abcdef'), True)
+        self.assertIsNone(self.cache.wait('abcdef', timeout=0.05))
+
+        b''.join(FileCache(self.root, 1000).fill('123456', [b'x']))
+        cache.delete(self.lock_key('abcdef'))
+        self.assertEqual(self.cache.wait('123456'), self.cache.path('123456'))
+
+    def test_evict_least_recently_used(self):
+        for index, key in enumerate(('aa0001', 'bb0002', 'cc0003')):
+            b''.join(FileCache(self.root, 10000).fill(key, [b'x' * 400]))
+            os.utime(self.cache.path(key), (1000 + index, 1000 + index))
+        self.cache.get('aa0001')  # A hit makes it the most recent
+
+        self.cache.evict()
+        self.assertIsNone(self.cache.get('bb0002'))
+        self.assertIsNotNone(self.cache.get('aa0001'))
+        self.assertIsNotNone(self.cache.get('cc0003'))
+        self.assertEqual(cache.get('file-cache-size:{0}'.format(self.root)), 800)
+
+    def test_evicts_only_once_over_the_limit(self):
+        with mock.patch.object(FileCache, 'evict') as evict:
+            b''.join(self.cache.fill('aa0001', [b'x' * 100]))
+            self.assertEqual(evict.call_count, 1)  # Size not known yet
+
+            cache.set('file-cache-size:{0}'.format(self.root), 100, None)
+            b''.join(self.cache.fill('bb0002', [b'x' * 800]))
+            self.assertEqual(evict.call_count, 1)
+
+            b''.join(self.cache.fill('cc0003', [b'x' * 200]))
+            self.assertEqual(evict.call_count, 2)
+
+    def test_size_is_tracked_across_fills(self):
+        b''.join(self.cache.fill('aa0001', [b'x' * 100]))
+        b''.join(self.cache.fill('bb0002', [b'x' * 300]))
+        self.assertEqual(cache.get('file-cache-size:{0}'.format(self.root)), 400)
+
+    def test_delete_prefix(self):
+        for key in ('aa0001', 'aa0002', 'ab0001'):
+            b''.join(self.cache.fill(key, [b'x']))
+        self.cache.delete_prefix('aa')
+        self.assertEqual([self.cache.get(key) is None for key in ('aa0001', 'aa0002', 'ab0001')], [True, True, False])
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from gitapp.repository import Repository
+
+from .gitrepo import GitRepo
+
+
+class LastCommitsTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.repo = GitRepo()
+        self.first = self.repo.commit('first', {'a.txt': 'a', 'b.txt': 'b', 'src/x.py': 'x', 'src/y.py': 'y'})
+        self.second = self.repo.commit('second\n\nwith a body', {'b.txt': 'b2', 'src/lib/z.py': 'z'})
+        self.third = self.repo.commit('third', {'src/x.py': 'x2', 'with space ü.txt': 'u'})
+        self.repository = Repository(self.repo.git_dir)
+
+    def tearDown(self):
+        self.repository.close()
+        self.repo.cleanup()
+
+    def shas(self, result):
+        return dict((name, commit.commit) for name, commit in result.items())
+
+    def test_root(self):
+        self.assertEqual(self.shas(self.repository.last_commits('HEAD')), {
+            'a.txt': self.first,
+            'b.txt': self.second,
+            'src': self.third,
+            'with space ü.txt': self.third,
+        })
+
+    def test_directory(self):
+        self.assertEqual(self.shas(self.repository.last_commits('HEAD', 'src')), {
+            'x.py': self.third,
+            'y.py': self.first,
+            'lib': self.second,
+        })
+        self.assertEqual(self.shas(self.repository.last_commits('HEAD', '/src/lib/')), {'z.py': self.second})
+
+    def test_commits_are_complete(self):
+        commit = self.repository.last_commits('HEAD')['b.txt']
+        self.assertEqual(commit.message, 'second\n\nwith a body')
+        self.assertEqual(commit.parents, (self.first,))
+
+    def test_older_revision(self):
+        self.assertEqual(self.shas(self.repository.last_commits(self.second, 'src')), {
+            'x.py': self.first,
+            'y.py': self.first,
+            'lib': self.second,
+        })
+
+    def test_merge(self):
+        # A file changed on a branch is attributed to the commit that changed it, not the merge
+        self.repo.git('checkout', '-q', '-b', 'side', self.first)
+        side = self.repo.commit('side', {'a.txt': 'a2'})
+        self.repo.git('checkout', '-q', 'master')
+        self.repo.merge('side', 'merge side')
+
+        result = self.shas(self.repository.last_commits('HEAD'))
+        self.assertEqual(result['a.txt'], side)
+        self.assertEqual(result['b.txt'], self.second)
+
+    def test_names_split_across_reads(self):
+        expected = self.shas(self.repository.last_commits('HEAD'))
+        cache.clear()
+
+        with mock.patch('gitapp.repository.READ_SIZE', 5):
+            self.assertEqual(self.shas(self.repository.last_commits('HEAD')), expected)
+
+    def test_cached_per_tree(self):
+        self.repository.last_commits('HEAD')
+
+        with mock.patch.object(self.repository, 'popen') as popen:
+            self.assertEqual(self.shas(self.repository.last_commits('HEAD'))['a.txt'], self.first)
+        popen.assert_not_called()
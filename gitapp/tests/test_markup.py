@@ -0,0 +1,39 @@
+# coding: utf-8
+
+from django.test import SimpleTestCase
+
+from gitapp.markup import safe_markdown_2_html
+
+
+class SafeMarkdownTest(SimpleTestCase):
+
+    def assertNoLink(self, text):
+        html = safe_markdown_2_html(text)
+        self.assertNotIn('href=', html)
+        self.assertNotIn('src=', html)
+
+    def test_javascript_links_are_dropped(self):
+        self.assertNoLink('[x](javascript:alert(1))')
+        self.assertNoLink('![x](javascript:alert(1))')
+
+    def test_mixed_case_scheme(self):
+        self.assertNoLink('[x](JaVaScRiPt:alert(1))')
+
+    def test_entity_encoded_scheme(self):
+        self.assertNoLink('[x](&#106;avascript:alert(1))')
+        self.assertNoLink('![x](&#x6A;avascript:alert(1))')
+        self.assertNoLink('[x](&amp;#106;avascript:alert(1))')
+
+    def test_whitespace_and_control_characters_in_scheme(self):
+        self.assertNoLink('[x](java&#x09;script:alert(1))')
+        self.assertNoLink('[x](&#x01;javascript:alert(1))')
+        self.assertNoLink('[x](java\x00script:alert(1))')
+
+    def test_safe_links_are_kept(self):
+        html = safe_markdown_2_html('[a](https://example.com/) [b](docs/a.md) [c](mailto:a@example.com)')
+        self.assertIn('href="https://example.com/"', html)
+        self.assertIn('href="docs/a.md"', html)
+        self.assertIn('href="mailto:a@example.com"', html)
+
+    def test_raw_html_is_escaped(self):
+        self.assertNotIn('<script', safe_markdown_2_html('<script>alert(1)</script>'))
@@ -0,0 +1,80 @@
+# coding: utf-8
+
+from django.test import SimpleTestCase
+
+from gitapp.utils import parse_byte_range, split_head, FILE_TYPE_SNIFF_SIZE
+
+
+class ParseByteRangeTest(SimpleTestCase):
+
+    def test_no_range(self):
+        self.assertIsNone(parse_byte_range(None, 10))
+        self.assertIsNone(parse_byte_range('', 10))
+        self.assertIsNone(parse_byte_range('items=0-1', 10))
+
+    def test_range(self):
+        self.assertEqual(parse_byte_range('bytes=0-0', 10), (0, 1))
+        self.assertEqual(parse_byte_range('bytes=2-4', 10), (2, 5))
+        self.assertEqual(parse_byte_range('bytes=9-9', 10), (9, 10))
+
+    def test_open_range(self):
+        self.assertEqual(parse_byte_range('bytes=0-', 10), (0, 10))
+        self.assertEqual(parse_byte_range('bytes=4-', 10), (4, 10))
+
+    def test_end_past_the_end_is_clamped(self):
+        self.assertEqual(parse_byte_range('bytes=2-100', 10), (2, 10))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_byte_range('bytes=-5', 10), (5, 10))
+        self.assertEqual(parse_byte_range('bytes=-10', 10), (0, 10))
+        self.assertEqual(parse_byte_range('bytes=-20', 10), (0, 10))
+
+    def test_empty_suffix_is_not_satisfiable(self):
+        self.assertIs(parse_byte_range('bytes=-0', 10), False)
+        self.assertIs(parse_byte_range('bytes=-0', 0), False)
+        self.assertIs(parse_byte_range('bytes=-5', 0), False)
+
+    def test_start_after_the_end_is_not_satisfiable(self):
+        self.assertIs(parse_byte_range('bytes=10-', 10), False)
+        self.assertIs(parse_byte_range('bytes=12-15', 10), False)
+        self.assertIs(parse_byte_range('bytes=0-', 0), False)
+
+    def test_several_ranges_send_everything(self):
+        self.assertIsNone(parse_byte_range('bytes=0-1,5-6', 10))
+        self.assertIsNone(parse_byte_range('bytes=-1, 0-0', 10))
+
+    def test_invalid_ranges_are_ignored(self):
+        for header in ('bytes=5-2', 'bytes=-', 'bytes=5', 'bytes=--5', 'bytes=-+5', 'bytes=a-b', 'bytes=²-'):
+            self.assertIsNone(parse_byte_range(header, 10), header)
+
+
+class SplitHeadTest(SimpleTestCase):
+
+    data = bytes(range(256)) * 40
+
+    def chunks(self, size):
+        return (self.data[offset:offset + size] for offset in range(0, len(self.data), size))
+
+    def test_head_and_body(self):
+        for size in (1, 100, FILE_TYPE_SNIFF_SIZE, len(self.data)):
+            head, body = split_head(self.chunks(size))
+            self.assertEqual(head, self.data[:FILE_TYPE_SNIFF_SIZE])
+            self.assertEqual(b''.join(body), self.data)
+
+    def test_skip(self):
+        for skip in (0, 10, FILE_TYPE_SNIFF_SIZE + 1, 5000, len(self.data)):
+            head, body = split_head(self.chunks(700), skip)
+            self.assertEqual(head, self.data[:FILE_TYPE_SNIFF_SIZE])
+            self.assertEqual(b''.join(body), self.data[skip:])
+
+    def test_short_stream(self):
+        head, body = split_head([b'ab', b'c'])
+        self.assertEqual(head, b'abc')
+        self.assertEqual(b''.join(body), b'abc')
+
+    def test_closing_the_body_closes_the_stream(self):
+        chunks = self.chunks(100)
+        head, body = split_head(chunks)
+        next(body)
+        body.close()
+        self.assertIsNone(chunks.gi_frame)
@@ -0,0 +1,139 @@
+# coding: utf-8
+
+import io
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from gitapp.repository import Commit, ObjectNotFound, Repository, parse_commits, parse_tree
+
+from .gitrepo import GitRepo
+
+
+def record(commit, parents='', message='title', author='Alice', email='alice@example.com', timestamp='1500000000'):
+    return '\x1f'.join((commit, parents, author, email, timestamp, message)).encode('utf-8')
+
+
+class CommitRecordTest(SimpleTestCase):
+
+    def test_fields(self):
+        commit = Commit.from_record(record('a' * 40, message='Fix the thing\n'))
+        self.assertEqual(commit.commit, 'a' * 40)
+        self.assertEqual(commit.parents, ())
+        self.assertEqual((commit.author, commit.email), ('Alice', 'alice@example.com'))
+        self.assertEqual(commit.date.timestamp(), 1500000000)
+        self.assertEqual(commit.message, 'Fix the thing')
+        self.assertIsNone(commit.merge)
+
+    def test_multi_paragraph_body(self):
+        message = 'Title\n\nFirst paragraph\nstill first.\n\n\nSecond paragraph\n'
+        commit = Commit.from_record(record('a' * 40, message=message))
+        self.assertEqual(commit.message, message.strip())
+        self.assertEqual(commit.title, 'Title')
+
+    def test_separator_in_body(self):
+        # The body goes last, a stray separator in it stays part of the message
+        commit = Commit.from_record(record('a' * 40, message='one\x1ftwo'))
+        self.assertEqual(commit.message, 'one\x1ftwo')
+        self.assertEqual(commit.author, 'Alice')
+
+    def test_merge(self):
+        commit = Commit.from_record(record('a' * 40, parents='{0} {1}'.format('b' * 40, 'c' * 40)))
+        self.assertEqual(commit.parents, ('b' * 40, 'c' * 40))
+        self.assertEqual(commit.merge, 'bbbbbbb ccccccc')
+
+    def test_invalid_utf8(self):
+        commit = Commit.from_record(record('a' * 40, author='x').replace(b'\x1fx\x1f', b'\x1f\xff\x1f'))
+        self.assertEqual(commit.author, '�')
+
+
+class ParseCommitsTest(SimpleTestCase):
+
+    messages = ['first\n\nbody\n\nmore body\n', 'second', 'third\n\n\n']
+
+    def stream(self):
+        # What git log -z writes: records separated by NUL
+        records = [record(str(index) * 40, message=message) for index, message in enumerate(self.messages)]
+        return io.BytesIO(b'\x00'.join(records))
+
+    def test_records(self):
+        commits = list(parse_commits(self.stream()))
+        self.assertEqual([commit.commit for commit in commits], ['0' * 40, '1' * 40, '2' * 40])
+        self.assertEqual([commit.message for commit in commits], [message.strip() for message in self.messages])
+
+    def test_records_split_across_reads(self):
+        expected = [commit.message for commit in parse_commits(self.stream())]
+
+        for size in (1, 7, 40, 41):
+            with mock.patch('gitapp.repository.READ_SIZE', size):
+                self.assertEqual([commit.message for commit in parse_commits(self.stream())], expected)
+
+    def test_empty(self):
+        self.assertEqual(list(parse_commits(io.BytesIO(b''))), [])
+
+
+class IterCommitsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.repo = GitRepo()
+        self.repository = Repository(self.repo.git_dir)
+
+    def tearDown(self):
+        self.repository.close()
+        self.repo.cleanup()
+
+    def test_history_with_a_merge(self):
+        root = self.repo.commit('root\n\nThe first commit.\n\nIt has\ntwo paragraphs.')
+        self.repo.git('checkout', '-q', '-b', 'side')
+        side = self.repo.commit('side')
+        self.repo.git('checkout', '-q', 'master')
+        main = self.repo.commit('main')
+        merge = self.repo.merge('side', 'merge side')
+
+        commits = list(self.repository.iter_commits(merge))
+        self.assertEqual([commit.commit for commit in commits], [merge, main, side, root])
+        self.assertEqual(commits[0].parents, (main, side))
+        self.assertEqual(commits[-1].message, 'root\n\nThe first commit.\n\nIt has\ntwo paragraphs.')
+        self.assertEqual(commits[-1].parents, ())
+
+    def test_stopping_early(self):
+        for index in range(5):
+            self.repo.commit('commit {0}'.format(index))
+        commits = self.repository.iter_commits('HEAD')
+        self.assertEqual(next(commits).message, 'commit 4')
+        commits.close()
+
+
+class TreeTest(SimpleTestCase):
+
+    def test_parse_tree(self):
+        data = b''.join((b'100644 a b.txt\x00', b'\x01' * 20, b'40000 d\xc3\xbcr\x00', b'\x02' * 20,
+                         b'160000 sub\x00', b'\x03' * 20, b'120000 link\x00', b'\x00' * 20))
+        entries = parse_tree(data)
+        self.assertEqual([(entry.mode, entry.type, entry.name) for entry in entries], [
+            ('100644', 'blob', 'a b.txt'),
+            ('40000', 'tree', 'dür'),
+            ('160000', 'commit', 'sub'),
+            ('120000', 'blob', 'link'),
+        ])
+        self.assertEqual([entry.sha for entry in entries], ['01' * 20, '02' * 20, '03' * 20, '00' * 20])
+        self.assertEqual([entry.is_dir() for entry in entries], [False, True, False, False])
+
+    def test_empty_tree(self):
+        self.assertEqual(parse_tree(b''), [])
+
+    def test_ls_tree(self):
+        repo = GitRepo()
+        self.addCleanup(repo.cleanup)
+        repo.commit('files', {'a.txt': 'a', 'src/x.py': 'x'})
+        repository = Repository(repo.git_dir)
+        self.addCleanup(repository.close)
+
+        sha, entries = repository.ls_tree('HEAD')
+        self.assertEqual(sha, repo.git('rev-parse', 'HEAD^{tree}'))
+        self.assertEqual([(entry.name, entry.type) for entry in entries], [('a.txt', 'blob'), ('src', 'tree')])
+        self.assertEqual([entry.name for entry in repository.ls_tree('HEAD', '/src/')[1]], ['x.py'])
+        self.assertEqual(entries[0].sha, repo.git('rev-parse', 'HEAD:a.txt'))
+
+        with self.assertRaises(ObjectNotFound):
+            repository.ls_tree('HEAD', 'a.txt')
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+from django.test import SimpleTestCase
+
+from gitapp.gitHttpBackend import FLUSH_PKT, pkt_line, upload_pack_cache_key
+from gitapp.repository import Repository
+
+from .gitrepo import GitRepo
+
+
+GIT_DIR = '/srv/git/alice/demo.git'
+WANT = 'want {0}\n'.format('a' * 40)
+DELIM_PKT = b'0001'
+
+
+def v0_request(*lines):
+    return pkt_line(WANT.rstrip('\n') + ' multi_ack_detailed side-band-64k ofs-delta\n') + \
+        b''.join(pkt_line(line) for line in lines) + FLUSH_PKT + pkt_line('done\n')
+
+
+def v2_request(command='fetch', *lines):
+    return pkt_line('command={0}\n'.format(command)) + pkt_line('agent=git/2.39\n') + DELIM_PKT + \
+        b''.join(pkt_line(line) for line in lines) + FLUSH_PKT
+
+
+class UploadPackCacheKeyTest(SimpleTestCase):
+
+    def test_clone_is_cached(self):
+        self.assertIsNotNone(upload_pack_cache_key(GIT_DIR, v0_request()))
+        self.assertIsNotNone(upload_pack_cache_key(GIT_DIR, v0_request('deepen 1\n')))
+        self.assertIsNotNone(upload_pack_cache_key(GIT_DIR, v2_request('fetch', WANT, 'done\n'), 'version=2'))
+
+    def test_same_request_same_key(self):
+        self.assertEqual(upload_pack_cache_key(GIT_DIR, v0_request(), refs_stamp='1'),
+                         upload_pack_cache_key(GIT_DIR, v0_request(), refs_stamp='1'))
+
+    def test_fetch_with_haves_is_not_cached(self):
+        have = 'have {0}\n'.format('b' * 40)
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, v0_request(have)))
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, v2_request('fetch', WANT, have, 'done\n'), 'version=2'))
+
+    def test_other_commands_are_not_cached(self):
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, v2_request('ls-refs', 'peel\n', 'symrefs\n'), 'version=2'))
+        object_info = v2_request('object-info', 'size\n', 'oid {0}\n'.format('a' * 40))
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, object_info, 'version=2'))
+
+    def test_request_without_wants_is_not_cached(self):
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, FLUSH_PKT))
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, v2_request('fetch', 'done\n'), 'version=2'))
+
+    def test_invalid_request_is_not_cached(self):
+        self.assertIsNone(upload_pack_cache_key(GIT_DIR, b'zzzz' + WANT.encode('ascii')))
+
+    def test_key_depends_on_repo_protocol_and_refs(self):
+        body = v0_request()
+        key = upload_pack_cache_key(GIT_DIR, body)
+        self.assertNotEqual(upload_pack_cache_key('/srv/git/alice/other.git', body), key)
+        self.assertNotEqual(upload_pack_cache_key(GIT_DIR, body, 'version=1'), key)
+        self.assertNotEqual(upload_pack_cache_key(GIT_DIR, body, refs_stamp='1'), key)
+        self.assertNotEqual(upload_pack_cache_key(GIT_DIR, v0_request('deepen 1\n')), key)
+
+    def test_keys_of_a_repo_share_a_prefix(self):
+        # invalidate_upload_pack_cache drops a repo's entries by prefix
+        first = upload_pack_cache_key(GIT_DIR, v0_request())
+        second = upload_pack_cache_key(GIT_DIR, v0_request('deepen 1\n'), refs_stamp='1')
+        self.assertEqual(first.split('-')[0], second.split('-')[0])
+        self.assertNotEqual(upload_pack_cache_key('/srv/git/alice/other.git', v0_request()).split('-')[0],
+                            first.split('-')[0])
+
+    def test_refs_stamp_follows_the_refs(self):
+        repo = GitRepo()
+        self.addCleanup(repo.cleanup)
+        repo.commit('first')
+        repository = Repository(repo.git_dir)
+        self.addCleanup(repository.close)
+
+        stamp = repository.refs_stamp()
+        self.assertEqual(repository.refs_stamp(), stamp)
+        repo.git('branch', 'topic')
+        self.assertNotEqual(repository.refs_stamp(), stamp)
+
+        stamp = repository.refs_stamp()
+        repo.git('pack-refs', '--all')
+        self.assertNotEqual(repository.refs_stamp(), stamp)
@@ -1,25 +1,30 @@
 # coding: utf-8
 
+from array import array
 import base64
-import codecs
+from collections import OrderedDict
 from Crypto import Cipher, Random
-import datetime
-from hashlib import md5
+from hashlib import md5, sha1
+from itertools import accumulate, islice
 import markdown
+from operator import sub
 import os
+import re
 from subprocess import Popen, PIPE
-import time
+import zlib
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
-from django.shortcuts import Http404
+from django.http import HttpResponse, HttpResponseNotModified
+from django.shortcuts import Http404, render
 from django.urls import reverse_lazy
-from django.utils.html import format_html
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from django.utils.safestring import mark_safe
 
 from django_gravatar.helpers import get_gravatar_url
 
-from .tasks import update_transit
 
 
 progress_bar = ["progress progress-info",
@@ -40,48 +45,198 @@ EXTENSIONS = {'.md': 'html', '.py': 'python', '.js': 'javascript',
               '.yaml': 'yaml', '.cpp': 'cpp'
               }
 
+# Names used for the language stats, keyed by EXTENSIONS values
+FILE_TYPES = {'html': 'HTML', 'javascript': 'JavaScript', 'css': 'CSS', 'php': 'PHP',
+              'sql': 'SQL', 'yaml': 'YAML', 'cpp': 'C++', 'c': 'C', 'json': 'JSON',
+              'xml': 'XML', 'csharp': 'C#', 'objective-c': 'Objective-C', 'coffeescript': 'CoffeeScript',
+              'typescript': 'TypeScript'
+              }
+
+FILE_TYPE_EXTENSIONS = dict(EXTENSIONS, **{
+    '.md': 'markdown', '.markdown': 'markdown', '.rst': 'text', '.htm': 'html', '.pyw': 'python',
+    '.bash': 'shell', '.zsh': 'shell', '.pm': 'perl', '.jsx': 'javascript', '.ts': 'typescript',
+    '.coffee': 'coffeescript', '.scss': 'css', '.less': 'css', '.c': 'c', '.h': 'c', '.cc': 'cpp',
+    '.cxx': 'cpp', '.hpp': 'cpp', '.cs': 'csharp', '.m': 'objective-c', '.json': 'json',
+    '.xml': 'xml', '.yml': 'yaml', '.hrl': 'erlang', '.rs': 'rust', '.lua': 'lua',
+    '.kt': 'kotlin', '.swift': 'swift', '.clj': 'clojure', '.hs': 'haskell', '.ex': 'elixir',
+    '.exs': 'elixir', '.r': 'r', '.cfg': 'text', '.ini': 'text', '.csv': 'text', '.log': 'text',
+})
+
+SHEBANG_TYPES = {'python': 'Python', 'sh': 'Shell', 'bash': 'Shell', 'zsh': 'Shell', 'dash': 'Shell',
+                 'ksh': 'Shell', 'perl': 'Perl', 'ruby': 'Ruby', 'node': 'JavaScript', 'nodejs': 'JavaScript',
+                 'php': 'PHP', 'lua': 'Lua', 'Rscript': 'R', 'escript': 'Erlang', 'tclsh': 'Tcl'
+                 }
+
+# Leading bytes -> the type file(1) would report
+MAGIC_NUMBERS = ((b'\x89PNG', 'PNG'), (b'GIF8', 'GIF'), (b'\xff\xd8\xff', 'JPEG'), (b'%PDF', 'PDF'),
+                 (b'PK\x03\x04', 'Zip'), (b'\x1f\x8b', 'gzip'), (b'BZh', 'bzip2'), (b'\x7fELF', 'ELF'),
+                 (b'\xfd7zXZ\x00', 'XZ'), (b'\xca\xfe\xba\xbe', 'compiled'), (b'RIFF', 'RIFF'),
+                 (b'\x00\x00\x01\x00', 'MS'), (b'SQLite format 3\x00', 'SQLite')
+                 )
+
+FILE_TYPE_SNIFF_SIZE = 1024
+FILE_BATCH_SIZE = 512
+
 keydict = {'sshkey': lambda user, pk: user.sshkey_set.get(id=pk).delete(),
            'gnupgkey': lambda user, pk: user.gnupgkey_set.get(id=pk).delete()
            }
 
-months_dict = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-               'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+TRANSIT_RETRY_AFTER = getattr(settings, 'TRANSIT_RETRY_AFTER', 5)
+
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tar.zst', '.tgz', '.tar', '.zip')
+BYTE_RANGE = re.compile(r'([0-9]*)-([0-9]*)$')
+
+PAGE_CACHE_ANONYMOUS = getattr(settings, 'PAGE_CACHE_ANONYMOUS', False)
+PAGE_CACHE_TIMEOUT = getattr(settings, 'PAGE_CACHE_TIMEOUT', 60 * 5)
+PAGE_ETAG_VERSION = getattr(settings, 'PAGE_ETAG_VERSION', '1')
+
+LINE_OFFSETS_TIMEOUT = getattr(settings, 'LINE_OFFSETS_TIMEOUT', 60 * 60 * 24)
+LINE_OFFSETS_MAX_CACHE_SIZE = getattr(settings, 'LINE_OFFSETS_MAX_CACHE_SIZE', 512 * 1024)  # Under memcached's item limit
 
 imag_dict = {'large': settings.PROFILE_THUMB_LARGE,
              'small': settings.PROFILE_THUMB_SMALL,
              'mini': settings.PROFILE_THUMB_MINI}
 
 
-def detect_file_type(filename):
+def parse_file_output(output):
     """
-    This detects the file type(programming language)
-    :param filename:
+    Turns a line of ``file(1)`` output into a file type, e.g. "Python script, ASCII text" -> "Python"
+    :param output:
     :return:
     """
-    command = 'file {}'.format(filename)
-    process = Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    result = process.communicate()[0]
+    return output.split(',')[0].split(': ')[-1].replace('script', '').split(' ')[0].strip()
+
+
+def sniff_file_type(filename, head):
+    """
+    Classifies a file from its name and first bytes without leaving the process
+    :param filename:
+    :param bytes head: the first FILE_TYPE_SNIFF_SIZE bytes of the file
+    :return: the file type, None if only file(1) can tell
+    """
+    lexer = FILE_TYPE_EXTENSIONS.get(os.path.splitext(filename)[-1].lower())
+    if lexer is not None:
+        return FILE_TYPES.get(lexer, lexer.capitalize())
+
+    if not head:
+        return 'Text'
+
+    if head.startswith(b'#!'):
+        interpreter = head[2:].split(b'\n', 1)[0].split()
+        if interpreter and interpreter[0].endswith(b'/env') and len(interpreter) > 1:
+            interpreter = interpreter[1:]
+
+        if interpreter:
+            name = os.path.basename(interpreter[0].decode('utf-8', 'replace')).rstrip('0123456789.')
+            file_type = SHEBANG_TYPES.get(name)
+            if file_type is not None:
+                return file_type
+
+    for magic, file_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return file_type
+
+    if b'\0' not in head:
+        return 'Text'
+    return None
+
+
+def split_head(chunks, skip=0):
+    """
+    Takes the first FILE_TYPE_SNIFF_SIZE bytes of a stream for sniffing without reading it twice
+    :param chunks: iterable of the bytes of a file from its beginning
+    :param skip: bytes at the beginning that are only sniffed, e.g. those before a byte range
+    :return: (head, the rest of chunks from byte skip on), closing the rest closes chunks
+    """
+    chunks = iter(chunks)
+    read = b''
+
+    for chunk in chunks:
+        read += chunk
+        if len(read) >= FILE_TYPE_SNIFF_SIZE:
+            break
+    return read[:FILE_TYPE_SNIFF_SIZE], _skip_bytes(read, chunks, skip)
+
+
+def _skip_bytes(read, chunks, skip):
+    position = len(read)
 
     try:
-        result = result.decode("utf-8")
-    except AttributeError:
-        pass
+        if position > skip:
+            yield read[skip:]
+
+        for chunk in chunks:
+            chunk_start, position = position, position + len(chunk)
+            if position > skip:
+                yield chunk[max(skip - chunk_start, 0):]
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
 
-    result = result.split(',')[0].split(': ')[-1].replace('script', '').split(' ')[0].strip()
+
+def read_file_head(filename):
+    try:
+        with open(filename, 'rb') as input_file:
+            return input_file.read(FILE_TYPE_SNIFF_SIZE)
+    except (IOError, OSError):
+        return b''
+
+
+def detect_file_types(filenames):
+    """
+    Classifies a whole tree in one pass: extension, shebang and magic numbers are checked
+    in-process and whatever is left over goes to a single file(1) run per FILE_BATCH_SIZE files.
+    :param filenames:
+    :return: OrderedDict of filename -> file type
+    """
+    result = OrderedDict()
+    unknown = []
+
+    for filename in filenames:
+        file_type = sniff_file_type(filename, read_file_head(filename))
+        result[filename] = file_type
+        if file_type is None:
+            unknown.append(filename)
+
+    for start in range(0, len(unknown), FILE_BATCH_SIZE):
+        batch = unknown[start:start + FILE_BATCH_SIZE]
+        process = Popen(['file', '--print0', '--no-pad', '--'] + batch, stdout=PIPE, stderr=PIPE)
+        records = process.communicate()[0].split(b'\0')[1:]
+
+        # Records come in the order of batch as ": <description>\n<next file name>". file escapes
+        # newlines in names, so the description is whatever comes before the last one.
+        for filename, record in zip(batch, records):
+            description = record.rpartition(b'\n')[0] if b'\n' in record else record
+            result[filename] = parse_file_output(description.decode('utf-8', 'replace').lstrip(':').strip())
+
+    for filename in unknown:
+        if result[filename] is None:
+            result[filename] = 'data'
     return result
 
 
-def get_date_from_git(astring):
-    str_2_list = astring.split()
-    if len(str_2_list) == 5:
-        month, day, time_, year, _ = str_2_list
-    else:
-        month, day, time_, year = str_2_list[1:]
+def detect_blob_type(filename, data):
+    """
+    Same as detect_file_type for content that is not on disk, e.g. a blob
+    :param filename:
+    :param bytes data:
+    :return:
+    """
+    file_type = sniff_file_type(filename, data[:FILE_TYPE_SNIFF_SIZE])
+
+    if file_type is None:
+        process = Popen(['file', '-b', '-'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        file_type = parse_file_output(process.communicate(data[:FILE_TYPE_SNIFF_SIZE])[0].decode('utf-8', 'replace'))
+    return file_type or 'data'
+
 
-    month = months_dict[month]
-    minute, second, microsecond = [int(i) for i in time_.split(':')]
-    year, day, month = [int(one) for one in [year, day, month]]
-    return datetime.datetime(year, month, day, minute, second, microsecond)
+def detect_file_type(filename):
+    """
+    This detects the file type(programming language)
+    :param filename:
+    :return:
+    """
+    return detect_file_types([filename])[filename]
 
 
 def get_relative_and_full_path(file_path, path=settings.SOURCE):
@@ -138,106 +293,6 @@ def get_thumb_url(user, size, cache_name='thumb'):
         return thumb_url
 
 
-def commit_2_list(commits):
-    """
-    Takes commit from stdout and returns list of commit messages
-    :param commits:
-    :return:
-    """
-    commits = list(filter(None, commits.split('\n\n')))
-    all_commits = []
-
-    for index, value in enumerate(commits):
-        if not index % 2:
-            top = value.split('\n')
-        else:
-            bottom = list(filter(None, value.split('\n')))
-            top.append(bottom[-1].strip())
-            all_commits.append(top)
-    return all_commits
-
-
-class CommitParser(object):
-    def __init__(self, commits):
-        self.commit_str_list = self.parser_20_list(commits)
-        self.commit_objects = self.create_commit_object()
-
-    @staticmethod
-    def parser_20_list(commits):
-        """
-        Takes commit from stdout and returns list of commit messages
-        :param commits:
-        :return:
-        """
-        commits = list(filter(None, commits.decode("utf-8").split('\n\n')))
-        all_commits = []
-        commit_pack = []
-
-        for index, value in enumerate(commits):
-            if value.startswith('commit'):
-                commit_pack = [value]
-            else:
-                commit_pack.append(value)
-
-            if index > 0 and value.startswith('commit'):
-                all_commits.append(commit_pack)
-        return all_commits
-
-    def create_commit_object(self):
-        commit_objects_list = []
-        for commit in self.commit_str_list:
-            clean_commit = list(filter(None, commit))[0]
-            commit_objects_list.append(clean_commit)
-        commit_object_list = [solve_commit(a_list) for a_list in commit_objects_list]
-        return commit_object_list
-
-    def __call__(self):
-        return self.commit_objects
-
-
-def solve_commit(alist):
-    """
-    Takes desission and creates a commit instance
-    :param alist:
-    :return:
-    """
-    from .models import Commit
-    commit_dict = {}
-
-    if type(alist) == str:
-        alist = [alist]
-
-    if len(alist) == 2:
-        pt1 = alist[0].split('\n')
-        pt1.append(alist[1])
-        alist = pt1
-
-    if len(alist) > 4:
-        if alist[1].startswith('Merge:'):
-                commit, merge, author, date = alist[:4]
-                message = '\n'.join(alist[4:])
-                commit_dict.update({'merge': merge})
-        else:
-            commit, author, date = alist[:3]
-            message = '\n'.join(alist[3:])
-    elif len(alist) == 1:
-        try:
-            commit, author, date, = alist[0].splitlines()
-        except IndexError:
-            commit, merge, author, date, = alist[0].splitlines()
-            commit_dict.update({'merge': merge})
-        message = ''
-
-    else:
-        commit, author, date, message = alist
-
-    commit_dict.update({'commit': commit, 'author': author,
-                        'date': date, 'message': message.strip()
-                        })
-    commit = Commit(**commit_dict)
-    return commit
-
-
 def normalize_link(root_dir, given_file_or_dir, source_link=settings.SOURCE):
     full_path = os.path.join(root_dir, given_file_or_dir)
     files_or_paths = []
@@ -260,7 +315,8 @@ def normalize_link(root_dir, given_file_or_dir, source_link=settings.SOURCE):
 
 
 def markdown_2_html(markdown_text):
-    html = format_html(markdown.markdown(markdown_text))
+    # Not format_html, the braces of the text would be taken for placeholders
+    html = mark_safe(markdown.markdown(markdown_text))
     return html
 
 
@@ -284,15 +340,107 @@ def get_code_n_count(afile):
     :param afile:
     :return:
     """
+    with open(afile, 'rb') as input_file:
+        return get_blob_code_n_count(input_file.read())
+
+
+def get_blob_code_n_count(data):
+    """
+    Same as get_code_n_count for the raw content of a blob
+    :param data: bytes
+    :return:
+    """
     try:
-        with codecs.open(afile, mode="r", encoding="utf-8") as input_file:
-            text = input_file.read()
-            num_lines = file_len(afile)
-            size = os.path.getsize(afile)
-            return text, num_lines, size
+        text = data.decode("utf-8")
     except UnicodeDecodeError:
         return reverse_lazy('encoding_error')
 
+    num_lines = text.count('\n')
+    if text and not text.endswith('\n'):
+        num_lines += 1
+    return text, num_lines, len(data)
+
+
+def line_offsets(chunks):
+    """
+    Index of the lines of a file in one pass over its content, offsets[n - 1]:offsets[n] is line n
+    :param chunks: iterable of the bytes of the file
+    :return: array of the byte offset each line starts at, followed by the size of the file
+    """
+    offsets = array('I', [0])
+    position = 0
+
+    for chunk in chunks:
+        if offsets.typecode == 'I' and position + len(chunk) > 0xFFFFFFFF:
+            offsets = array('Q', offsets)
+        find, append = chunk.find, offsets.append
+        index = find(b'\n')
+
+        while index != -1:
+            append(position + index + 1)
+            index = find(b'\n', index + 1)
+        position += len(chunk)
+
+    if offsets[-1] != position:
+        offsets.append(position)
+    return offsets
+
+
+def get_line_offsets(chunks, sha=None):
+    """
+    line_offsets of a blob, kept in the cache under its sha. Only read when they are not
+    cached, stored as zlib compressed line lengths and not at all when that is over
+    LINE_OFFSETS_MAX_CACHE_SIZE.
+    """
+    if sha is None:
+        return line_offsets(chunks)
+
+    key = 'line-offsets:{0}'.format(sha)
+    cached = cache.get(key)
+
+    if cached is not None:
+        typecode, packed = cached
+        lengths = array(typecode)
+        lengths.frombytes(zlib.decompress(packed))
+        return array(typecode, accumulate(lengths))
+
+    offsets = line_offsets(chunks)
+    lengths = array(offsets.typecode, [0])
+    lengths.extend(map(sub, islice(offsets, 1, None), offsets))
+    packed = zlib.compress(lengths.tobytes())
+
+    if len(packed) <= LINE_OFFSETS_MAX_CACHE_SIZE:
+        cache.set(key, (offsets.typecode, packed), LINE_OFFSETS_TIMEOUT)
+    return offsets
+
+
+def parse_byte_range(header, size):
+    """
+    Parses a Range header for a single range of bytes, e.g. bytes=0-499, bytes=500- or bytes=-500
+    :return: (start, stop) with stop exclusive, None to send everything (no header, several
+             ranges or a unit other than bytes) or False if the range is past the end
+    """
+    unit, _, ranges = (header or '').partition('=')
+
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+
+    match = BYTE_RANGE.match(ranges.strip())
+
+    if match is None or not any(match.groups()):
+        return None  # Not a valid range, ignored like the header was not sent
+    first, last = match.groups()
+
+    if not first:
+        # The last bytes, a suffix of 0 bytes can never be satisfied
+        start, stop = max(size - int(last), 0), size
+        return (start, stop) if int(last) and size else False
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    return (start, min(int(last) + 1, size) if last else size) if start < size else False
+
 
 def get_language_via_ext(ext):
     return EXTENSIONS.get(ext, None)
@@ -396,6 +544,109 @@ def get_project_repo(repo_name, project_name, slug=None):
         return None
 
 
+def get_project_from_git_path(path_info):
+    """
+    Returns the project a smart HTTP path (/<repo>/<project>.git/...) points at or None.
+    """
+    from .models import Project
+    parts = list(filter(None, path_info.split('/')))
+
+    for index, part in enumerate(parts[1:], 1):
+        if part.endswith('.git'):
+            return Project.objects.filter(repo__name=parts[index - 1],
+                                          path__endswith='/{0}'.format(part)).first()
+    return None
+
+
+def on_complete(generator, callback, *args):
+    """
+    Yields everything from generator, then calls callback(*args) once it is exhausted
+    or closed by the server.
+    """
+    try:
+        for chunk in generator:
+            yield chunk
+    finally:
+        callback(*args)
+
+
+def transit_warming_response(request, project):
+    """
+    Answered while a project's transit clone is being created, instead of blocking the worker.
+    """
+    response = render(request, 'gitapp/warming.html',
+                      {'project': project, 'retry_after': TRANSIT_RETRY_AFTER}, status=503)
+    response['Retry-After'] = TRANSIT_RETRY_AFTER
+    return response
+
+
+def page_etag(request, project):
+    """
+    ETag of a page of project: its pages_fingerprint, the url and who is looking
+    """
+    viewer = request.user.pk if request.user.is_authenticated else '-'
+    fingerprint = project.pages_fingerprint(working_dir=getattr(request, 'reads_working_dir', False))
+    parts = (PAGE_ETAG_VERSION, fingerprint, request.get_full_path(),
+             str(viewer), getattr(request, 'LANGUAGE_CODE', ''))
+    return '"{0}"'.format(sha1('\0'.join(parts).encode('utf-8')).hexdigest())
+
+
+def conditional_on_refs(func):
+    """
+    Decorator for the pages of a project that only depend on it, its refs, the url and the
+    viewer, put under view_if_public. A matching If-None-Match is answered with 304 before
+    the view does any git or template work. With PAGE_CACHE_ANONYMOUS anonymous views of
+    public projects are served from the cache.
+    """
+
+    def _dec(request, *args, **kwargs):
+        project = getattr(request, 'project', None)
+
+        if request.method not in ('GET', 'HEAD') or project is None:
+            return func(request, *args, **kwargs)
+
+        etag = page_etag(request, project)
+        key = 'page:{0}'.format(etag.strip('"'))
+        shared = PAGE_CACHE_ANONYMOUS and not project.is_private and not request.user.is_authenticated
+
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            cached = cache.get(key) if shared else None
+
+            if cached is not None:
+                response = HttpResponse(cached[1], content_type=cached[0])
+            else:
+                response = func(request, *args, **kwargs)
+
+                if response.status_code != 200 or response.streaming:
+                    return response
+
+                if hasattr(response, 'render') and not response.is_rendered:
+                    response.render()
+
+                # Pages that hand out a cookie or a CSRF token are the viewer's own
+                if shared and not response.cookies and not request.META.get('CSRF_COOKIE_USED'):
+                    cache.set(key, (response['Content-Type'], response.content), PAGE_CACHE_TIMEOUT)
+
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True, max_age=0, must_revalidate=True,
+                            **({'private': True} if project.is_private else {'public': True}))
+        patch_vary_headers(response, ('Cookie',))
+        return response
+    return _dec
+
+
+def split_archive_extension(name):
+    """
+    Splits 'my.lib.tar.gz' into ('my.lib', 'tar.gz'), gives (name, None) without one of ARCHIVE_EXTENSIONS
+    """
+    for extension in ARCHIVE_EXTENSIONS:
+        if name.endswith(extension):
+            return name[:-len(extension)], extension[1:]
+    return name, None
+
+
 def view_if_public(func):
     """ Decorator that ensure the repo is accessed only if its public. """
 
@@ -411,31 +662,16 @@ def view_if_public(func):
         elif project_name.endswith('.git'):
             project_name = project_name.split('.git')[0]
 
-            project = get_project_repo(request.user.username, project_name)
+            project = get_project_repo(repo_name, project_name)
 
         else:
-            ext = project_name.split('.')
-            if ext[-1] in ['zip', 'gz']:
-
-                if ext == '.zip':
-                    project_name = project_name.split('.zip')[0]
-
-                else:
-                    project_name = project_name.split('.tar.gz')[0]
+            project_name = split_archive_extension(project_name)[0]
 
             kwargs['repo_name'] = repo_name
-            project = get_project_repo(request.user.username, project_name)
+            project = get_project_repo(repo_name, project_name)
             if project is None:
                 raise PermissionDenied
 
-        exists = os.path.exists(project.working_dir)
-
-        if not exists:
-            update_transit.delay(project.id)
-            while not exists:
-                time.sleep(1)
-                exists = os.path.exists(project.working_dir)
-
         is_owner = project.repo.owner == request.user
 
         if project.is_private and not is_owner:
@@ -448,6 +684,36 @@ def view_if_public(func):
     return _dec
 
 
+def needs_working_dir(func):
+    """
+    Decorator, below view_if_public, for views that read the transit clone of the project.
+    While the clone is being created they answer 503 instead of blocking the worker.
+    """
+
+    def _dec(request, *args, **kwargs):
+        project = request.project
+
+        if not os.path.exists(project.working_dir):
+            project.refresh_transit()
+
+            if not os.path.exists(project.working_dir):
+                return transit_warming_response(request, project)
+
+        setattr(request, "reads_working_dir", True)  # See page_etag
+        return func(request, *args, **kwargs)
+    return _dec
+
+
+def browses_working_dir(func):
+    """
+    needs_working_dir for the views browsing files, which only read the transit clone
+    when BROWSE_BARE_REPO is off
+    """
+    from .models import BROWSE_BARE_REPO
+
+    return func if BROWSE_BARE_REPO else needs_working_dir(func)
+
+
 class cd(object):
     def __init__(self, new_path):
         self.new_path = new_path
@@ -1,18 +1,21 @@
 # coding: utf-8
 
 import os
-import time
-from subprocess import Popen, PIPE
-from wsgiref.util import FileWrapper
+import re
 
 from django.contrib.auth.views import LoginView
+from django.utils.cache import add_never_cache_headers, patch_cache_control
 from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt
 from django.utils.translation import ugettext_lazy as _
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, Http404
 from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required
-from django.utils.encoding import smart_str
+from django.contrib.admin.views.decorators import staff_member_required
+from django.template.defaultfilters import slugify
+from django.utils.http import parse_etags, urlencode
 from django.urls import reverse_lazy, reverse
 from django.contrib.auth import authenticate
 from django.contrib.auth import login
@@ -27,13 +30,22 @@ from django.views.generic import View
 
 from django.db import transaction
 
-from gitapp import gitHttpBackend
+from gitapp import compression, gitHttpBackend
+from gitapp.admission import GIT_TRANSFERS, transfer_metrics
+from gitapp.exception import TransferRejected
+from gitapp.repository import ObjectNotFound
+from gitapp.filecache import FileCache
+from gitapp.highlight import highlight_code
+from gitapp.markup import render_markdown
 from gitapp.forms import WikiUpdateForm
 from gitapp.mixins import WikiMixin
 from gitapp.models import Wiki
-from .utils import (view_if_public, get_project_repo,
-                    delete_key, get_code_n_count, cd, markdown_2_html,
-                    get_language_via_ext, get_thumb_url, get_relative_and_full_path
+from .utils import (view_if_public, needs_working_dir, browses_working_dir, conditional_on_refs,
+                    get_project_repo, delete_key, get_code_n_count,
+                    get_language_via_ext, get_thumb_url, get_relative_and_full_path,
+                    get_project_from_git_path, on_complete,
+                    get_blob_code_n_count, get_line_offsets, parse_byte_range, sniff_file_type,
+                    split_archive_extension, split_head, FILE_TYPE_SNIFF_SIZE
                     )
 from .forms import (CreateProjectForm, LoginForm, UserCreationForm, WikiForm,
                     ChangePasswordForm, ChangeEmailForm,
@@ -43,92 +55,251 @@ from .tables import (format_repo_2_table, ProjectListTable, KeyTable, EmailTable
                      ProjectFilesTable, dynamic_format_repo_2_table)
 
 
+ARCHIVE_CONTENT_TYPES = {'zip': 'application/zip', 'tar.gz': 'application/gzip',
+                         'tgz': 'application/gzip', 'tar': 'application/x-tar', 'tar.zst': 'application/zstd'}
+ARCHIVE_COMPRESSION_LEVEL = getattr(settings, 'ARCHIVE_COMPRESSION_LEVEL', 6)
+LARGE_FILE_SIZE = getattr(settings, 'LARGE_FILE_SIZE', 512 * 1024)  # Bigger files are shown a window at a time
+FILE_WINDOW_LINES = getattr(settings, 'FILE_WINDOW_LINES', 1000)
+FILE_WINDOW_MAX_LINES = getattr(settings, 'FILE_WINDOW_MAX_LINES', 5000)  # Largest ?start=&end= window
+RAW_MAX_AGE = getattr(settings, 'RAW_MAX_AGE', 60 * 60 * 24 * 365)  # For raw files at a commit sha
+RAW_IMMUTABLE_REF = re.compile(r'^[0-9a-f]{40}$')
+ARCHIVE_CACHE = FileCache(settings.COMPRESSION_POINT, getattr(settings, 'ARCHIVE_CACHE_SIZE', 1 << 30))
+
+
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(browses_working_dir, name='dispatch')
+@method_decorator(conditional_on_refs, name='dispatch')
 class DisplayFileView(TemplateView):
+    """
+    Shows a file or a directory of a project at ?ref= (HEAD by default)
+    """
     template_name = 'gitapp/code.html'
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         repo_name = kwargs.get("repo_name")
         project_name = kwargs.get("project_name")
+        project = self.request.project
+        ref = self.request.GET.get('ref') or None
 
-        path = '{0}/{1}.git'.format(repo_name, project_name)
-        project = get_object_or_404(Project, repo__name=repo_name, path=path)
-
-        code = size = num_lines = lang = None
-        file_path = self.request.META.get('PATH_INFO', '/')
-        relative_path = file_path.replace(settings.SOURCE + '/', '')
-        relative_path = '/'.join([path for path in filter(None, relative_path.split('/'))])
-        full_path = os.path.join(settings.TRANSIT_POINT, relative_path)
-        file_path = full_path
+        code = size = num_lines = lang = sha = window = data = None
+        n_relative_path = kwargs['file_path'].strip('/')
+        path_type = project.path_type(n_relative_path, ref=ref)
 
-        if file_path == '/' or not os.path.exists(full_path):
+        if not n_relative_path or path_type is None:
             raise Http404
 
-        else:
-            if os.path.isdir(file_path):
-                table = dynamic_format_repo_2_table(project, file_path)
-                self.template_name = 'gitapp/specific_project.html'
-                context.update({'project': project, 'table': table})
+        if path_type == 'tree':
+            table = dynamic_format_repo_2_table(project, n_relative_path, ref=ref)
+            self.template_name = 'gitapp/list_files_in_repo.html'
+            context.update({'project': project, 'table': table, 'user': project.repo.owner})
+            return context
+
+        elif path_type == 'blob':
+            filename = n_relative_path.split('/')[-1]
+            context.update({'filename': filename})
+            file_ = os.path.splitext(filename)[0]
+            readme = file_.lower() == 'readme'
+
+            try:
+                blob_sha, size = project.blob_info(n_relative_path, ref=ref)
+            except ObjectNotFound:
+                raise Http404
+            window = None if readme else self.get_window(size)
+            if not readme:
+                sha = blob_sha
+
+            if window is None:
+                data = project.read_blob(n_relative_path, ref=ref)
+                list_or_str = get_blob_code_n_count(data)
+            else:
+                # Only the bytes of the window are kept, the whole blob is only read once to
+                # index its lines when that is not cached yet
+                data = None
+                list_or_str, window = self.read_window(project, n_relative_path, sha, ref, size, *window)
+
+            if not isinstance(list_or_str, tuple):
+                self.template_name = 'error.html'
+                context.update({'error_message': _('The file You Are Trying To open as Encoding Error')})
                 return context
 
-            elif os.path.isfile(file_path):
-                list_or_str = get_code_n_count(file_path)
-                if type(list_or_str) == str:
-                    return redirect(list_or_str)
-
-                code, num_lines, size = list_or_str
-                filename = os.path.split(file_path)[-1]
-                context.update({'filename': filename})
-                file_ = os.path.splitext(filename)[0]
-                if file_.lower() == 'readme':
-                    code = markdown_2_html(code)
-
-                ext = os.path.splitext(file_path)[-1]
-                if ext:
-                    if ext in ['rm', 'rst', 'html']:
-                        lang = 'html'
-                    else:
-                        lang = get_language_via_ext(ext)
-
-            if lang is None:
-                with cd(project.working_dir):
-                    command = ['file', file_path]
-                    process = Popen(command, stdout=PIPE, stderr=PIPE)
-                    result = process.communicate()[0].decode("utf-8")
-                    lang = result.split(',')[0].split(': ')[-1].replace('script', '').split(' ')[0].strip().lower()
-
-            n_relative_path = '/'.join([i for i in filter(None, relative_path.split('/'))
-                                        if i not in (repo_name, project_name)])
-            history_url = reverse('file_history', args=[repo_name, project_name, n_relative_path])
-            edit_url = reverse('edit_file', args=[repo_name, project_name, n_relative_path])
-            text_url = reverse('render_file_as_text', args=[repo_name, project_name, n_relative_path])
-
-            context.update({'code': code, 'num_lines': num_lines,
-                            'size': size, 'project': project, 'lang': lang,
-                            'history_url': history_url, 'text_url': text_url,
-                            'edit_url': edit_url})
+            code, num_lines, size = list_or_str
+            if readme:
+                code = render_markdown(code, key=blob_sha)
+
+            ext = os.path.splitext(filename)[-1]
+            if ext:
+                if ext in ['rm', 'rst', 'html']:
+                    lang = 'html'
+                else:
+                    lang = get_language_via_ext(ext)
+
+        if lang is None:
+            if data is None:
+                head = b''.join(project.stream_blob(n_relative_path, ref=ref, stop=FILE_TYPE_SNIFF_SIZE, sha=sha))
+            else:
+                head = data[:FILE_TYPE_SNIFF_SIZE]
+            lang = (sniff_file_type(n_relative_path, head) or 'text').lower()
+
+        history_url = reverse('file_history', args=[repo_name, project_name, n_relative_path])
+        edit_url = reverse('edit_file', args=[repo_name, project_name, n_relative_path])
+        text_url = reverse('raw_file', args=[repo_name, project_name, n_relative_path])
+
+        if ref:
+            text_url = '{0}?{1}'.format(text_url, urlencode({'ref': ref}))
+
+        if window is None:
+            highlighted = highlight_code(code, lang, sha=sha)
+        else:
+            # Only the lines on the page are highlighted, numbered from where they start
+            highlighted = highlight_code(code, lang, sha=sha and '{0}.{1}-{2}'.format(sha, window['start'],
+                                                                                    window['end']),
+                                         strip=False, linenostart=window['start'])
+
+        context.update({'code': code, 'num_lines': num_lines,
+                        'highlighted': mark_safe(highlighted), 'window': window,
+                        'size': size, 'project': project, 'lang': lang,
+                        'history_url': history_url, 'text_url': text_url,
+                        'edit_url': edit_url})
 
-            return context
+        return context
+
+    def get_window(self, size):
+        """
+        Lines (start, end) asked for with ?start=&end=, the first FILE_WINDOW_LINES for files
+        bigger than LARGE_FILE_SIZE, None to show the whole file
+        """
+        start, end = self.request.GET.get('start'), self.request.GET.get('end')
+
+        if not (start or end) and size <= LARGE_FILE_SIZE:
+            return None
+
+        try:
+            start = max(int(start or 1), 1)
+            end = int(end) if end else start + FILE_WINDOW_LINES - 1
+        except ValueError:
+            raise Http404
+        return start, max(start, min(end, start + FILE_WINDOW_MAX_LINES - 1))
+
+    def read_window(self, project, path, sha, ref, size, start, end):
+        """
+        Reads and decodes lines start to end of the file at path only
+        :return: ((code, num_lines, size) or the encoding error url, the window for the template)
+        """
+        offsets = get_line_offsets(project.stream_blob(path, ref=ref, sha=sha), sha)
+        num_lines = len(offsets) - 1
+
+        if start > max(num_lines, 1):
+            raise Http404
+        end = min(end, num_lines)
+
+        try:
+            code = b''.join(project.stream_blob(path, ref=ref, start=offsets[start - 1], stop=offsets[end],
+                                                sha=sha)).decode('utf-8')
+        except UnicodeDecodeError:
+            return reverse_lazy('encoding_error'), None
+
+        lines = end - start + 1
+        window = {'start': start, 'end': end, 'previous_url': None, 'next_url': None}
+
+        if start > 1:
+            window['previous_url'] = self.window_url(ref, max(start - lines, 1), start - 1)
+        if end < num_lines:
+            window['next_url'] = self.window_url(ref, end + 1, min(end + lines, num_lines))
+        return (code, num_lines, size), window
+
+    def window_url(self, ref, start, end):
+        query = [('start', start), ('end', end)]
+
+        if ref:
+            query.insert(0, ('ref', ref))
+        return '{0}?{1}'.format(self.request.path, urlencode(query))
 
 
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(browses_working_dir, name='dispatch')
+class RawFileView(View):
+    """
+    Streams a file of a project at ?ref= (HEAD by default) as is. The blob sha is the ETag,
+    a single byte range is answered with 206 and urls pinned to a commit sha are cacheable for good.
+    """
+    def get(self, request, *args, **kwargs):
+        project = request.project
+        ref = request.GET.get('ref') or None
+        path = kwargs['file_path'].strip('/')
+
+        try:
+            sha, size = project.blob_info(path, ref=ref)
+        except ObjectNotFound:
+            raise Http404
+
+        etag = '"{0}"'.format(sha) if sha else None
+
+        if etag and set(parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))) & {etag, '*'}:
+            response = HttpResponseNotModified()
+        else:
+            byte_range = parse_byte_range(request.META.get('HTTP_RANGE'), size)
+            if_range = request.META.get('HTTP_IF_RANGE')
+
+            if if_range and if_range != etag:
+                byte_range = None  # The client's partial copy is of another version
+
+            if byte_range is False:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */{0}'.format(size)
+            else:
+                start, stop = byte_range or (0, size)
+                # The type is sniffed from the first chunk of the body: git reads a blob from its
+                # beginning anyway. Only a working dir file is read at the range with a seek, its
+                # head then costs one more small read but no process.
+                if sha or not start:
+                    head, body = split_head(project.stream_blob(path, ref=ref, stop=stop, sha=sha), start)
+                else:
+                    head = b''.join(project.stream_blob(path, ref=ref, stop=FILE_TYPE_SNIFF_SIZE))
+                    body = project.stream_blob(path, ref=ref, start=start, stop=stop)
+                content_type = 'application/octet-stream' if b'\0' in head else 'text/plain; charset=utf-8'
+                response = StreamingHttpResponse(body, content_type=content_type, status=206 if byte_range else 200)
+                response['Content-Length'] = stop - start
+
+                if byte_range:
+                    response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop - 1, size)
+
+            response['Accept-Ranges'] = 'bytes'
+            response['X-Content-Type-Options'] = 'nosniff'
+
+        if etag:
+            response['ETag'] = etag
+
+        cache_control = {'private': True} if project.is_private else {'public': True}
+        if ref and RAW_IMMUTABLE_REF.match(ref) and project.repository.rev_parse(ref) == ref:
+            # A file at a given commit can never change
+            patch_cache_control(response, max_age=RAW_MAX_AGE, immutable=True, **cache_control)
+        else:
+            patch_cache_control(response, no_cache=True, max_age=0, must_revalidate=True, **cache_control)
+        return response
+
+
+@method_decorator(view_if_public, name='dispatch')
+@method_decorator(browses_working_dir, name='dispatch')
 class RenderFileAsTextView(TemplateView):
     template_name = 'gitapp/text.html'
     full_path = None
 
     def get_context_data(self, **kwargs):
-        self.full_path = get_relative_and_full_path(self.request.META.get('PATH_INFO', '/'),
-                                                    path=settings.TEXT_PATH)[1]
-        if self.full_path == '/' or not os.path.exists(self.full_path) or os.path.isdir(self.full_path):
+        project = self.request.project
+        ref = self.request.GET.get('ref') or None
+        self.full_path = kwargs['file_path'].strip('/')
+
+        if not self.full_path or project.path_type(self.full_path, ref=ref) != 'blob':
             raise Http404
         context = {}
-        code = get_code_n_count(self.full_path)[0]
+        code = get_blob_code_n_count(project.read_blob(self.full_path, ref=ref))[0]
         context.update({'code': code})
         return context
 
 
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(needs_working_dir, name='dispatch')
 @method_decorator(login_required, name='dispatch')
 class EditCodeView(FormView):
     template_name = 'gitapp/edit.html'
@@ -352,6 +523,7 @@ class ChangeRepoStatusView(UpdateView):
 
 
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(conditional_on_refs, name='dispatch')
 class ListCommitsView(DetailView):
     template_name = 'gitapp/commit_default.html'
     context_object_name = "project"
@@ -366,12 +538,23 @@ class ListCommitsView(DetailView):
         project = context["project"]
 
         user = project.repo.owner
-        commits = project.commits()
+        commits = project.commit_history(self.kwargs.get("branch"))
         all_commits = CommitFactory(commits)
 
         page = self.request.GET.get('page')
+        before = self.request.GET.get('before')
+        tip = self.request.GET.get('tip')
+        skip = self.request.GET.get('skip')
+
+        if before is not None:
+            before = project.repository.rev_parse(before)
+            tip = project.repository.rev_parse(tip) if tip else None
+            if before is None or (self.request.GET.get('tip') and tip is None):
+                raise Http404
+            skip = int(skip) if skip and skip.isdigit() else None
+
         context.update({'repo': project, 'user': user,
-                       'commits': all_commits.get_commits_page(page)})
+                       'commits': all_commits.get_commits_page(page, before=before, tip=tip, skip=skip)})
 
         if self.request.GET.get('time_line'):
             self.template_name = 'gitapp/commits_timeline.html'
@@ -496,6 +679,8 @@ class CreateProjectView(CreateView):
 
 
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(browses_working_dir, name='dispatch')
+@method_decorator(conditional_on_refs, name='dispatch')
 class ProjectDetailView(DetailView):
     template_name = 'gitapp/project_detail.html'
     context_object_name = 'project'
@@ -514,6 +699,9 @@ class ProjectDetailView(DetailView):
         table = format_repo_2_table(project)
         readme_file = project.get_readme_file()
 
+        if readme_file:
+            readme_file = mark_safe(highlight_code(readme_file, 'html'))
+
         context.update({'table': table,
                         'user': project.repo.owner,
                         'readme_file': readme_file}
@@ -522,6 +710,7 @@ class ProjectDetailView(DetailView):
 
 
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(conditional_on_refs, name='dispatch')
 class WikiDetailView(DetailView):
     template_name = 'gitapp/read_wiki.html'
     context_object_name = 'wiki'
@@ -579,6 +768,8 @@ class WikiDeleteView(WikiMixin, DeleteView):
 
 @method_decorator(login_required, name="dispatch")
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(needs_working_dir, name='dispatch')
+@method_decorator(conditional_on_refs, name='dispatch')
 class FilesInRepo(TemplateView):
     template_name = 'gitapp/list_files_in_repo.html'
 
@@ -599,10 +790,12 @@ class FilesInRepo(TemplateView):
             raise Http404
 
 
+@method_decorator(csrf_exempt, name="dispatch")
 @method_decorator(login_required, name="dispatch")
 class GitView(View):
     """
-    This view handles all git commands
+    This view handles all git commands. The smart HTTP protocol is spoken here,
+    anything else (the dumb protocol) goes through git http-backend.
     """
     def dispatch(self, request, *args, **kwargs):
         try:
@@ -610,38 +803,104 @@ class GitView(View):
         except AttributeError:
             user = None
 
+        service = kwargs.get('service')
+        advertised_service = request.GET.get('service')
+
+        if service == 'info/refs' and advertised_service in gitHttpBackend.SERVICES:
+            return self.advertise_refs(request, advertised_service)
+
+        if request.method == 'POST' and service in gitHttpBackend.SERVICES:
+            return self.run_service(request, service, user)
+
         status_line, headers, response_body_generator = \
             gitHttpBackend.wsgi_to_git_http_backend(request.META,
                                                     settings.REPO_PATH,
                                                     user=user)
 
-        response = HttpResponse(response_body_generator,
-                                status=int(status_line[:3]))
-        headers = dict((key, values) for key, values in headers)
+        response = StreamingHttpResponse(response_body_generator,
+                                         status=int(status_line[:3]))
+
+        for key, value in headers:
+            response[key] = value
+
+        return response
+
+    @staticmethod
+    def get_project(request):
+        project = get_project_from_git_path(request.path_info)
+
+        if project is None or not project.repository.exists():
+            raise Http404
+        return project
+
+    def advertise_refs(self, request, service):
+        project = self.get_project(request)
+        etag, body = gitHttpBackend.cached_advertise_refs(project.repository, service,
+                                                          request.META.get('HTTP_GIT_PROTOCOL'))
 
-        for key, values in headers.items():
-            setattr(response, key, values)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/x-{0}-advertisement'.format(service))
 
+        response['ETag'] = etag
+        patch_cache_control(response, no_cache=True, max_age=0, must_revalidate=True)
         return response
 
+    def run_service(self, request, service, user):
+        project = self.get_project(request)
+        content_type = 'application/x-{0}-result'.format(service)
+        old_refs = project.repository.refs() if service == 'git-receive-pack' else None
+
+        if service == 'git-upload-pack':
+            git_dir = project.repository.git_dir
+            client = user or request.META.get('REMOTE_ADDR')
+            try:
+                path, response_body_generator = gitHttpBackend.run_cached_upload_pack(
+                    git_dir, request.META, user=user, admit=lambda: GIT_TRANSFERS.admit(git_dir, client))
+            except TransferRejected as error:
+                response = HttpResponse('Too many git transfers, retry in {0} seconds\n'.format(error.retry_after),
+                                        status=429, content_type='text/plain')
+                response['Retry-After'] = error.retry_after
+                return response
+
+            if path is not None:
+                response = gitHttpBackend.UPLOAD_PACK_CACHE.serve(path, content_type)
+                add_never_cache_headers(response)
+                return response
+        else:
+            response_body_generator = gitHttpBackend.run_git_service(project.repository.git_dir, service,
+                                                                     request.META, user=user)
+
+        if service == 'git-receive-pack':
+            response_body_generator = on_complete(response_body_generator, project.refs_updated, old_refs)
+
+        response = StreamingHttpResponse(response_body_generator, content_type=content_type)
+        add_never_cache_headers(response)
+        return response
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class GitTransfersView(View):
+    """
+    Admission metrics of the git transfers (running, queued, rejected, wait times) per worker process
+    """
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(transfer_metrics())
+
 
 @method_decorator(view_if_public, name='dispatch')
+@method_decorator(conditional_on_refs, name='dispatch')
 class HistoryView(TemplateView):
     """
-    Show diff on file
+    Show diff on file, read from the bare repo so it moves with the refs in the ETag
     """
     template_name = 'gitapp/history.html'
 
     def get_context_data(self, **kwargs):
-        _, full_path = get_relative_and_full_path(self.request.META.get('PATH_INFO', '/'),
-                                                  path=settings.EDIT_PATH)
-        project = get_object_or_404(Project,
-                                    repo__name=self.kwargs["repo_name"],
-                                    name=self.kwargs["project_name"])
-        with cd(project.working_dir):
-            command = ['git', 'diff', 'HEAD^^', 'HEAD', full_path]
-            process = Popen(command, stdout=PIPE, stderr=PIPE)
-            result = process.communicate()[0].decode("utf-8")
+        project = self.request.project
+        path = kwargs['file_path'].strip('/')
+        result = project.repository.run('diff', 'HEAD^^', 'HEAD', '--', path).decode('utf-8', 'replace')
 
         return {'result': result}
 
@@ -658,33 +917,53 @@ class EncodingErrorView(TemplateView):
 
 @method_decorator(view_if_public, name='dispatch')
 class DownloadView(View):
-    def dispatch(self, request, *args, **kwargs):
-        repo_name = kwargs.get("repo_name")
-        project_name = kwargs.get("project_name").split('.')
+    """
+    Streams an archive of ?ref= (HEAD by default) made by git archive from the bare repo.
+    ?format= overrides the extension of the url and ?level= the compression level.
+    """
+    def get(self, request, *args, **kwargs):
+        project = request.project
+        name = project.media_name
+        archive_format = request.GET.get('format') or split_archive_extension(kwargs.get("project_name"))[1]
+        content_type = ARCHIVE_CONTENT_TYPES.get(archive_format)
 
-        project_name = project_name.split('.')
-        compression_type = '.'.join(project_name[1:])
-        path = '{0}/{1}.git'.format(repo_name, project_name[0])
-        project = get_object_or_404(Project, repo__name=repo_name, path=path)
-        project.compress_project(compression=compression_type)
-        file_path = smart_str(project.compress_project(return_path=True, compression=compression_type))
+        if content_type is None or (archive_format == 'tar.zst' and archive_format not in compression.COMPRESSORS):
+            raise Http404
 
-        with open(file_path, 'rb') as file_content:
-            response = HttpResponse(FileWrapper(file_content), content_type="application/force-download")
-            response['Content-Disposition'] = 'attachment; filename={0}; filename*=UTF-8''{0}' \
-                .format(smart_str(project.compress_project(return_compressed_dir=True, compression=compression_type)))
+        try:
+            level = compression.clamp_level(archive_format,
+                                            int(request.GET.get('level', ARCHIVE_COMPRESSION_LEVEL)))
+        except ValueError:
+            raise Http404
 
-            try:
-                response['Content-Length'] = os.path.getsize(file_path)
-            except (AttributeError, NotImplementedError):
-                pass  # Generated files.
-
-            response['Content-Encoding'] = 'utf-8'
-            Project.objects.filter(repo__name=repo_name, path=path).update(downloads=F('downloads') + 1)
-            file_path_not_exist = True
-
-            while file_path_not_exist:
-                time.sleep(6)  # Sleep while compressing is going on in background
-                if os.path.exists(file_path):
-                    file_path_not_exist = False
+        ref = request.GET.get('ref') or None
+        sha = project.repository.rev_parse(ref or 'HEAD')
+
+        if sha is None:
+            raise Http404
+
+        # Archives are made from the tree so branches and tags pointing at the same content share them
+        tree = project.repository.rev_parse('{0}^{{tree}}'.format(sha))
+        key = '{0}.{1}.{2}.{3}'.format(tree, name, level, archive_format)
+        path = ARCHIVE_CACHE.get(key)
+
+        if path is not None:
+            response = ARCHIVE_CACHE.serve(path, content_type)
+        else:
+            status = {}
+
+            if archive_format in compression.COMPRESSORS:
+                chunks = compression.compress(project.repository.archive(tree, 'tar', prefix='{0}/'.format(name),
+                                                                         status=status),
+                                              archive_format, level)
+            else:
+                chunks = project.repository.archive(tree, archive_format, prefix='{0}/'.format(name), level=level,
+                                                    status=status)
+            # A failed or killed git archive must not be cached
+            chunks = ARCHIVE_CACHE.fill(key, chunks, complete=lambda: status.get('returncode') == 0)
+            response = StreamingHttpResponse(chunks, content_type=content_type)
+
+        file_name = name if ref is None else '{0}-{1}'.format(name, slugify(ref))
+        response['Content-Disposition'] = 'attachment; filename={0}.{1}'.format(file_name, archive_format)
+        Project.objects.filter(pk=project.pk).update(downloads=F('downloads') + 1)
         return response
@@ -1,6 +1,7 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+from datetime import timedelta
 import os
 from os import environ
 from django.urls import reverse_lazy
@@ -91,7 +92,6 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'gitapp.middleware.TransitMiddleware',
 ]
 
 
@@ -177,12 +177,53 @@ ROOT_DIR = os.path.join(BASE_DIR, 'gitstation')
 REPO_PATH = os.path.join(ROOT_DIR, 'repo')  # Location of the git server repository
 TRANSIT_POINT = os.path.join(ROOT_DIR, 'transit')  # We clone repo to this dir and use it for serving or querying
 COMPRESSION_POINT = os.path.join(ROOT_DIR, 'compress')  # Location we use to server repo in compressed format
+ARCHIVE_CACHE_SIZE = 1 << 30  # Bytes of generated archives kept in COMPRESSION_POINT
+ARCHIVE_COMPRESSION_LEVEL = 6  # Default for ?level=, 1-9 (1-19 for tar.zst)
+ARCHIVE_COMPRESSION_THREADS = None  # Threads compressing tar.gz/tar.zst downloads, None for one per core
+ARCHIVE_COMPRESSION_BLOCK_SIZE = 128 * 1024  # Bytes of tar each thread deflates at a time
+UPLOAD_PACK_CACHE_POINT = os.path.join(ROOT_DIR, 'packs')  # Cached clone responses of git upload-pack
+UPLOAD_PACK_CACHE_SIZE = 4 << 30
+FILE_CACHE_FILL_WAIT = 60 * 2  # Seconds a request waits for an entry another one is caching before it makes its own
+FILE_CACHE_SENDFILE_HEADER = None  # 'X-Sendfile' or 'X-Accel-Redirect' to let the web server send cached files
+FILE_CACHE_SENDFILE_LOCATIONS = {COMPRESSION_POINT: '/protected/compress/',
+                                 UPLOAD_PACK_CACHE_POINT: '/protected/packs/'}  # Internal locations for X-Accel-Redirect
+
+# Git
+GIT_BINARY = 'git'
+GIT_REPOSITORY_POOL_SIZE = 64  # Max bare repos with live cat-file processes per worker
+GIT_HTTP_CHUNK_SIZE = 0x10000  # Bytes moved at a time between a git client and git http-backend
+GIT_HTTP_MAX_HEADER_SIZE = 0x20000
+REF_ADVERTISEMENT_CACHE_SIZE = 256  # info/refs responses (and git's own advertisements) kept in memory per process
+REF_ADVERTISEMENT_TIMEOUT = 60 * 60  # Seconds they are kept in the shared cache
+GIT_ADVERTISEMENT_TIMEOUT = 5 * 60  # Seconds git's own capabilities are reused before asking git again
+GIT_TRANSFER_MAX_ACTIVE = 16  # upload-packs running at once across all workers sharing CACHES['default']
+GIT_TRANSFER_MAX_PER_REPO = 4  # of which on the same repo
+GIT_TRANSFER_MAX_QUEUED = 64  # upload-packs waiting for a slot in one worker process before clients get a 429
+GIT_TRANSFER_SLOT_TIMEOUT = 60  # Slots of a worker that died are free again within two of these (seconds)
+GIT_TRANSFER_POLL_INTERVAL = 0.5  # Seconds between two looks, per worker, for a slot freed by another worker
+GIT_TRANSFER_QUEUE_TIMEOUT = 30  # Seconds one waits before it gets a 429
+GIT_TRANSFER_RETRY_AFTER = 10  # Base Retry-After of a 429, grows with the queue
+BROWSE_BARE_REPO = True  # Serve trees and files from REPO_PATH instead of the TRANSIT_POINT clone
+TRANSIT_LOCK_TIMEOUT = 60 * 10  # Longest a transit clone/pull may hold its single-flight lock
+TRANSIT_RETRY_AFTER = 5  # Seconds a client is told to wait while a transit clone is created
+LARGE_FILE_SIZE = 512 * 1024  # Files bigger than this are shown FILE_WINDOW_LINES at a time
+FILE_WINDOW_LINES = 1000
+FILE_WINDOW_MAX_LINES = 5000  # Most lines a ?start=&end= window may ask for
+LANGUAGE_STATS_MEASURE = 'files'  # What the language stats and chart weigh: 'files', 'lines' or 'bytes'
+MAINTENANCE_LOOSE_OBJECTS = 500  # Repack a repo once it has more loose objects than this
+MAINTENANCE_PACKS = 8  # or more packs than this (full repack past MAINTENANCE_FULL_REPACK_PACKS)
+MAINTENANCE_FULL_REPACK_PACKS = 32
+MAINTENANCE_PUSHES = 50  # or this many pushes since the last run
+PAGE_CACHE_ANONYMOUS = False  # Keep whole pages of public projects for anonymous visitors
+PAGE_CACHE_TIMEOUT = 60 * 5
+PAGE_ETAG_VERSION = '1'  # Change on deploys that change page markup, drops every page ETag
 
 # URL PATH
 SOURCE = 'src-tree'
 HISTORY = 'file-history'
 EDIT_PATH = 'edit-file'
 TEXT_PATH = 'render-as-text'
+RAW_PATH = 'raw'
 
 # Static & Media Paths
 MEDIA_ROOT = os.path.join(BASE_DIR, 'gitstation/media')
@@ -215,4 +256,13 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 CELERY_ALWAYS_EAGER = True
-CELERYBEAT_SCHEDULE = {}
+CELERYBEAT_SCHEDULE = {
+    'reconcile-transits': {
+        'task': 'gitapp.tasks.reconcile_transits',
+        'schedule': timedelta(minutes=10),
+    },
+    'schedule-maintenance': {
+        'task': 'gitapp.tasks.schedule_maintenance',
+        'schedule': timedelta(hours=1),
+    },
+}
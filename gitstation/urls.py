@@ -19,16 +19,21 @@ urlpatterns = [
     path('register/', views.UserRegistrationView.as_view(), name='signup'),
     path('login/', views.MyLoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', LogoutView.as_view(next_page=reverse_lazy('login')), name='logout'),
-    url(r'<repo_name>/((?P<project_name>.*).git)/info/refs$', views.GitView.as_view(), name='push_n_clone_fetch'),
+    url(r'^(?P<repo_name>[^/]+)/(?P<project_name>[^/]+)\.git/(?P<service>.+)$', views.GitView.as_view(),
+        name='push_n_clone_fetch'),
     path('encoding-error/', views.EncodingErrorView.as_view(), name='encoding_error'),
     path('<repo_name>/<project_name>/commits/<branch>/', views.ListCommitsView.as_view(), name='commits'),
-    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/{0}/$'.format(settings.SOURCE),
+    url(r'^(?P<repo_name>[^/]+)/(?P<project_name>[^/]+)/{0}/(?P<file_path>.*)$'.format(settings.SOURCE),
         views.DisplayFileView.as_view(), name='display_file'),
-    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/file-history/(.*)/$',
+    url(r'^(?P<repo_name>[^/]+)/(?P<project_name>[^/]+)/{0}/(?P<file_path>.*)$'.format(settings.RAW_PATH),
+        views.RawFileView.as_view(), name='raw_file'),
+    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/file-history/(?P<file_path>.*)/$',
         views.HistoryView.as_view(), name='file_history'),
-    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/edit-file/(.*)/$', views.EditCodeView.as_view(), name='edit_file'),
-    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/render-as-text/(.*)/$', views.RenderFileAsTextView.as_view(),
-        name='render_file_as_text'),
+    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/edit-file/(?P<file_path>.*)/$', views.EditCodeView.as_view(),
+        name='edit_file'),
+    url(r'^(?P<repo_name>.*)/(?P<project_name>.*)/render-as-text/(?P<file_path>.*)/$',
+        views.RenderFileAsTextView.as_view(), name='render_file_as_text'),
+    path('git-transfers/', views.GitTransfersView.as_view(), name='git_transfers'),
     path('admin/', admin.site.urls),
     path('account/', views.AccountView.as_view(), name='profile'),
     path('<username>/wall/', views.UserWallView.as_view(), name='wall'),